@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Notification, Location, Payment
+from .models import Notification, Location, Payment, OutboxMessage, RideTrack, TrackChunk
 
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
@@ -15,9 +15,28 @@ class LocationAdmin(admin.ModelAdmin):
     search_fields = ('user__username', 'driver__user__username')
     readonly_fields = ('timestamp',)
 
+@admin.register(TrackChunk)
+class TrackChunkAdmin(admin.ModelAdmin):
+    list_display = ('ride', 'driver', 'user', 'point_count', 'first_timestamp', 'last_timestamp')
+    search_fields = ('ride__id',)
+    exclude = ('data',)
+
+@admin.register(RideTrack)
+class RideTrackAdmin(admin.ModelAdmin):
+    list_display = ('ride', 'point_count', 'raw_point_count', 'tolerance_m', 'started_at')
+    search_fields = ('ride__id',)
+    readonly_fields = ('created_at', 'updated_at')
+
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
     list_display = ('ride', 'amount', 'payment_method', 'status', 'processed_at')
     list_filter = ('payment_method', 'status', 'processed_at')
     search_fields = ('transaction_id', 'ride__id')
-    readonly_fields = ('processed_at',)
\ No newline at end of file
+    readonly_fields = ('processed_at',)
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('group', 'status', 'attempts', 'available_at', 'created_at')
+    list_filter = ('status',)
+    search_fields = ('group',)
+    readonly_fields = ('created_at',)
\ No newline at end of file
@@ -1,20 +1,45 @@
 import json
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from drivers.models import Driver
 from rides.models import Ride
-from core.models import Location
-from django.utils import timezone
+from core.event_replay import current_seq, missed_events
+from core.location_buffer import location_buffer
+from core.location_filter import LocationFilter
+from core.services import FINISHED_RIDE_STATUSES, ride_group
+from core.trip_meter import ONBOARD_STATUSES, aload_trip_meter, asave_trip_meter
+from core.wire import LOCATION_SUBPROTOCOL, LocationDecoder, LocationEncoder, WireError, location_json
 
 User = get_user_model()
 
+RIDE_STATUSES = dict(Ride.RIDE_STATUS_CHOICES)
+
+# Rides whose context a connection remembers, including rejected ones
+RIDE_CONTEXT_CACHE_SIZE = 8
+
 class RideTrackingConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
         
         if self.user.is_authenticated:
-            await self.accept()
+            self.ride_contexts = {}
+            self.ride_groups = set()
+            self.driver_id = await self.get_driver_id()
+            self.location_filter = LocationFilter.for_user_type(self.user.user_type)
+
+            # Clients that offer the binary subprotocol exchange location
+            # frames as compact binary messages; everything else stays JSON
+            if LOCATION_SUBPROTOCOL in self.scope.get('subprotocols', []):
+                self.location_encoder = LocationEncoder()
+                self.location_decoder = LocationDecoder()
+                await self.accept(LOCATION_SUBPROTOCOL)
+            else:
+                self.location_encoder = self.location_decoder = None
+                await self.accept()
             
             # Add user to a group for tracking updates
             if self.user.user_type == 'driver':
@@ -26,6 +51,16 @@ class RideTrackingConsumer(AsyncWebsocketConsumer):
                 self.group_name,
                 self.channel_name
             )
+
+            # Rejoin the groups of rides already under way
+            for ride_id in await self.get_active_ride_ids():
+                await self.join_ride(ride_id)
+
+            # Live events up to this number were already sent by the replay
+            self.replayed_seq = 0
+            resume_from = self.get_resume_from()
+            if resume_from is not None:
+                await self.replay_events(resume_from)
         else:
             await self.close()
 
@@ -35,56 +70,139 @@ class RideTrackingConsumer(AsyncWebsocketConsumer):
             self.group_name,
             self.channel_name
         )
+        for ride_id in list(self.ride_groups):
+            await self.leave_ride(ride_id)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            if self.location_decoder is None:
+                await self.reject(None, 'Binary frames need the location subprotocol')
+                return
+            try:
+                ride_id, latitude, longitude, _ = self.location_decoder.decode(bytes_data)
+            except WireError as e:
+                await self.reject(None, str(e))
+                return
+            await self.handle_location(ride_id, latitude, longitude)
+            return
 
-    async def receive(self, text_data):
         text_data_json = json.loads(text_data)
         message_type = text_data_json.get('type')
         
         if message_type == 'location_update':
-            latitude = text_data_json.get('latitude')
-            longitude = text_data_json.get('longitude')
-            ride_id = text_data_json.get('ride_id')
-            
-            # Save location to database
-            await self.save_location(latitude, longitude, ride_id)
-            
-            # Broadcast location to relevant parties
-            await self.channel_layer.group_send(
-                self.group_name,
-                {
-                    'type': 'location_message',
-                    'latitude': latitude,
-                    'longitude': longitude,
-                    'ride_id': ride_id
-                }
+            await self.handle_location(
+                text_data_json.get('ride_id'),
+                text_data_json.get('latitude'),
+                text_data_json.get('longitude')
             )
         elif message_type == 'ride_status_update':
             ride_id = text_data_json.get('ride_id')
             status = text_data_json.get('status')
-            
+
+            context = await self.get_ride_context(ride_id)
+            if context is None:
+                await self.reject(ride_id)
+                return
+            if status not in RIDE_STATUSES:
+                await self.reject(ride_id, 'Invalid ride status')
+                return
+
             # Update ride status in database
-            await self.update_ride_status(ride_id, status)
+            await self.update_ride_status(context['ride_id'], status)
+            context['status'] = status
             
-            # Broadcast status update
+            # Broadcast status update to both parties
+            await self.join_ride(context['ride_id'])
             await self.channel_layer.group_send(
-                self.group_name,
+                ride_group(context['ride_id']),
                 {
                     'type': 'status_message',
-                    'ride_id': ride_id,
+                    'ride_id': context['ride_id'],
                     'status': status
                 }
             )
+            if status in FINISHED_RIDE_STATUSES:
+                await self.channel_layer.group_send(
+                    ride_group(context['ride_id']),
+                    {'type': 'ride_leave', 'ride_id': context['ride_id']}
+                )
+
+    async def handle_location(self, ride_id, latitude, longitude):
+        context = await self.get_ride_context(ride_id)
+        if context is None:
+            await self.reject(ride_id)
+            return
+
+        # Drop frames that arrive too fast or have not really moved
+        if not self.location_filter.accept(latitude, longitude, ride_id):
+            return
+
+        # Queue the location; the buffer writes it in bulk and turns away
+        # invalid coordinates, which are then not broadcast either
+        if not self.save_location(latitude, longitude, ride_id):
+            return
+
+        # The driver's points advance the trip meter, which gives the ETA
+        eta_seconds = None
+        if context['role'] == 'driver':
+            eta_seconds = await self.advance_trip_meter(context, float(latitude), float(longitude))
+
+        # One send reaches the other party; the sender skips its own copy
+        await self.join_ride(context['ride_id'])
+        await self.channel_layer.group_send(
+            ride_group(context['ride_id']),
+            {
+                'type': 'location_message',
+                'latitude': latitude,
+                'longitude': longitude,
+                'ride_id': context['ride_id'],
+                'eta_seconds': eta_seconds,
+                'sender_channel': self.channel_name
+            }
+        )
+
+    async def advance_trip_meter(self, context, latitude, longitude):
+        """
+        Add a point to the ride's trip meter, saved to the cache for
+        CompleteRideView. The meter is reloaded for every point, since
+        batches uploaded to /api/rides/update-location/ advance it too.
+        Returns the ETA in seconds to the pickup before it, to the
+        destination after it, or None.
+        """
+        meter = await aload_trip_meter(context['ride_id'])
+        onboard = context['status'] in ONBOARD_STATUSES
+        if meter.add(latitude, longitude, time.time(), onboard):
+            await asave_trip_meter(context['ride_id'], meter)
+
+        if onboard:
+            return meter.eta_seconds(*context['destination'])
+        if context['status'] == 'accepted':
+            return meter.eta_seconds(*context['pickup'])
+        return None
 
     async def location_message(self, event):
+        if event.get('sender_channel') == self.channel_name:
+            return
         # Send location data to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'location_update',
-            'latitude': event['latitude'],
-            'longitude': event['longitude'],
-            'ride_id': event['ride_id']
-        }))
+        if self.location_encoder is not None:
+            try:
+                frame = self.location_encoder.encode(
+                    event['ride_id'], event['latitude'], event['longitude'], event.get('eta_seconds')
+                )
+            except WireError:
+                return
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=location_json(
+                event['ride_id'], event['latitude'], event['longitude'], event.get('eta_seconds')
+            ))
 
     async def status_message(self, event):
+        # Keep the cached status current, whichever party changed it
+        context = self.ride_contexts.get(event['ride_id'])
+        if context is not None:
+            context['status'] = event['status']
+
         # Send status update to WebSocket
         await self.send(text_data=json.dumps({
             'type': 'ride_status_update',
@@ -92,34 +210,141 @@ class RideTrackingConsumer(AsyncWebsocketConsumer):
             'status': event['status']
         }))
 
+    async def notification_message(self, event):
+        if event.get('seq', self.replayed_seq + 1) <= self.replayed_seq:
+            return
+        # Send notification to WebSocket
+        data = {
+            'type': 'notification',
+            'message': event['message']
+        }
+        if 'seq' in event:
+            data['seq'] = event['seq']
+        await self.send(text_data=json.dumps(data))
+
+    async def ride_join(self, event):
+        # The ride was accepted; forget any context cached before that
+        self.ride_contexts.pop(event['ride_id'], None)
+        await self.join_ride(event['ride_id'])
+
+    async def ride_leave(self, event):
+        self.ride_contexts.pop(event['ride_id'], None)
+        await self.leave_ride(event['ride_id'])
+
+    async def join_ride(self, ride_id):
+        if ride_id not in self.ride_groups:
+            self.ride_groups.add(ride_id)
+            await self.channel_layer.group_add(ride_group(ride_id), self.channel_name)
+
+    async def leave_ride(self, ride_id):
+        if ride_id in self.ride_groups:
+            self.ride_groups.discard(ride_id)
+            await self.channel_layer.group_discard(ride_group(ride_id), self.channel_name)
+
+    def get_resume_from(self):
+        """The last event sequence number a reconnecting client saw, from ``?resume_from=``"""
+        values = parse_qs(self.scope.get('query_string', b'').decode()).get('resume_from')
+        try:
+            return max(int(values[0]), 0) if values else None
+        except ValueError:
+            return None
+
+    async def replay_events(self, resume_from):
+        """
+        Send the events the client missed since ``resume_from``. If they are
+        no longer all kept the client is told to resync instead, along with
+        the number to resume from next time. Events that arrive live
+        meanwhile are only handled after this, and those the replay already
+        covered are skipped.
+        """
+        events = await sync_to_async(missed_events)(self.user.id, resume_from)
+        if events is None:
+            self.replayed_seq = await sync_to_async(current_seq)(self.user.id)
+            await self.send(text_data=json.dumps({'type': 'resync', 'seq': self.replayed_seq}))
+            return
+        for event in events:
+            await getattr(self, event['type'])(event)
+            self.replayed_seq = event['seq']
+
     @sync_to_async
-    def save_location(self, latitude, longitude, ride_id):
+    def get_active_ride_ids(self):
+        rides = Ride.objects.filter(status__in=['accepted', 'picked_up', 'in_transit'])
+        if self.driver_id is not None:
+            rides = rides.filter(driver_id=self.driver_id)
+        else:
+            rides = rides.filter(passenger=self.user)
+        return list(rides.values_list('id', flat=True))
+
+    async def get_ride_context(self, ride_id):
+        """
+        The cached context of ``ride_id`` if the user takes part in it, else
+        None. Only the first frame for a ride costs a query; later frames,
+        including rejected ones, are answered from the connection's cache.
+        """
         try:
-            ride = Ride.objects.get(id=ride_id)
-            Location.objects.create(
-                user=self.user if self.user.user_type == 'passenger' else None,
-                driver=self.user.driver_profile if self.user.user_type == 'driver' else None,
-                ride=ride,
-                latitude=latitude,
-                longitude=longitude
-            )
-            
-            # Update driver's location if this is a driver
-            if self.user.user_type == 'driver':
-                driver = self.user.driver_profile
-                driver.location_lat = latitude
-                driver.location_lng = longitude
-                driver.last_location_update = timezone.now()
-                driver.save()
-                
-        except Ride.DoesNotExist:
-            pass
+            ride_id = int(ride_id)
+        except (TypeError, ValueError):
+            return None
+
+        context = self.ride_contexts.get(ride_id)
+        if context is None:
+            context = await self.load_ride_context(ride_id)
+            if len(self.ride_contexts) >= RIDE_CONTEXT_CACHE_SIZE:
+                self.ride_contexts.pop(next(iter(self.ride_contexts)))
+            self.ride_contexts[ride_id] = context
+        return context if context['role'] else None
+
+    @sync_to_async
+    def load_ride_context(self, ride_id):
+        ride = Ride.objects.filter(id=ride_id).values(
+            'status', 'passenger_id', 'driver__user_id',
+            'pickup_lat', 'pickup_lng', 'destination_lat', 'destination_lng'
+        ).first()
+        role = None
+        if ride is not None:
+            if ride['passenger_id'] == self.user.id:
+                role = 'passenger'
+            elif ride['driver__user_id'] == self.user.id:
+                role = 'driver'
+        return {
+            'ride_id': ride_id,
+            'role': role,
+            'status': ride['status'] if ride else None,
+            'passenger_id': ride['passenger_id'] if ride else None,
+            'driver_user_id': ride['driver__user_id'] if ride else None,
+            'pickup': (ride['pickup_lat'], ride['pickup_lng']) if ride else None,
+            'destination': (ride['destination_lat'], ride['destination_lng']) if ride else None,
+        }
+
+    async def reject(self, ride_id, message='Not a participant of this ride'):
+        await self.send(text_data=json.dumps({
+            'type': 'error',
+            'ride_id': ride_id,
+            'message': message
+        }))
+
+    @sync_to_async
+    def get_driver_id(self):
+        if self.user.user_type != 'driver':
+            return None
+        return Driver.objects.filter(user=self.user).values_list('id', flat=True).first()
+
+    def save_location(self, latitude, longitude, ride_id):
+        # No thread hop: the buffer only appends in memory and flushes in
+        # the background, also moving the driver's position
+        return location_buffer.add(
+            latitude,
+            longitude,
+            ride_id,
+            user_id=self.user.id if self.user.user_type == 'passenger' else None,
+            driver_id=self.driver_id
+        )
 
     @sync_to_async
     def update_ride_status(self, ride_id, status):
-        try:
-            ride = Ride.objects.get(id=ride_id)
-            ride.status = status
-            ride.save()
-        except Ride.DoesNotExist:
-            pass
\ No newline at end of file
+        # The ride is known to exist from the cached context
+        now = timezone.now()
+        fields = {'status': status, 'updated_at': now}
+        if status == 'picked_up':
+            fields['pickup_time'] = now
+        Ride.objects.filter(id=ride_id).update(**fields)
@@ -0,0 +1,103 @@
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import EventSequence, UserEvent
+
+# Per-user groups; events sent to them are numbered and kept for replay
+USER_GROUP = re.compile(r'^(?:passenger|driver)_(\d+)$')
+
+# Group events a client sees; internal ones such as ride_join are not replayed
+REPLAYED_EVENT_TYPES = ('notification_message',)
+
+
+def sequence_events(messages):
+    """
+    Number the events in ``(group, message)`` pairs that go to a user's
+    group with the user's next sequence numbers, in order, and keep them
+    for replay. Returns the pairs with those messages replaced by copies
+    carrying ``seq``; messages already numbered keep their number.
+
+    Numbers come from the user's EventSequence row, bumped with a single
+    UPDATE, so every process draws from the same series and a number is
+    never handed out twice. Rows are locked in user id order so concurrent
+    batches queue up instead of deadlocking. The last
+    EVENT_REPLAY_BUFFER_SIZE events of a user are kept for at most
+    EVENT_REPLAY_TIMEOUT seconds; older ones are pruned each time a user's
+    numbers pass another multiple of the buffer size.
+    """
+    indices = {}
+    for index, (group, message) in enumerate(messages):
+        match = USER_GROUP.match(group)
+        if match is not None and message.get('type') in REPLAYED_EVENT_TYPES and 'seq' not in message:
+            indices.setdefault(int(match.group(1)), []).append(index)
+    if not indices:
+        return messages
+
+    messages = list(messages)
+    size = getattr(settings, 'EVENT_REPLAY_BUFFER_SIZE', 100)
+    expired = timezone.now() - timedelta(seconds=getattr(settings, 'EVENT_REPLAY_TIMEOUT', 3600))
+    user_ids = sorted(indices)
+    with transaction.atomic():
+        # The rows stay locked until commit
+        missing = [user_id for user_id in user_ids if not bump(user_id, len(indices[user_id]))]
+        if missing:
+            # Users seen for the first time, after every existing row is held
+            EventSequence.objects.bulk_create(
+                [EventSequence(user_id=user_id) for user_id in missing], ignore_conflicts=True
+            )
+            for user_id in missing:
+                bump(user_id, len(indices[user_id]))
+        last_seqs = dict(EventSequence.objects.filter(user_id__in=user_ids).values_list('user_id', 'last_seq'))
+
+        events = []
+        stale = Q()
+        for user_id in user_ids:
+            user_indices = indices[user_id]
+            first = last_seqs[user_id] - len(user_indices) + 1
+            for seq, index in enumerate(user_indices, first):
+                group, message = messages[index]
+                messages[index] = (group, {**message, 'seq': seq})
+                events.append(UserEvent(user_id=user_id, seq=seq, payload=messages[index][1]))
+            if (first - 1) // size != last_seqs[user_id] // size:
+                stale |= Q(user_id=user_id) & (Q(seq__lte=last_seqs[user_id] - size) | Q(created_at__lt=expired))
+        UserEvent.objects.bulk_create(events)
+        if stale:
+            UserEvent.objects.filter(stale).delete()
+    return messages
+
+
+def bump(user_id, count):
+    """Move a user's sequence ``count`` numbers on; False if the user has no row yet"""
+    return EventSequence.objects.filter(user_id=user_id).update(last_seq=F('last_seq') + count) > 0
+
+
+def current_seq(user_id):
+    return EventSequence.objects.filter(user_id=user_id).values_list('last_seq', flat=True).first() or 0
+
+
+def missed_events(user_id, resume_from):
+    """
+    Events of a user numbered after ``resume_from``, oldest first, or None
+    if some of them are no longer kept, or ``resume_from`` was never handed
+    out, and the client has to reload its state instead.
+    """
+    current = current_seq(user_id)
+    if resume_from > current or current - resume_from > getattr(settings, 'EVENT_REPLAY_BUFFER_SIZE', 100):
+        return None
+    if resume_from == current:
+        return []
+
+    expired = timezone.now() - timedelta(seconds=getattr(settings, 'EVENT_REPLAY_TIMEOUT', 3600))
+    events = list(
+        UserEvent.objects.filter(
+            user_id=user_id, seq__gt=resume_from, seq__lte=current, created_at__gte=expired
+        ).order_by('seq').values_list('payload', flat=True)
+    )
+    if len(events) < current - resume_from:
+        return None
+    return events
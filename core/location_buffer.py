@@ -0,0 +1,235 @@
+import atexit
+import logging
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from drivers.positions import record_positions
+from rides.models import Ride
+from . import metrics
+from .models import TrackChunk
+from .track_storage import from_epoch_ms, pack_arrays, pack_chunk, read_chunks
+
+logger = logging.getLogger(__name__)
+
+COORDINATE_PLACES = Decimal('0.000001')
+
+
+def parse_coordinate(value, limit):
+    """Return ``value`` as a 6 decimal place Decimal, or None if it is not a valid coordinate"""
+    try:
+        coordinate = Decimal(str(value)).quantize(COORDINATE_PLACES)
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+    if not coordinate.is_finite() or abs(coordinate) > limit:
+        return None
+    return coordinate
+
+
+def append_track_runs(runs):
+    """
+    Append ``{(ride_id, user_id, driver_id): [(lat, lng, ts), ...]}`` to
+    the participants' tracks and return the number of points stored.
+
+    Every run is sealed as a chunk of its own, so a flush is a single
+    INSERT that neither reads nor locks earlier rows. ``merge_track_chunks``
+    folds the small chunks together later.
+    """
+    chunks = []
+    for (ride_id, user_id, driver_id), run in runs.items():
+        latitudes, longitudes, timestamps = zip(*run)
+        chunks.append(TrackChunk(
+            ride_id=ride_id,
+            user_id=user_id,
+            driver_id=driver_id,
+            data=pack_chunk(latitudes, longitudes, timestamps),
+            point_count=len(run),
+            first_timestamp=min(timestamps),
+            last_timestamp=max(timestamps)
+        ))
+    TrackChunk.objects.bulk_create(chunks)
+    return sum(len(run) for run in runs.values())
+
+
+def merge_track_chunks(ride_ids):
+    """
+    Merge the small chunks of every participant of ``ride_ids`` that has
+    more than TRACK_CHUNK_MAX_OPEN of them into chunks of up to
+    TRACK_CHUNK_MAX_POINTS points. Full chunks are never rewritten, so a
+    merge repacks less than one full chunk besides the new small ones
+    however long the ride. Chunks another process is merging are skipped.
+    Returns the number of chunks removed.
+    """
+    max_points = getattr(settings, 'TRACK_CHUNK_MAX_POINTS', 4096)
+    crowded = (
+        TrackChunk.objects.filter(ride_id__in=ride_ids, point_count__lt=max_points)
+        .values_list('ride_id', 'user_id', 'driver_id')
+        .annotate(chunks=Count('id'))
+        .filter(chunks__gt=getattr(settings, 'TRACK_CHUNK_MAX_OPEN', 16))
+    )
+    removed = 0
+    for ride_id, user_id, driver_id, _ in crowded:
+        with transaction.atomic():
+            chunks = list(
+                TrackChunk.objects.select_for_update(skip_locked=True).filter(
+                    ride_id=ride_id, user_id=user_id, driver_id=driver_id, point_count__lt=max_points
+                )
+            )
+            if len(chunks) < 2:
+                continue
+            lat, lng, ts = read_chunks([bytes(chunk.data) for chunk in chunks])
+            TrackChunk.objects.filter(id__in=[chunk.id for chunk in chunks]).delete()
+            merged = []
+            for start in range(0, len(ts), max_points):
+                part = slice(start, start + max_points)
+                merged.append(TrackChunk(
+                    ride_id=ride_id,
+                    user_id=user_id,
+                    driver_id=driver_id,
+                    data=pack_arrays(lat[part], lng[part], ts[part]),
+                    point_count=len(ts[part]),
+                    first_timestamp=from_epoch_ms(ts[part][0]),
+                    last_timestamp=from_epoch_ms(ts[part][-1])
+                ))
+            TrackChunk.objects.bulk_create(merged)
+        removed += len(chunks) - len(merged)
+    if removed:
+        metrics.counter('location_buffer.chunks_merged').inc(removed)
+    return removed
+
+
+class LocationBuffer:
+    """
+    Write-behind buffer for live location points.
+
+    ``add()`` only appends to an in-memory list, so it is safe to call from
+    async consumers without a thread hop. On a background thread, once
+    LOCATION_BUFFER_MAX_SIZE points are waiting or LOCATION_BUFFER_FLUSH_SECONDS
+    after the first one arrived, the points are appended to their rides'
+    tracks (see ``append_track_runs`` and ``merge_track_chunks``). Driver positions are coalesced to
+    the latest point per driver and handed to the position store, which
+    persists them on its own throttled cadence.
+
+    Points for rides that do not exist are dropped, as before. A failed
+    flush puts its points back so the next flush retries them, as long as
+    no more than LOCATION_BUFFER_MAX_PENDING are waiting.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._points = []
+        self._timer = None
+
+    def __len__(self):
+        return len(self._points)
+
+    def add(self, latitude, longitude, ride_id, user_id=None, driver_id=None, timestamp=None):
+        """Queue a location point; returns False if it was rejected as invalid"""
+        latitude = parse_coordinate(latitude, 90)
+        longitude = parse_coordinate(longitude, 180)
+        try:
+            ride_id = int(ride_id)
+        except (TypeError, ValueError):
+            ride_id = None
+        if latitude is None or longitude is None or ride_id is None:
+            metrics.counter('location_buffer.rejected').inc()
+            return False
+
+        point = (ride_id, user_id, driver_id, latitude, longitude, timestamp or timezone.now())
+        with self._lock:
+            self._points.append(point)
+            pending = len(self._points)
+            if pending >= getattr(settings, 'LOCATION_BUFFER_MAX_SIZE', 500):
+                self._schedule(0)
+            elif self._timer is None:
+                self._schedule(getattr(settings, 'LOCATION_BUFFER_FLUSH_SECONDS', 2))
+        metrics.counter('location_buffer.points').inc()
+        metrics.gauge('location_buffer.pending').set(pending)
+        return True
+
+    def _schedule(self, delay):
+        # Called with self._lock held
+        if self._timer is not None:
+            if delay > 0:
+                return
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._flush_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Location buffer flush failed')
+        finally:
+            connection.close()
+
+    def flush(self):
+        """Write every buffered point now; returns the number of points stored"""
+        with self._flush_lock:
+            with self._lock:
+                points, self._points = self._points, []
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not points:
+                return 0
+
+            started = time.perf_counter()
+            try:
+                stored = self._write(points)
+            except Exception:
+                self._requeue(points)
+                raise
+            metrics.histogram('location_buffer.flush_ms').observe((time.perf_counter() - started) * 1000)
+            metrics.counter('location_buffer.flushed').inc(stored)
+            metrics.gauge('location_buffer.pending').set(len(self._points))
+            return stored
+
+    def _write(self, points):
+        ride_ids = set(
+            Ride.objects.filter(id__in={point[0] for point in points}).values_list('id', flat=True)
+        )
+        runs = {}
+        latest = {}
+        for ride_id, user_id, driver_id, latitude, longitude, timestamp in points:
+            if ride_id not in ride_ids:
+                continue
+            runs.setdefault((ride_id, user_id, driver_id), []).append((latitude, longitude, timestamp))
+            if driver_id is not None:
+                latest[driver_id] = (latitude, longitude, timestamp)
+
+        with transaction.atomic():
+            stored = append_track_runs(runs)
+            record_positions(latest)
+        merge_track_chunks({ride_id for ride_id, _, _ in runs})
+        return stored
+
+    def _requeue(self, points):
+        limit = getattr(settings, 'LOCATION_BUFFER_MAX_PENDING', 50000)
+        with self._lock:
+            dropped = max(len(points) + len(self._points) - limit, 0)
+            # Keep the newest points when over the limit
+            self._points[:0] = points[dropped:]
+            if self._points and self._timer is None:
+                self._schedule(getattr(settings, 'LOCATION_BUFFER_FLUSH_SECONDS', 2))
+        if dropped > 0:
+            metrics.counter('location_buffer.dropped').inc(dropped)
+
+    def close(self):
+        """Flush what is left; registered to run at interpreter shutdown"""
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Could not drain the location buffer on shutdown')
+
+
+location_buffer = LocationBuffer()
+atexit.register(location_buffer.close)
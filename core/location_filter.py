@@ -0,0 +1,68 @@
+import time
+
+from django.conf import settings
+
+from drivers.geo import haversine_km
+from . import metrics
+
+DEFAULT_LOCATION_FILTER = {
+    'driver': {'MIN_DISTANCE_M': 10, 'MIN_INTERVAL_SECONDS': 2, 'MAX_INTERVAL_SECONDS': 30},
+    'passenger': {'MIN_DISTANCE_M': 25, 'MIN_INTERVAL_SECONDS': 5, 'MAX_INTERVAL_SECONDS': 60},
+}
+
+
+class LocationFilter:
+    """
+    Dead-band and rate limit for the location frames of one connection.
+
+    A frame is kept if it is the first one, belongs to a different ride,
+    or arrives at least ``min_interval`` seconds after the last kept frame
+    and has moved at least ``min_distance_m`` from it. A device that stays
+    put is still kept every ``max_interval`` seconds as a heartbeat.
+    Clients send on a fixed interval, so a dropped frame is superseded by
+    the next one and the stream is effectively coalesced to its latest
+    position.
+    """
+
+    def __init__(self, user_type, min_distance_m=0, min_interval=0, max_interval=None):
+        self.user_type = user_type
+        self.min_distance_m = min_distance_m
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.last = None  # (lat, lng, ride_id, time) of the last kept frame
+
+    @classmethod
+    def for_user_type(cls, user_type):
+        config = getattr(settings, 'LOCATION_FILTER', DEFAULT_LOCATION_FILTER).get(user_type, {})
+        return cls(
+            user_type,
+            min_distance_m=config.get('MIN_DISTANCE_M', 0),
+            min_interval=config.get('MIN_INTERVAL_SECONDS', 0),
+            max_interval=config.get('MAX_INTERVAL_SECONDS'),
+        )
+
+    def accept(self, latitude, longitude, ride_id=None, now=None):
+        """True if the frame should be stored and broadcast"""
+        now = time.monotonic() if now is None else now
+        try:
+            lat, lng = float(latitude), float(longitude)
+        except (TypeError, ValueError):
+            return self._drop('invalid')
+
+        if self.last is not None and self.last[2] == ride_id:
+            last_lat, last_lng, _, last_time = self.last
+            elapsed = now - last_time
+            if elapsed < self.min_interval:
+                return self._drop('rate')
+            heartbeat_due = self.max_interval is not None and elapsed >= self.max_interval
+            if not heartbeat_due and haversine_km(last_lat, last_lng, lat, lng) * 1000 < self.min_distance_m:
+                return self._drop('stationary')
+
+        self.last = (lat, lng, ride_id, now)
+        metrics.counter(f'location_filter.kept.{self.user_type}').inc()
+        return True
+
+    def _drop(self, reason):
+        metrics.counter(f'location_filter.dropped.{self.user_type}').inc()
+        metrics.counter(f'location_filter.dropped.{reason}').inc()
+        return False
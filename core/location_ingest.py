@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from drivers.positions import get_position_store, record_positions
+from . import metrics
+from .location_buffer import append_track_runs, merge_track_chunks, parse_coordinate
+from .track_storage import to_epoch_ms
+from .trip_meter import ONBOARD_STATUSES, load_trip_meter, save_trip_meter
+
+# How long the newest uploaded timestamp is remembered to spot retried uploads
+HIGH_WATER_TIMEOUT = 24 * 3600
+
+
+def parse_timestamp(value):
+    """An aware datetime from an ISO 8601 string or epoch milliseconds, or None"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        try:
+            return datetime.fromtimestamp(value / 1000, tz=dt_timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            return None
+    if not isinstance(value, str):
+        return None
+    try:
+        timestamp = parse_datetime(value)
+    except ValueError:
+        return None
+    if timestamp is not None and timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp, dt_timezone.utc)
+    return timestamp
+
+
+def ingest_locations(ride, user, points, driver_id=None):
+    """
+    Store a batch of timestamped points that a device buffered while it
+    was offline, keeping the device's timestamps.
+
+    Points with invalid coordinates, or timestamps before the ride or
+    further than LOCATION_BATCH_MAX_CLOCK_SKEW_SECONDS in the future, are
+    rejected. Repeated timestamps within the batch are duplicates, and so
+    is anything at or before the newest point of an earlier batch from the
+    same device, which makes a retried upload harmless. What is left is
+    merged into the participant's track in one write.
+
+    For a driver the newest point becomes the latest position, once per
+    batch and only if it is fresher than the one already known, and the
+    points advance the trip meter (see ``TripMeter.add_uploaded``).
+    Returns the number of points accepted, duplicated and rejected.
+    """
+    skew = timedelta(seconds=getattr(settings, 'LOCATION_BATCH_MAX_CLOCK_SKEW_SECONDS', 60))
+    now = timezone.now()
+    earliest = ride.created_at - skew
+
+    valid = {}
+    rejected = duplicates = 0
+    for point in points:
+        if not isinstance(point, dict):
+            rejected += 1
+            continue
+        latitude = parse_coordinate(point.get('latitude'), 90)
+        longitude = parse_coordinate(point.get('longitude'), 180)
+        timestamp = parse_timestamp(point.get('timestamp'))
+        if latitude is None or longitude is None or timestamp is None or not earliest <= timestamp <= now + skew:
+            rejected += 1
+            continue
+        # A clock slightly ahead must not put points after live ones
+        timestamp = min(timestamp, now)
+        key = to_epoch_ms(timestamp)
+        if key in valid:
+            duplicates += 1
+            continue
+        valid[key] = (latitude, longitude, timestamp)
+
+    high_water_key = f'location_ingest:{ride.id}:{user.id}'
+    high_water = cache.get(high_water_key)
+    if high_water is not None:
+        stale = [key for key in valid if key <= high_water]
+        for key in stale:
+            del valid[key]
+        duplicates += len(stale)
+
+    run = [valid[key] for key in sorted(valid)]
+    if run:
+        latitudes, longitudes, timestamps = zip(*run)
+        with transaction.atomic():
+            append_track_runs({(ride.id, user.id if driver_id is None else None, driver_id): run})
+            if driver_id is not None:
+                current = get_position_store().get(driver_id)
+                if current is None or current[2] < timestamps[-1]:
+                    record_positions({driver_id: run[-1]})
+        merge_track_chunks([ride.id])
+        cache.set(high_water_key, to_epoch_ms(timestamps[-1]), HIGH_WATER_TIMEOUT)
+
+        if driver_id is not None and ride.status in ('accepted',) + ONBOARD_STATUSES:
+            meter = load_trip_meter(ride.id)
+            meter.add_uploaded(
+                [(float(latitude), float(longitude), timestamp.timestamp()) for latitude, longitude, timestamp in run],
+                ride.status in ONBOARD_STATUSES
+            )
+            save_trip_meter(ride.id, meter)
+
+    metrics.counter('location_ingest.points').inc(len(run))
+    metrics.counter('location_ingest.duplicates').inc(duplicates)
+    metrics.counter('location_ingest.rejected').inc(rejected)
+    return {'accepted': len(run), 'duplicates': duplicates, 'rejected': rejected}
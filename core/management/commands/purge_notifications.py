@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.retention import count_expired_notifications, purge_expired_notifications
+
+
+class Command(BaseCommand):
+    help = 'Delete notifications older than their type\'s NOTIFICATION_RETENTION, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=getattr(settings, 'NOTIFICATION_PURGE_BATCH_SIZE', 1000)
+        )
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the expired notifications')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            for notification_type, expired in count_expired_notifications().items():
+                self.stdout.write(f"{notification_type}: {expired} expired")
+            return
+
+        def progress(notification_type, deleted):
+            if options['verbosity'] > 1:
+                self.stdout.write(f"{notification_type}: {deleted} deleted so far")
+
+        deleted = purge_expired_notifications(
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            progress=progress
+        )
+        for notification_type, count in deleted.items():
+            self.stdout.write(f"{notification_type}: deleted {count}")
+        self.stdout.write(f"Deleted {sum(deleted.values())} notification(s)")
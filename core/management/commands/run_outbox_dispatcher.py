@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.outbox import dispatcher
+
+
+class Command(BaseCommand):
+    help = 'Deliver pending outbox messages, including retries and messages left behind by other processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls')
+        parser.add_argument('--once', action='store_true', help='Drain once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            dispatcher.drain()
+            if options['once']:
+                self.stdout.write(f"Outbox queue depth: {dispatcher.refresh_queue_depth()}")
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,90 @@
+import threading
+from collections import deque
+
+
+class Counter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Keeps the most recent ``size`` observations and reports percentiles
+    over them, plus lifetime count and sum.
+    """
+
+    def __init__(self, size=1024):
+        self._lock = threading.Lock()
+        self._values = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._values.append(value)
+            self.count += 1
+            self.total += value
+
+    def percentile(self, q):
+        with self._lock:
+            values = sorted(self._values)
+        if not values:
+            return None
+        return values[min(int(q / 100 * len(values)), len(values) - 1)]
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': round(self.total, 3),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _get_or_create(name, kind):
+    metric = _registry.get(name)
+    if metric is None:
+        with _registry_lock:
+            metric = _registry.setdefault(name, kind())
+    return metric
+
+
+def counter(name):
+    return _get_or_create(name, Counter)
+
+
+def gauge(name):
+    return _get_or_create(name, Gauge)
+
+
+def histogram(name):
+    return _get_or_create(name, Histogram)
+
+
+def snapshot():
+    """Current value of every registered metric, keyed by name"""
+    return {name: metric.snapshot() for name, metric in sorted(_registry.items())}
@@ -0,0 +1,31 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_location_timestamp_default'),
+        ('rides', '0003_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RideTrack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('polyline', models.TextField()),
+                ('timestamps', models.TextField()),
+                ('started_at', models.DateTimeField()),
+                ('precision', models.PositiveSmallIntegerField(default=5)),
+                ('tolerance_m', models.FloatField()),
+                ('point_count', models.PositiveIntegerField()),
+                ('raw_point_count', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('ride', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='track', to='rides.ride')),
+            ],
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from drivers.models import Driver
 from rides.models import Ride
 
@@ -20,8 +21,20 @@ class Notification(models.Model):
     title = models.CharField(max_length=200)
     message = models.TextField()
     is_read = models.BooleanField(default=False)
+    # How many events were coalesced into this notification
+    group_count = models.PositiveIntegerField(default=1)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Inbox pages walk (created_at, id) newest first
+            models.Index(fields=['recipient', '-created_at', '-id'], name='notification_inbox_idx'),
+            # Seeds cold unread counters
+            models.Index(fields=['recipient'], condition=models.Q(is_read=False), name='notification_unread_idx'),
+            # Retention purges walk each type oldest first
+            models.Index(fields=['notification_type', 'created_at'], name='notification_type_created_idx'),
+        ]
+
     def __str__(self):
         return f"{self.title} - {self.recipient.username}"
 
@@ -35,7 +48,13 @@ class Location(models.Model):
 
     latitude = models.DecimalField(max_digits=9, decimal_places=6)
     longitude = models.DecimalField(max_digits=9, decimal_places=6)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, so buffered points keep the time they were received
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ride', 'timestamp'], name='location_ride_timestamp_idx'),
+        ]
 
     def __str__(self):
         if self.driver:
@@ -45,6 +64,50 @@ class Location(models.Model):
         else:
             return f"Location at {self.timestamp}"
 
+class TrackChunk(models.Model):
+    """
+    A run of live location points of one ride participant, packed as a
+    columnar blob by ``core.track_storage``. Each flush of new points is a
+    chunk of its own; small chunks are merged into ones of up to
+    TRACK_CHUNK_MAX_POINTS (see ``core.location_buffer.merge_track_chunks``).
+    """
+    ride = models.ForeignKey(Ride, on_delete=models.CASCADE, related_name='track_chunks')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    driver = models.ForeignKey(Driver, on_delete=models.CASCADE, null=True, blank=True)
+    data = models.BinaryField()
+    point_count = models.PositiveIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ride', 'first_timestamp'], name='trackchunk_ride_first_ts_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.point_count} points for ride #{self.ride_id} from {self.first_timestamp}"
+
+class RideTrack(models.Model):
+    """
+    Simplified route of a finished ride, replacing its raw track chunks.
+    Coordinates are a Google encoded polyline and timestamps are encoded
+    the same way as whole seconds after ``started_at``.
+    """
+    ride = models.OneToOneField(Ride, on_delete=models.CASCADE, related_name='track')
+    polyline = models.TextField()
+    timestamps = models.TextField()
+    started_at = models.DateTimeField()
+    precision = models.PositiveSmallIntegerField(default=5)
+    tolerance_m = models.FloatField()
+    point_count = models.PositiveIntegerField()
+    raw_point_count = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Track for ride #{self.ride_id} ({self.point_count} points)"
+
 class Payment(models.Model):
     PAYMENT_STATUS_CHOICES = (
         ('pending', 'Pending'),
@@ -69,3 +132,67 @@ class Payment(models.Model):
 
     def __str__(self):
         return f"Payment for Ride #{self.ride.id} - {self.amount}"
+
+
+class OutboxMessage(models.Model):
+    """
+    Channel-layer message written in the same transaction as the change it
+    announces and delivered after commit by ``core.outbox.OutboxDispatcher``
+    """
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('sending', 'Sending'),
+        ('failed', 'Failed'),
+    )
+
+    group = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    claim_token = models.UUIDField(null=True, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    # Pending messages with the same key are replaced rather than queued again
+    dedupe_key = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='outbox_status_available_idx'),
+            models.Index(
+                fields=['dedupe_key'],
+                condition=models.Q(status='pending') & ~models.Q(dedupe_key=''),
+                name='outbox_pending_dedupe_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return f"Outbox message #{self.id} to {self.group} ({self.status})"
+
+
+class EventSequence(models.Model):
+    """Last event sequence number handed out to a user, see ``core.event_replay``"""
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, db_constraint=False, related_name='+'
+    )
+    last_seq = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Event #{self.last_seq} for user #{self.user_id}"
+
+
+class UserEvent(models.Model):
+    """A numbered event sent to a user, kept to replay to a reconnecting client"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False, related_name='+')
+    seq = models.PositiveBigIntegerField()
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'seq'], name='userevent_user_seq_uniq'),
+        ]
+
+    def __str__(self):
+        return f"Event #{self.seq} for user #{self.user_id}"
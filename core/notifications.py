@@ -0,0 +1,147 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Cast, Concat
+from django.utils import timezone
+
+from .models import Notification
+
+
+def unread_count_key(user_id):
+    return f'notifications:unread:{user_id}'
+
+
+def get_unread_count(user_id):
+    """
+    Unread notifications of a user, from a cached counter. Only a cold
+    counter (first read, or after eviction or expiry) costs a COUNT, which
+    then seeds it; creating and reading notifications keep it current.
+
+    Notifications are also created and deleted by management commands, so
+    with more than one process the counter needs a shared cache (see
+    REDIS_CACHE_URL in settings); a per-process cache would miss their
+    changes until the counter expires.
+    """
+    key = unread_count_key(user_id)
+    count = cache.get(key)
+    if count is None:
+        count = Notification.objects.filter(recipient_id=user_id, is_read=False).count()
+        # add() keeps a counter that another request seeded first
+        if not cache.add(key, count, getattr(settings, 'NOTIFICATION_UNREAD_COUNT_TIMEOUT', 3600)):
+            count = cache.get(key, count)
+    return max(count, 0)
+
+
+def adjust_unread_counts(deltas, on_commit=True):
+    """
+    Apply ``{user_id: delta}`` to the cached counters, by default once the
+    current transaction commits. Cold counters are left alone; they are
+    seeded from the database on their next read.
+    """
+    deltas = {user_id: delta for user_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    def apply():
+        for user_id, delta in deltas.items():
+            try:
+                cache.incr(unread_count_key(user_id), delta)
+            except ValueError:
+                pass
+
+    if on_commit:
+        transaction.on_commit(apply)
+    else:
+        apply()
+
+
+def create_notifications(notifications):
+    """
+    Insert Notification instances with one ``bulk_create`` and count them
+    towards their recipients' unread counters. Every notification should be
+    created through here so the counters stay right.
+    """
+    notifications = Notification.objects.bulk_create(notifications)
+    adjust_unread_counts(Counter(
+        notification.recipient_id for notification in notifications if not notification.is_read
+    ))
+    return notifications
+
+
+def create_notification(**fields):
+    return create_notifications([Notification(**fields)])[0]
+
+
+def coalesce_notifications(recipient_ids, notification_type, title, message, grouped_title):
+    """
+    Notify ``recipient_ids`` without piling up rows. A recipient who still
+    has an unread notification of this type from the last
+    NOTIFICATION_COALESCE_SECONDS gets that one updated in place: its
+    ``group_count`` goes up, its title becomes ``grouped_title`` with
+    ``{count}`` filled in and its message the latest one. Everyone else
+    gets a new notification. The unread counters only grow by the new ones.
+
+    Returns the new Notification instances and ``{recipient_id:
+    (notification_id, group_count)}`` for the updated ones.
+    """
+    window = timedelta(seconds=getattr(settings, 'NOTIFICATION_COALESCE_SECONDS', 60))
+    latest = {}
+    for recipient_id, notification_id in Notification.objects.filter(
+        recipient_id__in=recipient_ids,
+        notification_type=notification_type,
+        is_read=False,
+        created_at__gte=timezone.now() - window
+    ).order_by('recipient_id', '-created_at', '-id').values_list('recipient_id', 'id'):
+        latest.setdefault(recipient_id, notification_id)
+
+    grouped = {}
+    if latest:
+        prefix, _, suffix = grouped_title.partition('{count}')
+        Notification.objects.filter(id__in=latest.values()).update(
+            group_count=F('group_count') + 1,
+            title=Concat(
+                Value(prefix),
+                Cast(F('group_count') + 1, models.CharField()),
+                Value(suffix),
+                output_field=models.CharField()
+            ),
+            message=message
+        )
+        grouped = {
+            recipient_id: (notification_id, group_count)
+            for notification_id, recipient_id, group_count in Notification.objects.filter(
+                id__in=latest.values()
+            ).values_list('id', 'recipient_id', 'group_count')
+        }
+
+    created = create_notifications([
+        Notification(recipient_id=recipient_id, notification_type=notification_type, title=title, message=message)
+        for recipient_id in recipient_ids
+        if recipient_id not in latest
+    ])
+    return created, grouped
+
+
+def mark_read(user_id, ids=None, up_to_id=None, notification_type=None):
+    """
+    Mark a user's unread notifications read with a single UPDATE: those in
+    ``ids``, those with an id up to ``up_to_id`` and/or those of one type.
+    Returns how many changed.
+
+    The counter is decremented straight away rather than on commit, so the
+    caller can report the new count in the same request.
+    """
+    notifications = Notification.objects.filter(recipient_id=user_id, is_read=False)
+    if ids is not None:
+        notifications = notifications.filter(id__in=ids)
+    if up_to_id is not None:
+        notifications = notifications.filter(id__lte=up_to_id)
+    if notification_type is not None:
+        notifications = notifications.filter(notification_type=notification_type)
+    marked = notifications.update(is_read=True)
+    adjust_unread_counts({user_id: -marked}, on_commit=False)
+    return marked
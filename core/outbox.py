@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import metrics
+from .event_replay import sequence_events
+from .models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+def group_send_many(messages):
+    """
+    Send ``(group, message)`` pairs through the channel layer as one batch,
+    so a fan-out costs a single sync-to-async hop instead of one per group.
+    Groups are sent to concurrently, but the messages of one group one
+    after another, in order. Returns the exception raised for each message,
+    or None if it was sent.
+    """
+    if not messages:
+        return []
+
+    channel_layer = get_channel_layer()
+    by_group = {}
+    for index, (group, _) in enumerate(messages):
+        by_group.setdefault(group, []).append(index)
+    results = [None] * len(messages)
+
+    async def send_group(indices):
+        for index in indices:
+            group, message = messages[index]
+            try:
+                await channel_layer.group_send(group, message)
+            except Exception as e:
+                results[index] = e
+
+    async def send_all():
+        await asyncio.gather(*(send_group(indices) for indices in by_group.values()))
+
+    async_to_sync(send_all)()
+    return results
+
+
+def publish(messages):
+    """
+    Queue ``(group, message)`` pairs in the outbox. The rows are part of the
+    caller's transaction and are only handed to the dispatcher once it
+    commits, so a rolled back change never announces itself and slow
+    channel-layer sends never hold database locks.
+    """
+    if not messages:
+        return
+    OutboxMessage.objects.bulk_create([
+        OutboxMessage(group=group, payload=message) for group, message in messages
+    ])
+    metrics.counter('outbox.enqueued').inc(len(messages))
+    transaction.on_commit(dispatcher.wake)
+
+
+def publish_coalesced(messages, delay):
+    """
+    Queue ``(group, dedupe_key, message)`` triples for delivery ``delay``
+    seconds from now. While a message with the same key is still waiting
+    its payload is replaced instead, keeping its delivery time, so a burst
+    of updates reaches the client once, carrying the latest state.
+    """
+    if not messages:
+        return
+    pending = dict(
+        OutboxMessage.objects.filter(
+            status='pending',
+            dedupe_key__in=[dedupe_key for _, dedupe_key, _ in messages]
+        ).values_list('dedupe_key', 'id')
+    )
+
+    available_at = timezone.now() + timedelta(seconds=delay)
+    new, replaced = [], 0
+    for group, dedupe_key, message in messages:
+        # A message claimed by the dispatcher meanwhile is no longer pending
+        if dedupe_key in pending and OutboxMessage.objects.filter(
+            id=pending[dedupe_key], status='pending'
+        ).update(payload=message):
+            replaced += 1
+            continue
+        new.append(OutboxMessage(group=group, payload=message, dedupe_key=dedupe_key, available_at=available_at))
+
+    OutboxMessage.objects.bulk_create(new)
+    metrics.counter('outbox.enqueued').inc(len(new))
+    metrics.counter('outbox.coalesced').inc(replaced)
+    transaction.on_commit(dispatcher.wake)
+
+
+class OutboxDispatcher:
+    """
+    Delivers outbox messages in batches from a small worker pool.
+
+    Batches are claimed with a conditional UPDATE carrying a random claim
+    token, so several workers or processes (see the run_outbox_dispatcher
+    command) can drain the same table without delivering a message twice.
+    Failed sends are retried with exponential backoff up to
+    OUTBOX_MAX_ATTEMPTS, after which the message is left as 'failed'.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._running = 0
+        self._retry_timer = None
+
+    def wake(self):
+        workers = getattr(settings, 'OUTBOX_WORKERS', 2)
+        if workers <= 0:
+            # Inline delivery, used by tests and the dispatcher command
+            self.drain()
+            return
+
+        with self._lock:
+            if self._running >= workers:
+                return
+            self._running += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbox')
+        self._executor.submit(self._drain_in_worker)
+
+    def _drain_in_worker(self):
+        try:
+            self.drain()
+        except Exception:
+            logger.exception('Outbox drain failed')
+        finally:
+            with self._lock:
+                self._running -= 1
+
+        try:
+            # Also covers messages published while every worker was busy
+            self._schedule_retry()
+        except Exception:
+            logger.exception('Could not schedule outbox retry')
+        finally:
+            connections.close_all()
+
+    def drain(self):
+        """Deliver batches until nothing is left that is due"""
+        while self.deliver_batch():
+            pass
+        self.refresh_queue_depth()
+
+    def deliver_batch(self):
+        """Claim and deliver one batch; returns the number of messages claimed"""
+        now = timezone.now()
+        stale = now - timedelta(seconds=getattr(settings, 'OUTBOX_CLAIM_TIMEOUT_SECONDS', 60))
+        claimable = Q(status='pending', available_at__lte=now) | Q(status='sending', claimed_at__lt=stale)
+
+        ids = list(
+            OutboxMessage.objects.filter(claimable)
+            .order_by('id')
+            .values_list('id', flat=True)[:getattr(settings, 'OUTBOX_BATCH_SIZE', 100)]
+        )
+        if not ids:
+            return 0
+
+        token = uuid.uuid4()
+        OutboxMessage.objects.filter(claimable, id__in=ids).update(
+            status='sending', claim_token=token, claimed_at=now
+        )
+        messages = list(OutboxMessage.objects.filter(id__in=ids, claim_token=token))
+        if not messages:
+            return 0
+
+        # Numbered on the first attempt; retries keep the number
+        numbered = sequence_events([(message.group, message.payload) for message in messages])
+        for message, (_, payload) in zip(messages, numbered):
+            message.payload = payload
+        results = group_send_many([(message.group, message.payload) for message in messages])
+
+        delivered_at = timezone.now()
+        delivered, failed = [], []
+        for message, error in zip(messages, results):
+            if error is None:
+                delivered.append(message.id)
+                metrics.histogram('outbox.delivery_latency_ms').observe(
+                    (delivered_at - message.created_at).total_seconds() * 1000
+                )
+            else:
+                failed.append(self._reschedule(message, error, delivered_at))
+
+        OutboxMessage.objects.filter(id__in=delivered).delete()
+        if failed:
+            OutboxMessage.objects.bulk_update(
+                failed, ['payload', 'status', 'attempts', 'available_at', 'claim_token', 'claimed_at', 'last_error']
+            )
+        metrics.counter('outbox.delivered').inc(len(delivered))
+        return len(messages)
+
+    def _reschedule(self, message, error, now):
+        message.attempts += 1
+        message.claim_token = None
+        message.claimed_at = None
+        message.last_error = repr(error)
+        if message.attempts >= getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 5):
+            message.status = 'failed'
+            metrics.counter('outbox.failed').inc()
+            logger.error('Giving up on outbox message %s to %s: %r', message.id, message.group, error)
+        else:
+            message.status = 'pending'
+            backoff = getattr(settings, 'OUTBOX_RETRY_BACKOFF_SECONDS', 2) * 2 ** (message.attempts - 1)
+            message.available_at = now + timedelta(seconds=backoff)
+            metrics.counter('outbox.retried').inc()
+        return message
+
+    def _schedule_retry(self):
+        next_at = OutboxMessage.objects.filter(status='pending').order_by(
+            'available_at'
+        ).values_list('available_at', flat=True).first()
+        if next_at is None:
+            return
+
+        delay = max((next_at - timezone.now()).total_seconds(), 0)
+        with self._lock:
+            if self._retry_timer is not None and self._retry_timer.is_alive():
+                return
+            self._retry_timer = threading.Timer(delay, self.wake)
+            self._retry_timer.daemon = True
+            self._retry_timer.start()
+
+    def refresh_queue_depth(self):
+        depth = OutboxMessage.objects.filter(status__in=['pending', 'sending']).count()
+        metrics.gauge('outbox.queue_depth').set(depth)
+        return depth
+
+
+dispatcher = OutboxDispatcher()
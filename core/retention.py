@@ -0,0 +1,84 @@
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Notification
+from .notifications import adjust_unread_counts
+
+# Seconds each notification type is kept; types left out are kept forever
+DEFAULT_NOTIFICATION_RETENTION = {
+    'ride_request': 15 * 60,
+    'driver_arrived': 24 * 3600,
+    'ride_accepted': 7 * 24 * 3600,
+    'ride_completed': 90 * 24 * 3600,
+    'system': 30 * 24 * 3600,
+    'payment': 365 * 24 * 3600,
+}
+
+
+def notification_cutoffs(now=None):
+    """``{notification_type: cutoff}``: notifications created before their cutoff have expired"""
+    now = now or timezone.now()
+    retention = getattr(settings, 'NOTIFICATION_RETENTION', DEFAULT_NOTIFICATION_RETENTION)
+    return {
+        notification_type: now - timedelta(seconds=seconds)
+        for notification_type, seconds in retention.items()
+        if seconds is not None
+    }
+
+
+def count_expired_notifications(now=None):
+    return {
+        notification_type: Notification.objects.filter(
+            notification_type=notification_type,
+            created_at__lt=cutoff
+        ).count()
+        for notification_type, cutoff in notification_cutoffs(now).items()
+    }
+
+
+def purge_expired_notifications(now=None, batch_size=None, pause=0, progress=None):
+    """
+    Delete notifications older than their type's NOTIFICATION_RETENTION.
+
+    Rows are picked oldest first through the ``(notification_type,
+    created_at)`` index and deleted in batches of ``batch_size``, each in
+    its own short transaction, with ``pause`` seconds between batches to
+    leave room for live traffic. Unread counters drop by the unread rows
+    deleted. ``progress(notification_type, deleted)`` is called after each
+    batch with the running total for the type. Returns
+    ``{notification_type: deleted}``.
+    """
+    batch_size = batch_size or getattr(settings, 'NOTIFICATION_PURGE_BATCH_SIZE', 1000)
+    deleted = {}
+
+    for notification_type, cutoff in notification_cutoffs(now).items():
+        deleted[notification_type] = 0
+        while True:
+            rows = list(
+                Notification.objects.filter(
+                    notification_type=notification_type,
+                    created_at__lt=cutoff
+                ).order_by('created_at').values_list('id', 'recipient_id', 'is_read')[:batch_size]
+            )
+            if not rows:
+                break
+
+            with transaction.atomic():
+                Notification.objects.filter(id__in=[row[0] for row in rows]).delete()
+                unread = Counter(recipient_id for _, recipient_id, is_read in rows if not is_read)
+                adjust_unread_counts({recipient_id: -count for recipient_id, count in unread.items()})
+            deleted[notification_type] += len(rows)
+            if progress is not None:
+                progress(notification_type, deleted[notification_type])
+
+            if len(rows) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+
+    return deleted
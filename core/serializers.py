@@ -10,6 +10,17 @@ class NotificationSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = ('recipient', 'created_at')
 
+class MarkNotificationsReadSerializer(serializers.Serializer):
+    """Which notifications to mark read; the given criteria are combined"""
+    ids = serializers.ListField(child=serializers.IntegerField(), max_length=1000, required=False)
+    up_to_id = serializers.IntegerField(required=False)
+    type = serializers.ChoiceField(choices=Notification.NOTIFICATION_TYPES, required=False)
+
+    def validate(self, data):
+        if not data:
+            raise serializers.ValidationError('Give ids, up_to_id or type')
+        return data
+
 class LocationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Location
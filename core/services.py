@@ -1,106 +1,180 @@
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from drivers.models import Driver
+from drivers.spatial import find_nearest_available_drivers
 from rides.models import Ride, RideRequest
 from core.models import Notification
+from core.notifications import coalesce_notifications, create_notifications
+from core.outbox import publish, publish_coalesced
 import json
 
 User = get_user_model()
 
+# Ride statuses after which the participants leave the ride group
+FINISHED_RIDE_STATUSES = ('completed', 'cancelled', 'failed')
+
+def ride_group(ride_id):
+    """Channel group shared by the passenger and driver of a ride"""
+    return f"ride_{ride_id}"
+
 def notify_available_drivers(ride_request):
     """
-    Notify available drivers about a new ride request
+    Notify the nearest available drivers about a new ride request.
+
+    Only the RIDE_REQUEST_NOTIFY_LIMIT closest drivers within
+    RIDE_REQUEST_NOTIFY_RADIUS_KM of the pickup are notified, with one
+    bulk insert and one batched outbox write, so the cost of a request
+    does not grow with the fleet. During a burst of requests a driver's
+    unread notice is updated in place and pushed at most once per debounce
+    interval (see ``coalesce_notifications`` and ``publish_coalesced``).
     """
-    channel_layer = get_channel_layer()
-    
-    # Find nearby available drivers
-    available_drivers = Driver.objects.filter(
-        status='available',
-        is_active=True
+    nearest = find_nearest_available_drivers(
+        ride_request.pickup_lat,
+        ride_request.pickup_lng,
+        limit=getattr(settings, 'RIDE_REQUEST_NOTIFY_LIMIT', 10),
+        max_distance_km=getattr(settings, 'RIDE_REQUEST_NOTIFY_RADIUS_KM', 20),
     )
-    
-    for driver in available_drivers:
-        # Create notification for the driver
-        Notification.objects.create(
-            recipient=driver.user,
-            notification_type='ride_request',
-            title='New Ride Request',
-            message=f'A passenger needs a ride from {ride_request.pickup_address[:50]}...'
-        )
-        
-        # Send WebSocket notification
-        async_to_sync(channel_layer.group_send)(
-            f"driver_{driver.user.id}",
+    driver_users = dict(
+        Driver.objects.filter(
+            id__in=[driver_id for driver_id, _ in nearest],
+            status='available',
+            is_active=True
+        ).values_list('id', 'user_id')
+    )
+    user_ids = [driver_users[driver_id] for driver_id, _ in nearest if driver_id in driver_users]
+    if not user_ids:
+        return
+
+    created, grouped = coalesce_notifications(
+        user_ids,
+        'ride_request',
+        title='New Ride Request',
+        message=f'A passenger needs a ride from {ride_request.pickup_address[:50]}...',
+        grouped_title='{count} ride requests near you'
+    )
+
+    request_details = {
+        'ride_request_id': ride_request.id,
+        'pickup_address': ride_request.pickup_address,
+        'destination_address': ride_request.destination_address,
+    }
+    message = {
+        'type': 'notification_message',
+        'message': {'type': 'ride_request', **request_details}
+    }
+    publish([(f"driver_{notification.recipient_id}", message) for notification in created])
+
+    # Drivers already told about a request in this window get one summary
+    # per NOTIFICATION_PUSH_DEBOUNCE_SECONDS instead of a push per request
+    publish_coalesced([
+        (
+            f"driver_{user_id}",
+            f"ride_request_summary:{user_id}",
             {
                 'type': 'notification_message',
                 'message': {
-                    'type': 'ride_request',
-                    'ride_request_id': ride_request.id,
-                    'pickup_address': ride_request.pickup_address,
-                    'destination_address': ride_request.destination_address,
+                    'type': 'ride_request_summary',
+                    'notification_id': notification_id,
+                    'count': group_count,
+                    **request_details,
                 }
             }
         )
+        for user_id, (notification_id, group_count) in grouped.items()
+    ], getattr(settings, 'NOTIFICATION_PUSH_DEBOUNCE_SECONDS', 5))
 
 def notify_passenger_ride_accepted(ride):
     """
     Notify passenger that their ride has been accepted
     """
-    channel_layer = get_channel_layer()
-    
-    # Create notification for the passenger
-    Notification.objects.create(
-        recipient=ride.passenger,
-        notification_type='ride_accepted',
-        title='Ride Accepted',
-        message=f'Driver {ride.driver.user.get_full_name()} has accepted your ride request.'
-    )
-    
-    # Send WebSocket notification
-    async_to_sync(channel_layer.group_send)(
-        f"passenger_{ride.passenger.id}",
-        {
-            'type': 'notification_message',
-            'message': {
-                'type': 'ride_accepted',
-                'ride_id': ride.id,
-                'driver_name': ride.driver.user.get_full_name(),
-                'vehicle_info': f"{ride.driver.vehicle_make} {ride.driver.vehicle_model}",
+    notify_passengers_rides_accepted([ride])
+
+def notify_passengers_rides_accepted(rides):
+    """
+    Notify the passengers of several accepted rides with one bulk insert
+    and one outbox write. Delivery happens after the transaction commits.
+    """
+    create_notifications([
+        Notification(
+            recipient=ride.passenger,
+            notification_type='ride_accepted',
+            title='Ride Accepted',
+            message=f'Driver {ride.driver.user.get_full_name()} has accepted your ride request.'
+        )
+        for ride in rides
+    ])
+
+    messages = []
+    for ride in rides:
+        messages.append((
+            f"passenger_{ride.passenger.id}",
+            {
+                'type': 'notification_message',
+                'message': {
+                    'type': 'ride_accepted',
+                    'ride_id': ride.id,
+                    'driver_name': ride.driver.user.get_full_name(),
+                    'vehicle_info': f"{ride.driver.vehicle_make} {ride.driver.vehicle_model}",
+                }
             }
-        }
-    )
+        ))
+        # Both parties' open connections join the ride group
+        join = {'type': 'ride_join', 'ride_id': ride.id}
+        messages.append((f"passenger_{ride.passenger.id}", join))
+        messages.append((f"driver_{ride.driver.user.id}", join))
+    publish(messages)
+
+def notify_ride_ended(ride):
+    """
+    Tell the connections in the ride group that the ride is over, so they
+    leave the group. Delivered after the transaction commits.
+    """
+    publish([(ride_group(ride.id), {'type': 'ride_leave', 'ride_id': ride.id})])
 
-def broadcast_location_update(ride, latitude, longitude):
+def notify_passengers_requests_expired(ride_requests):
     """
-    Broadcast location update to both passenger and driver
+    Tell passengers that their ride requests expired without a driver, with
+    one bulk insert and one outbox write for the whole batch.
+    """
+    create_notifications([
+        Notification(
+            recipient_id=ride_request.passenger_id,
+            notification_type='system',
+            title='Ride Request Expired',
+            message='No driver was available for your ride request. Please try again.'
+        )
+        for ride_request in ride_requests
+    ])
+
+    publish([
+        (
+            f"passenger_{ride_request.passenger_id}",
+            {
+                'type': 'notification_message',
+                'message': {
+                    'type': 'ride_request_expired',
+                    'ride_request_id': ride_request.id,
+                }
+            }
+        )
+        for ride_request in ride_requests
+    ])
+
+def broadcast_location_update(ride, latitude, longitude, sender_channel=None):
+    """
+    Broadcast a location update to the ride group with a single send. The
+    connection named by ``sender_channel`` does not get its own update back.
     """
     channel_layer = get_channel_layer()
-    
-    # Send to passenger
     async_to_sync(channel_layer.group_send)(
-        f"passenger_{ride.passenger.id}",
+        ride_group(ride.id),
         {
-            'type': 'location_update',
-            'message': {
-                'type': 'driver_location',
-                'ride_id': ride.id,
-                'latitude': latitude,
-                'longitude': longitude,
-            }
+            'type': 'location_message',
+            'latitude': latitude,
+            'longitude': longitude,
+            'ride_id': ride.id,
+            'sender_channel': sender_channel,
         }
     )
-    
-    # Send to driver
-    async_to_sync(channel_layer.group_send)(
-        f"driver_{ride.driver.user.id}",
-        {
-            'type': 'location_update',
-            'message': {
-                'type': 'passenger_location',
-                'ride_id': ride.id,
-                'latitude': latitude,
-                'longitude': longitude,
-            }
-        }
-    )
\ No newline at end of file
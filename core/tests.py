@@ -1,3 +1,1038 @@
-from django.test import TestCase
+import asyncio
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from drivers.geo import haversine_km
+from drivers.positions import get_position_store
+from drivers.spatial import driver_index
+from drivers.tests import create_driver
+from rides.matching import build_ride
+from rides.models import Ride, RideRequest
+from . import metrics
+from .consumers import RideTrackingConsumer
+from .event_replay import sequence_events
+from .location_buffer import LocationBuffer, location_buffer
+from .location_filter import LocationFilter
+from .models import EventSequence, Location, Notification, OutboxMessage, TrackChunk, UserEvent
+from .notifications import create_notification, create_notifications, get_unread_count
+from .outbox import dispatcher, publish
+from .retention import purge_expired_notifications
+from .services import notify_available_drivers, notify_passenger_ride_accepted
+from .track_storage import MICRODEGREES, from_epoch_ms, pack_chunk, read_chunks, unpack_chunk
+from .trip_meter import TripMeter, aload_trip_meter, asave_trip_meter
+from .wire import LOCATION_SUBPROTOCOL, LocationDecoder, LocationEncoder, WireError
+from .trajectory import decode_deltas, decode_polyline, encode_deltas, encode_polyline, simplify_track
+
+User = get_user_model()
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def create_ride_request(passenger, lat='-25.000000', lng='28.000000'):
+    return RideRequest.objects.create(
+        passenger=passenger,
+        pickup_address='Farm road',
+        pickup_lat=lat,
+        pickup_lng=lng,
+        destination_address='Town clinic',
+        destination_lat='-25.100000',
+        destination_lng='28.100000',
+        expires_at=timezone.now() + timedelta(minutes=10)
+    )
+
+
+class ChannelLayerTestMixin:
+    def listen(self, group):
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(group, channel_name)
+        return channel_name
+
+    def receive(self, channel_name):
+        """Next event on the channel, or None if nothing arrives"""
+        async def receive_or_timeout():
+            try:
+                return await asyncio.wait_for(get_channel_layer().receive(channel_name), 0.1)
+            except asyncio.TimeoutError:
+                return None
+
+        return async_to_sync(receive_or_timeout)()
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    OUTBOX_WORKERS=0,
+    RIDE_REQUEST_NOTIFY_LIMIT=2,
+    RIDE_REQUEST_NOTIFY_RADIUS_KM=20
+)
+class NotifyAvailableDriversTestCase(ChannelLayerTestMixin, TestCase):
+    def setUp(self):
+        driver_index.clear()
+        self.passenger = User.objects.create_user(
+            email='passenger@example.com',
+            username='passenger@example.com',
+            password='testpassword123'
+        )
+
+    def test_only_nearest_drivers_in_radius_are_notified(self):
+        nearest = create_driver(1, lat='-25.010000', lng='28.000000')
+        second = create_driver(2, lat='-25.020000', lng='28.000000')
+        third = create_driver(3, lat='-25.030000', lng='28.000000')
+        remote = create_driver(4, lat='-26.000000', lng='28.000000')
+        channels = {
+            driver: self.listen(f'driver_{driver.user_id}')
+            for driver in (nearest, second, third, remote)
+        }
+        ride_request = create_ride_request(self.passenger)
+
+        # Index load, driver confirmation, coalescing lookup, notification and outbox inserts
+        with self.captureOnCommitCallbacks() as callbacks, self.assertNumQueries(5):
+            notify_available_drivers(ride_request)
+        for callback in callbacks:
+            callback()
+
+        self.assertEqual(
+            set(Notification.objects.values_list('recipient_id', flat=True)),
+            {nearest.user_id, second.user_id}
+        )
+        for driver in (nearest, second):
+            event = self.receive(channels[driver])
+            self.assertEqual(event['type'], 'notification_message')
+            self.assertEqual(event['message']['ride_request_id'], ride_request.id)
+        self.assertIsNone(self.receive(channels[third]))
+        self.assertIsNone(self.receive(channels[remote]))
+
+    def test_burst_is_coalesced_per_driver(self):
+        cache.clear()
+        driver = create_driver(1, lat='-25.010000', lng='28.000000')
+        channel_name = self.listen(f'driver_{driver.user_id}')
+        with self.captureOnCommitCallbacks(execute=True):
+            notify_available_drivers(create_ride_request(self.passenger))
+        self.assertEqual(self.receive(channel_name)['message']['type'], 'ride_request')
+        self.assertEqual(get_unread_count(driver.user_id), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            notify_available_drivers(create_ride_request(self.passenger))
+            latest = create_ride_request(self.passenger)
+            notify_available_drivers(latest)
+
+        notification = Notification.objects.get()
+        self.assertEqual(notification.group_count, 3)
+        self.assertEqual(notification.title, '3 ride requests near you')
+        self.assertEqual(get_unread_count(driver.user_id), 1)
+        # The summary waits out the debounce interval, as one message
+        self.assertIsNone(self.receive(channel_name))
+        outbox = OutboxMessage.objects.get()
+        self.assertEqual((outbox.payload['message']['count'], outbox.payload['message']['ride_request_id']), (3, latest.id))
+
+        OutboxMessage.objects.update(available_at=timezone.now())
+        dispatcher.drain()
+        event = self.receive(channel_name)
+        self.assertEqual(event['message']['type'], 'ride_request_summary')
+        self.assertEqual(event['message']['notification_id'], notification.id)
+        self.assertIsNone(self.receive(channel_name))
+
+        # Once read, the next request starts a fresh notification
+        Notification.objects.update(is_read=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            notify_available_drivers(create_ride_request(self.passenger))
+        self.assertEqual(Notification.objects.filter(is_read=False, group_count=1).count(), 1)
+        self.assertEqual(self.receive(channel_name)['message']['type'], 'ride_request')
+
+    def test_no_drivers_in_radius(self):
+        create_driver(1, lat='-26.000000', lng='28.000000')
+
+        notify_available_drivers(create_ride_request(self.passenger))
+
+        self.assertFalse(Notification.objects.exists())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, OUTBOX_WORKERS=0, OUTBOX_MAX_ATTEMPTS=2)
+class OutboxTestCase(ChannelLayerTestMixin, TestCase):
+    def test_delivered_after_commit_and_removed(self):
+        channel_name = self.listen('passenger_1')
+        delivered_before = metrics.histogram('outbox.delivery_latency_ms').count
+
+        with self.captureOnCommitCallbacks(execute=True):
+            publish([('passenger_1', {'type': 'notification_message', 'message': {'type': 'system'}})])
+            self.assertIsNone(self.receive(channel_name))
+
+        self.assertEqual(self.receive(channel_name)['message'], {'type': 'system'})
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertEqual(metrics.histogram('outbox.delivery_latency_ms').count, delivered_before + 1)
+        self.assertEqual(metrics.gauge('outbox.queue_depth').value, 0)
+
+    def test_rolled_back_messages_are_never_sent(self):
+        channel_name = self.listen('passenger_1')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                publish([('passenger_1', {'type': 'notification_message', 'message': {}})])
+                raise RuntimeError
+
+        self.assertIsNone(self.receive(channel_name))
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_failed_sends_are_retried_then_given_up(self):
+        cache.clear()
+        with mock.patch('core.outbox.group_send_many', return_value=[ConnectionError('down')]):
+            with self.captureOnCommitCallbacks(execute=True):
+                publish([('passenger_1', {'type': 'notification_message', 'message': {}})])
+
+            message = OutboxMessage.objects.get()
+            self.assertEqual((message.status, message.attempts), ('pending', 1))
+            self.assertEqual(message.payload['seq'], 1)
+            self.assertGreater(message.available_at, timezone.now())
+
+            OutboxMessage.objects.update(available_at=timezone.now())
+            with self.assertLogs('core.outbox', 'ERROR'):
+                dispatcher.drain()
+
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.status, message.attempts), ('failed', 2))
+        # The retry kept the event's number
+        self.assertEqual(message.payload['seq'], 1)
+        self.assertIn('down', message.last_error)
+
+
+def full_table_scans(sql, params=None):
+    """Tables the database would read in full to run ``sql``"""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            # A bare "SCAN <table>" (no index) is a full table scan
+            pattern = re.compile(r'^SCAN (?:TABLE )?(\w+)$')
+            plan = [row[-1] for row in cursor.fetchall()]
+        elif connection.vendor == 'postgresql':
+            # Tiny test tables would always be sequentially scanned otherwise
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            pattern = re.compile(r'Seq Scan on (\w+)')
+            plan = [row[0] for row in cursor.fetchall()]
+        else:
+            return []
+    return [match.group(1) for match in (pattern.search(line.strip()) for line in plan) if match]
+
+
+class QueryPlanTestCase(TestCase):
+    """Every query issued by the hot read paths must be served by an index"""
+
+    def setUp(self):
+        driver_index.clear()
+        cache.clear()
+        self.passenger = User.objects.create_user(
+            email='passenger@example.com',
+            username='passenger@example.com',
+            password='testpassword123',
+            first_name='Pat',
+            last_name='Passenger',
+            user_type='passenger'
+        )
+        self.driver = create_driver(1, '-25.000000', '28.000000')
+        ride_request = create_ride_request(self.passenger)
+        self.ride = build_ride(ride_request, self.driver)
+        self.ride.save()
+        Location.objects.create(user=self.passenger, ride=self.ride, latitude='-25.0', longitude='28.0')
+        Notification.objects.create(
+            recipient=self.passenger,
+            title='Ride accepted',
+            message='On the way',
+            notification_type='ride_accepted'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.passenger)
+
+    def assertNoFullScans(self, queries):
+        for query in queries:
+            sql = query['sql']
+            if not sql.lstrip().upper().startswith('SELECT'):
+                continue
+            self.assertEqual(full_table_scans(sql), [], sql)
+
+    def assertViewUsesIndexes(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(context.captured_queries)
+        self.assertNoFullScans(context.captured_queries)
+
+    def test_ride_views(self):
+        self.assertViewUsesIndexes('/api/rides/current/')
+        self.assertViewUsesIndexes('/api/rides/history/')
+        self.assertViewUsesIndexes(f'/api/rides/{self.ride.id}/')
+
+    def test_driver_views(self):
+        self.assertViewUsesIndexes('/api/drivers/available/')
+        with override_settings(DRIVER_SPATIAL_INDEX_ENABLED=False):
+            self.assertViewUsesIndexes('/api/drivers/nearby/?lat=-25.0&lng=28.0')
+
+    def test_notification_list(self):
+        self.assertViewUsesIndexes('/api/core/notifications/')
+        Notification.objects.create(
+            recipient=self.passenger,
+            title='Ride completed',
+            message='Thanks',
+            notification_type='ride_completed'
+        )
+        next_page = self.client.get('/api/core/notifications/?page_size=1').data['next']
+        self.assertViewUsesIndexes(next_page)
+        self.assertViewUsesIndexes('/api/core/notifications/unread-count/')
+
+    def test_ride_track_and_driver_rides(self):
+        querysets = [
+            Location.objects.filter(ride=self.ride).order_by('timestamp'),
+            Ride.objects.filter(driver=self.driver, status__in=['accepted', 'picked_up', 'in_transit']),
+        ]
+        for queryset in querysets:
+            sql, params = queryset.query.sql_with_params()
+            self.assertEqual(full_table_scans(sql, params), [], sql)
+
+
+class NotificationInboxTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='driver@example.com',
+            username='driver@example.com',
+            password='testpassword123',
+            user_type='driver'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def notify(self, count, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            return create_notifications([
+                Notification(recipient=self.user, notification_type='ride_request', title=f'Request {n}',
+                             message='Near you', **fields)
+                for n in range(count)
+            ])
+
+    def test_keyset_pages_do_not_shift_or_repeat(self):
+        created = self.notify(25)
+        # Same instant for all, so only the id orders them
+        Notification.objects.update(created_at=timezone.now())
+
+        seen = []
+        response = self.client.get('/api/core/notifications/?page_size=10')
+        while True:
+            seen += [item['id'] for item in response.data['results']]
+            if len(seen) == 10:
+                self.notify(1)  # arrives while the user is scrolling
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(seen, sorted((notification.id for notification in created), reverse=True))
+
+        self.assertEqual(self.client.get('/api/core/notifications/?cursor=bogus').status_code, 404)
+
+    def test_unread_count_is_a_cached_counter(self):
+        self.notify(3)
+        self.notify(1, is_read=True)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/api/core/notifications/unread-count/').data['unread_count'], 3)
+
+        notification = self.notify(2)[0]
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/core/notifications/unread-count/').data['unread_count'], 5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/core/notifications/{notification.id}/read/')
+            self.client.patch(f'/api/core/notifications/{notification.id}/read/')
+        self.assertEqual(self.client.get('/api/core/notifications/unread-count/').data['unread_count'], 4)
+
+        # A counter that was never seeded is not created by updates
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            create_notification(recipient=self.user, notification_type='system', title='Hi', message='Hello')
+        self.assertEqual(self.client.get('/api/core/notifications/unread-count/').data['unread_count'], 5)
+
+
+    def test_bulk_mark_read(self):
+        requests = self.notify(4)
+        create_notification(recipient=self.user, notification_type='system', title='Hi', message='Hello')
+        other = User.objects.create_user(email='other@example.com', username='other@example.com', password='x')
+        foreign = create_notification(recipient=other, notification_type='ride_request', title='No', message='No')
+        self.assertEqual(self.client.get('/api/core/notifications/unread-count/').data['unread_count'], 5)
+
+        def mark(data):
+            with self.captureOnCommitCallbacks(execute=True):
+                return self.client.post('/api/core/notifications/read/', data, format='json')
+
+        # Someone else's notification is never touched
+        with self.assertNumQueries(1):
+            response = mark({'ids': [requests[0].id, foreign.id]})
+        self.assertEqual(response.data, {'marked': 1, 'unread_count': 4})
+        self.assertEqual(mark({'up_to_id': requests[2].id}).data, {'marked': 2, 'unread_count': 2})
+        self.assertEqual(mark({'type': 'system'}).data, {'marked': 1, 'unread_count': 1})
+        self.assertEqual(mark({}).status_code, 400)
+        self.assertEqual(mark({'type': 'bogus'}).status_code, 400)
+
+        self.assertEqual(
+            set(Notification.objects.filter(is_read=False).values_list('id', flat=True)),
+            {requests[3].id, foreign.id}
+        )
+
+
+@override_settings(NOTIFICATION_RETENTION={'ride_request': 600, 'payment': 30 * 24 * 3600, 'system': None})
+class NotificationRetentionTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='driver@example.com',
+            username='driver@example.com',
+            password='testpassword123',
+            user_type='driver'
+        )
+        now = timezone.now()
+        for notification_type, age, is_read, count in (
+            ('ride_request', timedelta(hours=1), False, 4),
+            ('ride_request', timedelta(hours=1), True, 1),
+            ('ride_request', timedelta(minutes=1), False, 1),
+            ('payment', timedelta(days=7), False, 1),
+            ('system', timedelta(days=400), False, 1),
+        ):
+            for notification in create_notifications([
+                Notification(recipient=self.user, notification_type=notification_type,
+                             title='Old', message='Old', is_read=is_read)
+                for _ in range(count)
+            ]):
+                Notification.objects.filter(id=notification.id).update(created_at=now - age)
+
+    def test_expired_types_are_purged_in_batches(self):
+        self.assertEqual(get_unread_count(self.user.id), 7)
+        batches = []
+
+        with self.captureOnCommitCallbacks(execute=True):
+            deleted = purge_expired_notifications(batch_size=2, progress=lambda *args: batches.append(args))
+
+        self.assertEqual(deleted, {'ride_request': 5, 'payment': 0})
+        self.assertEqual(batches, [('ride_request', 2), ('ride_request', 4), ('ride_request', 5)])
+        self.assertEqual(
+            sorted(Notification.objects.values_list('notification_type', flat=True)),
+            ['payment', 'ride_request', 'system']
+        )
+        self.assertEqual(get_unread_count(self.user.id), 3)
+
+        queryset = Notification.objects.filter(notification_type='ride_request', created_at__lt=timezone.now())
+        sql, params = queryset.order_by('created_at').values_list('id').query.sql_with_params()
+        self.assertEqual(full_table_scans(sql, params), [], sql)
+
+    def test_command_reports_progress(self):
+        out = StringIO()
+        call_command('purge_notifications', '--dry-run', stdout=out)
+        self.assertIn('ride_request: 5 expired', out.getvalue())
+
+        out = StringIO()
+        call_command('purge_notifications', '--batch-size', '3', '--verbosity', '2', stdout=out)
+        self.assertIn('ride_request: 3 deleted so far', out.getvalue())
+        self.assertIn('Deleted 5 notification(s)', out.getvalue())
+
+@override_settings(LOCATION_BUFFER_MAX_SIZE=1000, LOCATION_BUFFER_FLUSH_SECONDS=3600)
+class LocationBufferTestCase(TestCase):
+    def setUp(self):
+        driver_index.clear()
+        get_position_store().clear()
+        self.addCleanup(get_position_store().clear)
+        self.passenger = User.objects.create_user(
+            email='passenger@example.com',
+            username='passenger@example.com',
+            password='testpassword123',
+            user_type='passenger'
+        )
+        self.driver = create_driver(1, '-25.000000', '28.000000')
+        driver_index.upsert(self.driver.id, self.driver.location_lat, self.driver.location_lng)
+        self.ride = build_ride(create_ride_request(self.passenger), self.driver)
+        self.ride.save()
+        self.buffer = LocationBuffer()
+
+    def test_flush_writes_points_in_bulk(self):
+        received_at = timezone.now().replace(microsecond=0) - timedelta(seconds=30)
+        for step in range(5):
+            self.assertTrue(self.buffer.add(
+                -25 + step / 1000, 28, self.ride.id,
+                driver_id=self.driver.id,
+                timestamp=received_at + timedelta(seconds=step)
+            ))
+        self.buffer.add('-25.1', '28.1', self.ride.id, user_id=self.passenger.id)
+        self.buffer.add('-25.1', '28.1', self.ride.id + 100, user_id=self.passenger.id)
+        self.assertFalse(self.buffer.add(None, '28.1', self.ride.id))
+        self.assertFalse(self.buffer.add('-95', '28.1', self.ride.id))
+        self.assertEqual(TrackChunk.objects.count(), 0)
+
+        # Ride lookup, one insert and one driver update in a savepoint, then the merge check
+        with self.assertNumQueries(6):
+            self.assertEqual(self.buffer.flush(), 6)
+        self.assertEqual(len(self.buffer), 0)
+
+        # One chunk per ride participant
+        chunk = TrackChunk.objects.get(driver=self.driver)
+        self.assertEqual(TrackChunk.objects.filter(user=self.passenger).get().point_count, 1)
+        lat, lng, ts = unpack_chunk(chunk.data)
+        self.assertEqual(lat.tolist(), [-25000000, -24999000, -24998000, -24997000, -24996000])
+        self.assertEqual(
+            [from_epoch_ms(ms) for ms in ts],
+            [received_at + timedelta(seconds=step) for step in range(5)]
+        )
+        self.driver.refresh_from_db()
+        self.assertEqual(str(self.driver.location_lat), '-24.996000')
+        self.assertEqual(self.driver.last_location_update, received_at + timedelta(seconds=4))
+        self.assertEqual(driver_index.nearest(-24.996, 28)[0][0], self.driver.id)
+
+    @override_settings(TRACK_CHUNK_MAX_POINTS=4, TRACK_CHUNK_MAX_OPEN=2)
+    def test_flushes_are_sealed_then_merged(self):
+        started = timezone.now().replace(microsecond=0) - timedelta(minutes=5)
+        for step in (2, 0):
+            self.buffer.add(-25 + step / 1000, 28, self.ride.id, driver_id=self.driver.id,
+                            timestamp=started + timedelta(seconds=step))
+            self.buffer.flush()
+        # Each flush is a row of its own
+        self.assertEqual(TrackChunk.objects.count(), 2)
+
+        # One small chunk over the limit merges them, in time order
+        self.buffer.add(-24.999, 28, self.ride.id, driver_id=self.driver.id, timestamp=started + timedelta(seconds=1))
+        self.buffer.flush()
+        chunk = TrackChunk.objects.get()
+        self.assertEqual(chunk.point_count, 3)
+        self.assertEqual((chunk.first_timestamp, chunk.last_timestamp), (started, started + timedelta(seconds=2)))
+        lat, _, ts = unpack_chunk(bytes(chunk.data))
+        self.assertEqual(lat.tolist(), [-25000000, -24999000, -24998000])
+        self.assertEqual(ts.tolist(), sorted(ts.tolist()))
+
+        # Merged chunks are split at the size limit and full ones are left alone
+        for step in (3, 4, 5, 6, 7):
+            self.buffer.add(-25, 28, self.ride.id, driver_id=self.driver.id, timestamp=started + timedelta(seconds=step))
+            self.buffer.flush()
+        self.assertEqual(list(TrackChunk.objects.order_by('first_timestamp').values_list('point_count', flat=True)),
+                         [4, 3, 1])
+        full = TrackChunk.objects.order_by('first_timestamp').first()
+        self.buffer.add(-25, 28, self.ride.id, driver_id=self.driver.id, timestamp=started + timedelta(seconds=8))
+        self.buffer.flush()
+        self.assertEqual(list(TrackChunk.objects.order_by('first_timestamp').values_list('point_count', flat=True)),
+                         [4, 4, 1])
+        self.assertTrue(TrackChunk.objects.filter(id=full.id).exists())
+
+    def test_failed_flush_keeps_points(self):
+        self.buffer.add('-25.0', '28.0', self.ride.id, driver_id=self.driver.id)
+        with mock.patch.object(TrackChunk.objects, 'bulk_create', side_effect=RuntimeError('db down')):
+            with self.assertRaises(RuntimeError):
+                self.buffer.flush()
+        self.assertEqual(len(self.buffer), 1)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(TrackChunk.objects.get().point_count, 1)
+
+
+@override_settings(LOCATION_FILTER={
+    'driver': {'MIN_DISTANCE_M': 10, 'MIN_INTERVAL_SECONDS': 2, 'MAX_INTERVAL_SECONDS': 30},
+})
+class LocationFilterTestCase(TestCase):
+    def test_dead_band_rate_limit_and_heartbeat(self):
+        location_filter = LocationFilter.for_user_type('driver')
+        kept = metrics.counter('location_filter.kept.driver')
+        dropped = metrics.counter('location_filter.dropped.driver')
+        kept_before, dropped_before = kept.value, dropped.value
+
+        self.assertTrue(location_filter.accept('-25.0', '28.0', 1, now=0))
+        # Moved ~110 m but too soon
+        self.assertFalse(location_filter.accept('-25.001', '28.0', 1, now=1))
+        # ~5 m from the last kept point
+        self.assertFalse(location_filter.accept('-25.00005', '28.0', 1, now=5))
+        self.assertTrue(location_filter.accept('-25.001', '28.0', 1, now=6))
+        # Parked, but the heartbeat is due
+        self.assertTrue(location_filter.accept('-25.001', '28.0', 1, now=36))
+        # A new ride always starts a new track
+        self.assertTrue(location_filter.accept('-25.001', '28.0', 2, now=37))
+        self.assertFalse(location_filter.accept(None, '28.0', 2, now=60))
+
+        self.assertEqual(kept.value - kept_before, 4)
+        self.assertEqual(dropped.value - dropped_before, 3)
+
+    def test_unconfigured_user_type_keeps_everything(self):
+        location_filter = LocationFilter.for_user_type('admin')
+        self.assertTrue(location_filter.accept('-25.0', '28.0', 1, now=0))
+        self.assertTrue(location_filter.accept('-25.0', '28.0', 1, now=0))
+
+
+class TrajectoryTestCase(TestCase):
+    def test_polyline_round_trip(self):
+        coordinates = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+        # Reference example from the encoded polyline format documentation
+        self.assertEqual(encode_polyline(coordinates), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+        self.assertEqual(decode_polyline('_p~iF~ps|U_ulLnnqC_mqNvxq`@'), coordinates)
+        self.assertEqual(decode_deltas(encode_deltas([0, 5, 5, 3600, 3599])), [0, 5, 5, 3600, 3599])
+
+    def test_simplify_within_tolerance(self):
+        # ~1.1 km due north with ~1 m of jitter, then a right-angle turn east
+        north = [(-25 + i / 10000, 28 + (i % 2) / 100000, i) for i in range(100)]
+        east = [(-25 + 99 / 10000, 28 + i / 10000, 100 + i) for i in range(1, 50)]
+        kept = simplify_track(north + east, tolerance_m=5)
+        self.assertEqual([point[2] for point in kept], [0, 99, 149])
+
+        # An out-and-back leg is not collapsed onto the straight segment
+        out_and_back = [(-25, 28, 0), (-25, 28.01, 1), (-25, 28.005, 2)]
+        self.assertEqual(len(simplify_track(out_and_back, tolerance_m=5)), 3)
+
+
+class TrackStorageTestCase(TestCase):
+    def test_chunks_round_trip_in_time_order(self):
+        start = timezone.now().replace(microsecond=0)
+        later = pack_chunk([-25.5, -25.4], [28.5, 28.4], [start + timedelta(seconds=70), start + timedelta(seconds=60)])
+        earlier = pack_chunk(['-25.000001'], ['179.999999'], [start])
+
+        # Header plus three 4 byte columns per point
+        self.assertEqual(len(later), 16 + 2 * 12)
+        lat, lng, ts = read_chunks([memoryview(later), earlier])
+        self.assertEqual(lat.tolist(), [-25000001, -25400000, -25500000])
+        self.assertEqual(lng.tolist(), [179999999, 28400000, 28500000])
+        self.assertEqual(
+            [from_epoch_ms(ms) for ms in ts],
+            [start, start + timedelta(seconds=60), start + timedelta(seconds=70)]
+        )
+        self.assertEqual(len(read_chunks([])[0]), 0)
+
+
+@override_settings(TRIP_METER_SPEED_ALPHA=0.5, TRIP_METER_MAX_SPEED_KMH=160, TRIP_METER_ROUTE_FACTOR=1)
+class TripMeterTestCase(TestCase):
+    def test_distance_only_on_board_and_jumps_ignored(self):
+        meter = TripMeter()
+        step = 0.001  # about 111 m
+        # Approach at 40 km/h: speed is learned but no distance counted
+        for i in range(3):
+            self.assertTrue(meter.add(-25 + i * step, 28, i * 10, onboard=False))
+        self.assertEqual(meter.distance_km, 0)
+        self.assertAlmostEqual(meter.speed_kmh, 40, delta=0.1)
+
+        for i in range(3, 6):
+            meter.add(-25 + i * step, 28, i * 10)
+        self.assertAlmostEqual(meter.distance_km, 2 * 0.1112, places=3)
+        # A point 50 km away ten seconds later is a GPS jump
+        self.assertFalse(meter.add(-24.5, 28, 60))
+        self.assertAlmostEqual(meter.distance_km, 2 * 0.1112, places=3)
+
+        # Half the weight goes to a step at 20 km/h
+        meter.add(-25 + 5.5 * step, 28, 60)
+        self.assertAlmostEqual(meter.speed_kmh, 30, delta=0.1)
+        self.assertAlmostEqual(meter.eta_seconds(-25 + 5.5 * step + 0.01, 28), 133, delta=1)
+        self.assertEqual(TripMeter.from_dict(meter.to_dict()).to_dict(), meter.to_dict())
+
+    @override_settings(TRIP_METER_GAP_SECONDS=60)
+    def test_uploaded_points_reroute_the_live_gap(self):
+        meter = TripMeter()
+        step = 0.001
+        meter.add(-25, 28, 1000)
+        meter.add(-25 - step, 28, 1010)
+        # The socket drops; the next live point comes 90 s later, 3 steps south
+        meter.add(-25 - 4 * step, 28, 1100)
+        meter.add(-25 - 5 * step, 28, 1110)
+        self.assertAlmostEqual(meter.distance_km, 5 * 0.1112, places=3)
+
+        # Meanwhile the device recorded a detour 100 m east, on a clock 30 s behind
+        self.assertEqual(meter.add_uploaded([(-25 - 2 * step, 28.001, 1010), (-25 - 3 * step, 28.001, 1040)]), 2)
+        detour = haversine_km(-25.001, 28, -25.002, 28.001) + 0.1112 + haversine_km(-25.003, 28.001, -25.004, 28)
+        self.assertAlmostEqual(meter.distance_km, 2 * 0.1112 + detour, places=3)
+
+        # A later batch from the same gap carries on from the last one
+        self.assertEqual(meter.add_uploaded([(-25.0035, 28.001, 1055)]), 1)
+        detour += haversine_km(-25.003, 28.001, -25.0035, 28.001) + haversine_km(-25.0035, 28.001, -25.004, 28)
+        detour -= haversine_km(-25.003, 28.001, -25.004, 28)
+        self.assertAlmostEqual(meter.distance_km, 2 * 0.1112 + detour, places=3)
+
+        # Live points carry on from the live stream
+        self.assertEqual(meter.last[2], 1110)
+        meter.add(-25 - 6 * step, 28, 1120)
+        self.assertAlmostEqual(meter.distance_km, 3 * 0.1112 + detour, places=3)
+        self.assertEqual(TripMeter.from_dict(meter.to_dict()).to_dict(), meter.to_dict())
+
+    def test_no_eta_without_speed(self):
+        meter = TripMeter()
+        meter.add(-25, 28, 0)
+        self.assertIsNone(meter.eta_seconds(-25.1, 28))
+
+
+class WireTestCase(TestCase):
+    def test_keyframes_then_deltas_round_trip(self):
+        encoder, decoder = LocationEncoder(), LocationDecoder()
+        track = [(7, -25.123456, 28.654321), (7, -25.1236, 28.6545), (7, -25.2, 28.7), (8, -25.2, 28.7)]
+        frames = [encoder.encode(*point) for point in track]
+        # New ride and a jump of several kilometres both need a keyframe
+        self.assertEqual([len(frame) for frame in frames], [13, 5, 13, 13])
+        for frame, (ride_id, lat, lng) in zip(frames, track):
+            decoded = decoder.decode(frame)
+            self.assertEqual(decoded[::3], (ride_id, None))
+            self.assertAlmostEqual(decoded[1], lat, delta=1 / MICRODEGREES)
+            self.assertAlmostEqual(decoded[2], lng, delta=1 / MICRODEGREES)
+
+    def test_eta_rides_along(self):
+        encoder, decoder = LocationEncoder(), LocationDecoder()
+        self.assertEqual(decoder.decode(encoder.encode(7, -25, 28, 300))[3], 300)
+        frame = encoder.encode(7, -25.001, 28, 10 ** 6)
+        self.assertEqual(len(frame), 7)
+        self.assertEqual(decoder.decode(frame)[3], 65535)
+
+    def test_malformed_frames(self):
+        frame = LocationEncoder().encode(7, -25, 28)
+        for data in (b'', frame[:5], b'\x09' + frame[1:]):
+            with self.assertRaises(WireError):
+                LocationDecoder().decode(data)
+        # A delta needs a keyframe before it
+        with self.assertRaises(WireError):
+            LocationDecoder().decode(b'\x02\x00\x00\x00\x00')
+        with self.assertRaises(WireError):
+            LocationEncoder().encode(7, 'nan', 28)
+
+
+class ConsumerTestMixin:
+    async def connect(self, user, subprotocols=(), query_string=b''):
+        communicator = ApplicationCommunicator(RideTrackingConsumer.as_asgi(), {
+            'type': 'websocket',
+            'path': '/ws/ride-tracking/',
+            'query_string': query_string,
+            'headers': [],
+            'subprotocols': list(subprotocols),
+            'user': user,
+        })
+        await communicator.send_input({'type': 'websocket.connect'})
+        accepted = await communicator.receive_output(1)
+        self.assertEqual(accepted['type'], 'websocket.accept')
+        communicator.subprotocol = accepted.get('subprotocol')
+        return communicator
+
+    async def send_json(self, communicator, data):
+        await communicator.send_input({'type': 'websocket.receive', 'text': json.dumps(data)})
+
+    async def receive_json(self, communicator):
+        return json.loads((await communicator.receive_output(1))['text'])
+
+    async def disconnect(self, communicator):
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(1)
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    LOCATION_FILTER={},
+    LOCATION_BUFFER_MAX_SIZE=1000,
+    LOCATION_BUFFER_FLUSH_SECONDS=3600
+)
+class RideContextTestCase(ConsumerTestMixin, TestCase):
+    def setUp(self):
+        driver_index.clear()
+        self.passenger = User.objects.create_user(
+            email='passenger@example.com',
+            username='passenger@example.com',
+            password='testpassword123',
+            user_type='passenger'
+        )
+        self.driver = create_driver(1, '-25.000000', '28.000000')
+        self.ride = build_ride(create_ride_request(self.passenger), self.driver)
+        self.ride.save()
+        other = User.objects.create_user(
+            email='other@example.com',
+            username='other@example.com',
+            password='testpassword123',
+            user_type='passenger'
+        )
+        self.other_ride = build_ride(create_ride_request(other), create_driver(2, '-25.1', '28.1'))
+        self.other_ride.save()
+        self.addCleanup(location_buffer.flush)
+        connection.force_debug_cursor = True
+        self.addCleanup(setattr, connection, 'force_debug_cursor', False)
+
+    @sync_to_async
+    def query_count(self):
+        return len(connection.queries_log)
+
+    def frame(self, ride_id, step=0):
+        return {'type': 'location_update', 'latitude': -25 + step / 1000, 'longitude': 28, 'ride_id': ride_id}
+
+    async def test_context_is_cached_and_strangers_rejected(self):
+        communicator = await self.connect(self.passenger)
+        queued = len(location_buffer)
+
+        queries = await self.query_count()
+        for step in range(3):
+            await self.send_json(communicator, self.frame(self.ride.id, step))
+        # Frames are not echoed back to the sender
+        self.assertTrue(await communicator.receive_nothing(0.1))
+        # One ride lookup for three frames
+        self.assertEqual(await self.query_count() - queries, 1)
+        self.assertEqual(len(location_buffer), queued + 3)
+
+        queries = await self.query_count()
+        for _ in range(2):
+            await self.send_json(communicator, self.frame(self.other_ride.id))
+            error = await self.receive_json(communicator)
+            self.assertEqual(error['type'], 'error')
+        self.assertEqual(await self.query_count() - queries, 1)
+        self.assertEqual(len(location_buffer), queued + 3)
+
+        await self.send_json(communicator, {'type': 'ride_status_update', 'ride_id': self.other_ride.id, 'status': 'cancelled'})
+        self.assertEqual((await self.receive_json(communicator))['type'], 'error')
+        await self.send_json(communicator, {'type': 'ride_status_update', 'ride_id': self.ride.id, 'status': 'bogus'})
+        self.assertEqual((await self.receive_json(communicator))['type'], 'error')
+        await self.disconnect(communicator)
+
+        statuses = await sync_to_async(lambda: set(Ride.objects.values_list('status', flat=True)))()
+        self.assertEqual(statuses, {'accepted'})
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    OUTBOX_WORKERS=0,
+    LOCATION_FILTER={},
+    LOCATION_BUFFER_MAX_SIZE=1000,
+    LOCATION_BUFFER_FLUSH_SECONDS=3600
+)
+class RideGroupTestCase(ConsumerTestMixin, TestCase):
+    def setUp(self):
+        driver_index.clear()
+        self.passenger = User.objects.create_user(
+            email='passenger@example.com',
+            username='passenger@example.com',
+            password='testpassword123',
+            user_type='passenger'
+        )
+        self.driver = create_driver(1, '-25.000000', '28.000000')
+        self.ride_request = create_ride_request(self.passenger)
+        # Cleanups run last first: flush the driver's points, then forget them
+        self.addCleanup(get_position_store().clear)
+        self.addCleanup(location_buffer.flush)
+        async_to_sync(get_channel_layer().flush)()
+        cache.clear()
+
+    @sync_to_async
+    def accept_ride(self):
+        ride = build_ride(self.ride_request, self.driver)
+        ride.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            notify_passenger_ride_accepted(ride)
+        return ride
+
+    async def test_participants_share_ride_group(self):
+        passenger = await self.connect(self.passenger)
+        driver = await self.connect(self.driver.user)
+
+        ride = await self.accept_ride()
+        self.assertEqual((await self.receive_json(passenger))['message']['type'], 'ride_accepted')
+
+        await self.send_json(driver, {'type': 'location_update', 'latitude': -25.001, 'longitude': 28, 'ride_id': ride.id})
+        update = await self.receive_json(passenger)
+        self.assertEqual((update['type'], update['ride_id']), ('location_update', ride.id))
+        self.assertTrue(await driver.receive_nothing(0.1))
+
+        await self.send_json(passenger, {'type': 'location_update', 'latitude': -25.002, 'longitude': 28, 'ride_id': ride.id})
+        self.assertEqual((await self.receive_json(driver))['latitude'], -25.002)
+        self.assertTrue(await passenger.receive_nothing(0.1))
+
+        # Cancelling the ride takes both connections out of the group
+        await self.send_json(passenger, {'type': 'ride_status_update', 'ride_id': ride.id, 'status': 'cancelled'})
+        self.assertEqual((await self.receive_json(passenger))['status'], 'cancelled')
+        self.assertEqual((await self.receive_json(driver))['status'], 'cancelled')
+        await passenger.receive_nothing(0.1)
+        groups = get_channel_layer().groups
+        self.assertNotIn(f'ride_{ride.id}', groups)
+
+        await self.disconnect(passenger)
+        await self.disconnect(driver)
+
+    async def test_reconnect_rejoins_active_rides(self):
+        ride = await self.accept_ride()
+        driver = await self.connect(self.driver.user)
+        passenger = await self.connect(self.passenger)
+
+        await self.send_json(passenger, {'type': 'location_update', 'latitude': -25.001, 'longitude': 28, 'ride_id': ride.id})
+        self.assertEqual((await self.receive_json(driver))['ride_id'], ride.id)
+
+        await self.disconnect(passenger)
+        await self.disconnect(driver)
+        self.assertNotIn(f'ride_{ride.id}', get_channel_layer().groups)
+
+    async def test_binary_and_json_clients_interoperate(self):
+        ride = await self.accept_ride()
+        driver = await self.connect(self.driver.user, [LOCATION_SUBPROTOCOL])
+        passenger = await self.connect(self.passenger)
+        self.assertEqual(driver.subprotocol, LOCATION_SUBPROTOCOL)
+        self.assertIsNone(passenger.subprotocol)
+
+        encoder = LocationEncoder()
+        for step in range(2):
+            frame = encoder.encode(ride.id, -25 - step / 1000, 28)
+            await driver.send_input({'type': 'websocket.receive', 'bytes': frame})
+            update = await self.receive_json(passenger)
+            self.assertEqual((update['ride_id'], update['latitude']), (ride.id, -25 - step / 1000))
+
+        decoder = LocationDecoder()
+        for step in range(2):
+            await self.send_json(passenger, {'type': 'location_update', 'latitude': -25.01 - step / 1000, 'longitude': 28, 'ride_id': ride.id})
+            output = await driver.receive_output(1)
+            self.assertEqual(len(output['bytes']), 13 if step == 0 else 5)
+            ride_id, latitude, _, _ = decoder.decode(output['bytes'])
+            self.assertEqual(ride_id, ride.id)
+            self.assertAlmostEqual(latitude, -25.01 - step / 1000)
+
+        # Binary frames from a JSON connection are refused
+        await passenger.send_input({'type': 'websocket.receive', 'bytes': frame})
+        self.assertEqual((await self.receive_json(passenger))['type'], 'error')
+
+        await self.disconnect(passenger)
+        await self.disconnect(driver)
+
+    async def test_driver_locations_carry_eta(self):
+        ride = await self.accept_ride()
+        passenger = await self.connect(self.passenger)
+        driver = await self.connect(self.driver.user)
+
+        with mock.patch('core.consumers.time') as clock:
+            clock.time.side_effect = [1000, 1010]
+            for step in range(2):
+                # Heading for the pickup at -25, 28 at 40 km/h
+                await self.send_json(driver, {'type': 'location_update', 'latitude': -25.01 + step / 1000, 'longitude': 28, 'ride_id': ride.id})
+                update = await self.receive_json(passenger)
+                if step == 0:
+                    # Meanwhile an uploaded batch advances the meter too
+                    meter = await aload_trip_meter(ride.id)
+                    meter.distance_km = 7.5
+                    await asave_trip_meter(ride.id, meter)
+        self.assertAlmostEqual(update['eta_seconds'], 1.3 * 0.009 * 111.2 / 40 * 3600, delta=20)
+        self.assertEqual((await aload_trip_meter(ride.id)).distance_km, 7.5)
+
+        # Passenger points do not move the meter
+        await self.send_json(passenger, {'type': 'location_update', 'latitude': -25, 'longitude': 28, 'ride_id': ride.id})
+        self.assertNotIn('eta_seconds', await self.receive_json(driver))
+
+        await self.disconnect(passenger)
+        await self.disconnect(driver)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, OUTBOX_WORKERS=0, EVENT_REPLAY_BUFFER_SIZE=3)
+class EventReplayTestCase(ConsumerTestMixin, TestCase):
+    def setUp(self):
+        self.passenger = User.objects.create_user(
+            email='passenger@example.com',
+            username='passenger@example.com',
+            password='testpassword123',
+            user_type='passenger'
+        )
+        async_to_sync(get_channel_layer().flush)()
+        cache.clear()
+
+    @sync_to_async
+    def notify(self, *titles):
+        with self.captureOnCommitCallbacks(execute=True):
+            publish([
+                (f'passenger_{self.passenger.id}', {'type': 'notification_message', 'message': {'title': title}})
+                for title in titles
+            ])
+
+    async def test_reconnect_replays_missed_events(self):
+        communicator = await self.connect(self.passenger)
+        await self.notify('first')
+        event = await self.receive_json(communicator)
+        self.assertEqual((event['seq'], event['message']['title']), (1, 'first'))
+        await self.disconnect(communicator)
+
+        # Numbers live in the database, not the cache
+        await sync_to_async(cache.clear)()
+        await self.notify('second', 'third')
+        communicator = await self.connect(self.passenger, query_string=b'resume_from=1')
+        replayed = [await self.receive_json(communicator) for _ in range(2)]
+        self.assertEqual([(event['seq'], event['message']['title']) for event in replayed], [(2, 'second'), (3, 'third')])
+        self.assertTrue(await communicator.receive_nothing(0.1))
+
+        # Live events carry on from there, in order
+        await self.notify('fourth', 'fifth')
+        self.assertEqual([(await self.receive_json(communicator))['seq'] for _ in range(2)], [4, 5])
+        await self.disconnect(communicator)
+
+    async def test_resync_when_missed_events_are_gone(self):
+        await self.notify('one', 'two', 'three', 'four', 'five')
+
+        # Only the last three events are buffered
+        communicator = await self.connect(self.passenger, query_string=b'resume_from=1')
+        self.assertEqual(await self.receive_json(communicator), {'type': 'resync', 'seq': 5})
+        await self.disconnect(communicator)
+
+        communicator = await self.connect(self.passenger, query_string=b'resume_from=2')
+        self.assertEqual([(await self.receive_json(communicator))['seq'] for _ in range(3)], [3, 4, 5])
+        await self.disconnect(communicator)
+        self.assertEqual(await sync_to_async(UserEvent.objects.count)(), 3)
+
+        # A number never handed out also asks for a resync
+        communicator = await self.connect(self.passenger, query_string=b'resume_from=9')
+        self.assertEqual(await self.receive_json(communicator), {'type': 'resync', 'seq': 5})
+        await self.disconnect(communicator)
+
+    async def test_live_events_covered_by_replay_are_skipped(self):
+        await self.notify('one', 'two')
+        communicator = await self.connect(self.passenger, query_string=b'resume_from=1')
+        # Delivered live while the replay was being sent
+        await get_channel_layer().group_send(
+            f'passenger_{self.passenger.id}',
+            {'type': 'notification_message', 'message': {'title': 'two'}, 'seq': 2}
+        )
+        self.assertEqual((await self.receive_json(communicator))['seq'], 2)
+        self.assertTrue(await communicator.receive_nothing(0.1))
+        await self.disconnect(communicator)
+
+
+@override_settings(EVENT_REPLAY_BUFFER_SIZE=1000)
+class ConcurrentSequenceTestCase(TransactionTestCase):
+    """Concurrent batches over the same users must hand out every number exactly once"""
+
+    def sequence(self, user_ids):
+        messages = [(f'passenger_{user_id}', {'type': 'notification_message', 'message': {}}) for user_id in user_ids]
+        try:
+            for _ in range(50):
+                try:
+                    return sequence_events(messages)
+                except OperationalError:
+                    # SQLite reports lock contention instead of waiting
+                    time.sleep(0.01)
+        finally:
+            connection.close()
+
+    def test_overlapping_batches(self):
+        users = [
+            User.objects.create_user(email=f'passenger{n}@example.com', username=f'passenger{n}@example.com',
+                                     password='testpassword123', user_type='passenger').id
+            for n in range(3)
+        ]
+        # Every batch names the users in another order, some of them twice
+        batches = [users, users[::-1], [users[2], users[0], users[2]], [users[1]]] * 5
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(self.sequence, batches))
+
+        handed_out = {user_id: [] for user_id in users}
+        for result in results:
+            numbered = {}
+            for group, message in result:
+                numbered.setdefault(int(group.split('_')[1]), []).append(message['seq'])
+            for user_id, seqs in numbered.items():
+                # A batch gets consecutive numbers per user, in message order
+                self.assertEqual(seqs, list(range(seqs[0], seqs[0] + len(seqs))))
+                handed_out[user_id] += seqs
+
+        for user_id, seqs in handed_out.items():
+            self.assertEqual(sorted(seqs), list(range(1, len(seqs) + 1)))
+            self.assertEqual(EventSequence.objects.get(user_id=user_id).last_seq, len(seqs))
+            self.assertEqual(
+                list(UserEvent.objects.filter(user_id=user_id).order_by('seq').values_list('seq', flat=True)),
+                sorted(seqs)
+            )
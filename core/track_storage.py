@@ -0,0 +1,76 @@
+import struct
+from datetime import datetime, timezone as dt_timezone
+
+import numpy as np
+
+# version, point count, timestamp of the first point in epoch milliseconds
+HEADER = struct.Struct('<BxxxIq')
+VERSION = 1
+MICRODEGREES = 1_000_000
+
+
+def to_epoch_ms(timestamp):
+    return round(timestamp.timestamp() * 1000)
+
+
+def from_epoch_ms(ms):
+    return datetime.fromtimestamp(int(ms) / 1000, tz=dt_timezone.utc)
+
+
+def pack_chunk(latitudes, longitudes, timestamps):
+    """
+    Pack a run of points into one columnar blob: the header, then int32
+    micro-degree latitudes, int32 micro-degree longitudes and uint32
+    millisecond deltas between consecutive timestamps. Points are sorted by
+    time first. ``timestamps`` are aware datetimes.
+    """
+    return pack_arrays(*to_arrays(latitudes, longitudes, timestamps))
+
+
+def to_arrays(latitudes, longitudes, timestamps):
+    ts = np.fromiter((to_epoch_ms(timestamp) for timestamp in timestamps), dtype=np.int64)
+    lat = np.rint(np.asarray(latitudes, dtype=np.float64) * MICRODEGREES).astype('<i4')
+    lng = np.rint(np.asarray(longitudes, dtype=np.float64) * MICRODEGREES).astype('<i4')
+    return lat, lng, ts
+
+
+def pack_arrays(lat, lng, ts):
+    """Pack ``(lat_e6, lng_e6, ts_ms)`` arrays, sorting them by time"""
+    order = np.argsort(ts, kind='stable')
+    lat, lng, ts = lat[order].astype('<i4'), lng[order].astype('<i4'), ts[order]
+    deltas = np.diff(ts, prepend=ts[0]).astype('<u4')
+    return b''.join((
+        HEADER.pack(VERSION, len(ts), int(ts[0])),
+        lat.tobytes(),
+        lng.tobytes(),
+        deltas.tobytes(),
+    ))
+
+
+def unpack_chunk(data):
+    """
+    ``(lat_e6, lng_e6, ts_ms)`` arrays of one blob. The coordinate arrays
+    are read-only views straight over ``data`` (bytes or memoryview);
+    only the timestamps are materialised, by a cumulative sum.
+    """
+    version, count, base_ms = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f'Unsupported track chunk version {version}')
+    offset = HEADER.size
+    lat = np.frombuffer(data, dtype='<i4', count=count, offset=offset)
+    lng = np.frombuffer(data, dtype='<i4', count=count, offset=offset + 4 * count)
+    deltas = np.frombuffer(data, dtype='<u4', count=count, offset=offset + 8 * count)
+    return lat, lng, base_ms + np.cumsum(deltas, dtype=np.int64)
+
+
+def read_chunks(blobs):
+    """Concatenate blobs into one time ordered ``(lat_e6, lng_e6, ts_ms)`` track"""
+    parts = [unpack_chunk(blob) for blob in blobs]
+    if not parts:
+        empty = np.empty(0, dtype=np.int64)
+        return empty.astype(np.int32), empty.astype(np.int32), empty
+    lat, lng, ts = (np.concatenate(column) for column in zip(*parts))
+    if len(ts) > 1 and np.any(np.diff(ts) < 0):
+        order = np.argsort(ts, kind='stable')
+        lat, lng, ts = lat[order], lng[order], ts[order]
+    return lat, lng, ts
@@ -0,0 +1,241 @@
+import logging
+import math
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+
+from drivers.geo import KM_PER_DEGREE
+from .location_buffer import location_buffer
+from .models import Location, RideTrack, TrackChunk
+from .track_storage import MICRODEGREES, from_epoch_ms, read_chunks, to_epoch_ms
+
+logger = logging.getLogger(__name__)
+
+
+def simplify_mask(latitudes, longitudes, tolerance_m, fixed=None):
+    """
+    Douglas-Peucker simplification: a boolean mask of the fewest points
+    such that no dropped point lies further than ``tolerance_m`` metres
+    from the simplified line. Points set in the optional ``fixed`` mask are
+    always kept, and only the spans between them are simplified.
+
+    Distances are measured to the segment (not the infinite line), so
+    out-and-back legs on rural roads are kept, on a local equirectangular
+    projection that is accurate to well under a metre over a ride.
+    """
+    lat = np.asarray(latitudes, dtype=np.float64)
+    lng = np.asarray(longitudes, dtype=np.float64)
+    n = len(lat)
+    keep = np.zeros(n, dtype=bool)
+    if n < 3:
+        keep[:] = True
+        return keep
+
+    metres_per_degree = KM_PER_DEGREE * 1000
+    xy = np.column_stack((lng * math.cos(math.radians(lat[0])), lat)) * metres_per_degree
+
+    keep[0] = keep[-1] = True
+    if fixed is not None:
+        keep |= np.asarray(fixed, dtype=bool)
+    anchors = np.flatnonzero(keep).tolist()
+    stack = list(zip(anchors[:-1], anchors[1:]))
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = xy[end] - xy[start]
+        offsets = xy[start + 1:end] - xy[start]
+        length_sq = segment @ segment
+        if length_sq == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            t = np.clip(offsets @ segment / length_sq, 0, 1)
+            distances = np.hypot(*(offsets - np.outer(t, segment)).T)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_m:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return keep
+
+
+def simplify_track(points, tolerance_m):
+    """Douglas-Peucker simplification of a list of ``(lat, lng, ...)`` points"""
+    points = list(points)
+    keep = simplify_mask([point[0] for point in points], [point[1] for point in points], tolerance_m)
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _encode_value(value, out):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+def _decode_values(encoded):
+    values = []
+    index = 0
+    while index < len(encoded):
+        result, shift = 0, 0
+        while True:
+            byte = ord(encoded[index]) - 63
+            index += 1
+            result |= (byte & 0x1f) << shift
+            shift += 5
+            if byte < 0x20:
+                break
+        values.append(~(result >> 1) if result & 1 else result >> 1)
+    return values
+
+
+def encode_deltas(values):
+    """Encode a sequence of integers as polyline characters of their deltas"""
+    out = []
+    previous = 0
+    for value in values:
+        _encode_value(value - previous, out)
+        previous = value
+    return ''.join(out)
+
+
+def decode_deltas(encoded):
+    values = []
+    total = 0
+    for delta in _decode_values(encoded):
+        total += delta
+        values.append(total)
+    return values
+
+
+def encode_polyline(coordinates, precision=5):
+    """Encode ``(lat, lng)`` pairs with the Google encoded polyline algorithm"""
+    factor = 10 ** precision
+    out = []
+    previous_lat = previous_lng = 0
+    for lat, lng in coordinates:
+        lat, lng = round(float(lat) * factor), round(float(lng) * factor)
+        _encode_value(lat - previous_lat, out)
+        _encode_value(lng - previous_lng, out)
+        previous_lat, previous_lng = lat, lng
+    return ''.join(out)
+
+
+def decode_polyline(encoded, precision=5):
+    factor = 10 ** precision
+    deltas = _decode_values(encoded)
+    lat = lng = 0
+    coordinates = []
+    for index in range(0, len(deltas), 2):
+        lat += deltas[index]
+        lng += deltas[index + 1]
+        coordinates.append((lat / factor, lng / factor))
+    return coordinates
+
+
+def decode_track(track):
+    """The ``(lat, lng, timestamp)`` points of a RideTrack"""
+    offsets = decode_deltas(track.timestamps)
+    return [
+        (lat, lng, track.started_at + timedelta(seconds=offset))
+        for (lat, lng), offset in zip(decode_polyline(track.polyline, track.precision), offsets)
+    ]
+
+
+def load_raw_track(ride):
+    """
+    The live track of a ride as ``(lat_e6, lng_e6, ts_ms, raw_count)``:
+    its packed TrackChunks plus any Location rows written before tracks
+    were packed. The driver's points make up the track when there are any,
+    otherwise the passenger's. ``raw_count`` counts every raw point.
+    """
+    chunks = list(
+        TrackChunk.objects.filter(ride=ride).order_by('first_timestamp', 'id')
+        .values_list('data', 'driver_id', 'point_count')
+    )
+    rows = list(Location.objects.filter(ride=ride).values_list('latitude', 'longitude', 'timestamp', 'driver_id'))
+    raw_count = sum(point_count for _, _, point_count in chunks) + len(rows)
+    from_driver = any(chunk[1] is not None for chunk in chunks) or any(row[3] is not None for row in rows)
+
+    lat, lng, ts = read_chunks(data for data, driver_id, _ in chunks if driver_id is not None or not from_driver)
+    rows = [row for row in rows if row[3] is not None or not from_driver]
+    if rows:
+        lat = np.concatenate((lat, [round(row[0] * MICRODEGREES) for row in rows])).astype(np.int32)
+        lng = np.concatenate((lng, [round(row[1] * MICRODEGREES) for row in rows])).astype(np.int32)
+        ts = np.concatenate((ts, [to_epoch_ms(row[2]) for row in rows])).astype(np.int64)
+        order = np.argsort(ts, kind='stable')
+        lat, lng, ts = lat[order], lng[order], ts[order]
+    return lat, lng, ts, raw_count
+
+
+def ride_track(ride):
+    """
+    ``(points, track)`` for replaying a ride: its raw points with a None
+    track, or once the ride has been compacted the decoded RideTrack, with
+    any raw points flushed by other processes since merged in.
+    """
+    track = RideTrack.objects.filter(ride=ride).first()
+    lat, lng, ts, _ = load_raw_track(ride)
+    points = [
+        (lat_e6 / MICRODEGREES, lng_e6 / MICRODEGREES, from_epoch_ms(ms))
+        for lat_e6, lng_e6, ms in zip(lat.tolist(), lng.tolist(), ts.tolist())
+    ]
+    if track is not None:
+        points = sorted(decode_track(track) + points, key=lambda point: point[2])
+    return points, track
+
+
+def compact_ride_track(ride, tolerance_m=None):
+    """
+    Replace the raw track of a finished ride with a simplified, polyline
+    encoded RideTrack. Points still waiting in the location buffer are
+    flushed first. Running it again merges any newer raw points into the
+    existing track: its points are all kept and only the spans the new
+    points fall in are simplified, so the error never compounds. Returns
+    the RideTrack, or None if the ride has no points.
+    """
+    if tolerance_m is None:
+        tolerance_m = getattr(settings, 'TRACK_SIMPLIFY_TOLERANCE_M', 5)
+    precision = getattr(settings, 'TRACK_POLYLINE_PRECISION', 5)
+
+    location_buffer.flush()
+
+    with transaction.atomic():
+        existing = RideTrack.objects.select_for_update().filter(ride=ride).first()
+        lat_e6, lng_e6, ts_ms, raw_count = load_raw_track(ride)
+        if not raw_count:
+            return existing
+
+        lat, lng = lat_e6 / MICRODEGREES, lng_e6 / MICRODEGREES
+        fixed = None
+        if existing is not None:
+            previous = decode_track(existing)
+            lat = np.concatenate(([point[0] for point in previous], lat))
+            lng = np.concatenate(([point[1] for point in previous], lng))
+            ts_ms = np.concatenate(([to_epoch_ms(point[2]) for point in previous], ts_ms))
+            fixed = np.arange(len(ts_ms)) < len(previous)
+            raw_count += existing.raw_point_count
+            # Late uploads can fall anywhere in the trip; simplify in time order
+            order = np.argsort(ts_ms, kind='stable')
+            lat, lng, ts_ms, fixed = lat[order], lng[order], ts_ms[order], fixed[order]
+
+        keep = simplify_mask(lat, lng, tolerance_m, fixed)
+        lat, lng, ts_ms = lat[keep], lng[keep], ts_ms[keep]
+        track = existing or RideTrack(ride=ride)
+        track.polyline = encode_polyline(zip(lat.tolist(), lng.tolist()), precision)
+        track.timestamps = encode_deltas(round((ms - int(ts_ms[0])) / 1000) for ms in ts_ms.tolist())
+        track.started_at = from_epoch_ms(ts_ms[0])
+        track.precision = precision
+        track.tolerance_m = tolerance_m
+        track.point_count = len(lat)
+        track.raw_point_count = raw_count
+        track.save()
+        TrackChunk.objects.filter(ride=ride).delete()
+        Location.objects.filter(ride=ride).delete()
+
+    logger.info('Compacted ride %s track from %s to %s points', ride.id, raw_count, track.point_count)
+    return track
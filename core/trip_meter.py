@@ -0,0 +1,168 @@
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from drivers.geo import haversine_km
+
+# The passenger is in the vehicle; only these legs count towards the trip
+ONBOARD_STATUSES = ('picked_up', 'in_transit')
+
+
+def trip_meter_key(ride_id):
+    return f'trip_meter:{ride_id}'
+
+
+class TripMeter:
+    """
+    Running distance and speed of a ride, advanced by one haversine step
+    per accepted driver location, so nothing is ever re-scanned.
+
+    Distance only accumulates while the passenger is on board; the
+    approach to the pickup still feeds the speed estimate. Speed is an
+    exponentially weighted moving average of the per-step speeds. Steps
+    faster than TRIP_METER_MAX_SPEED_KMH are GPS jumps and are ignored.
+
+    Live points are timed by the server and uploaded ones by the device,
+    so the two are never stepped against each other by time: points
+    uploaded after the live stream moved on only reroute its latest gap
+    (see ``add_uploaded``).
+    """
+
+    def __init__(self, distance_km=0.0, speed_kmh=None, last=None, started=None, gap=None):
+        self.distance_km = distance_km
+        self.speed_kmh = speed_kmh
+        self.last = last  # (lat, lng, epoch seconds) of the previous point
+        self.started = started  # epoch seconds of the first point on board
+        # (last point routed through, live point after it, counted) of the
+        # latest step longer than TRIP_METER_GAP_SECONDS
+        self.gap = gap
+
+    @classmethod
+    def from_dict(cls, data):
+        gap = data.get('gap')
+        return cls(
+            distance_km=data['distance_km'],
+            speed_kmh=data['speed_kmh'],
+            last=tuple(data['last']) if data['last'] else None,
+            started=data['started'],
+            gap=(tuple(gap[0]), tuple(gap[1]), gap[2]) if gap else None
+        )
+
+    def to_dict(self):
+        return {
+            'distance_km': self.distance_km,
+            'speed_kmh': self.speed_kmh,
+            'last': self.last,
+            'started': self.started,
+            'gap': self.gap,
+        }
+
+    def add(self, lat, lng, timestamp, onboard=True):
+        """Advance the meter to a point at ``timestamp`` (epoch seconds); returns False for a jump"""
+        if self.last is not None:
+            last_lat, last_lng, last_timestamp = self.last
+            elapsed = timestamp - last_timestamp
+            if elapsed <= 0:
+                return False
+            step_km = haversine_km(last_lat, last_lng, lat, lng)
+            speed_kmh = step_km / elapsed * 3600
+            if speed_kmh > getattr(settings, 'TRIP_METER_MAX_SPEED_KMH', 160):
+                return False
+            alpha = getattr(settings, 'TRIP_METER_SPEED_ALPHA', 0.3)
+            self.speed_kmh = speed_kmh if self.speed_kmh is None else alpha * speed_kmh + (1 - alpha) * self.speed_kmh
+            counted = onboard and self.started is not None
+            if counted:
+                self.distance_km += step_km
+            if elapsed > getattr(settings, 'TRIP_METER_GAP_SECONDS', 60):
+                # The stream was cut; points the device uploads later fill the gap in
+                self.gap = (self.last, (lat, lng, timestamp), counted)
+        if onboard and self.started is None:
+            self.started = timestamp
+        self.last = (lat, lng, timestamp)
+        return True
+
+    def add_uploaded(self, points, onboard=True):
+        """
+        Advance the meter with points a device recorded offline and uploaded
+        later, ``(lat, lng, epoch seconds)`` oldest first. If they are newer
+        than the last point they simply carry the meter on. Otherwise they
+        were recorded while the live stream was cut: the straight step it
+        took across its latest gap is rerouted through them, and a later
+        batch from the same gap carries on from this one. Returns the number
+        of points used.
+        """
+        if self.last is None or points[0][2] > self.last[2]:
+            return sum(self.add(lat, lng, timestamp, onboard) for lat, lng, timestamp in points)
+        if self.gap is None:
+            return 0
+
+        tail, end, counted = self.gap
+        max_speed_kmh = getattr(settings, 'TRIP_METER_MAX_SPEED_KMH', 160)
+        route = []
+        for point in points:
+            if route:
+                elapsed = point[2] - route[-1][2]
+                if elapsed <= 0 or haversine_km(*route[-1][:2], *point[:2]) / elapsed * 3600 > max_speed_kmh:
+                    continue
+            route.append(point)
+        if counted:
+            path = [tail] + route + [end]
+            self.distance_km += sum(haversine_km(*a[:2], *b[:2]) for a, b in zip(path, path[1:]))
+            self.distance_km -= haversine_km(*tail[:2], *end[:2])
+        self.gap = (route[-1], end, counted)
+        return len(route)
+
+    def eta_seconds(self, target_lat, target_lng):
+        """
+        Seconds to reach the target from the last point at the average
+        speed, with the straight line stretched by TRIP_METER_ROUTE_FACTOR
+        for winding roads. None until the speed is known.
+        """
+        if self.last is None or self.speed_kmh is None:
+            return None
+        distance_km = haversine_km(self.last[0], self.last[1], float(target_lat), float(target_lng))
+        distance_km *= getattr(settings, 'TRIP_METER_ROUTE_FACTOR', 1.3)
+        speed_kmh = max(self.speed_kmh, getattr(settings, 'TRIP_METER_MIN_SPEED_KMH', 5))
+        return round(distance_km / speed_kmh * 3600)
+
+
+def load_trip_meter(ride_id):
+    data = cache.get(trip_meter_key(ride_id))
+    return TripMeter.from_dict(data) if data else TripMeter()
+
+
+def save_trip_meter(ride_id, meter):
+    cache.set(trip_meter_key(ride_id), meter.to_dict(), getattr(settings, 'TRIP_METER_TIMEOUT', 6 * 3600))
+
+
+async def aload_trip_meter(ride_id):
+    data = await cache.aget(trip_meter_key(ride_id))
+    return TripMeter.from_dict(data) if data else TripMeter()
+
+
+async def asave_trip_meter(ride_id, meter):
+    await cache.aset(trip_meter_key(ride_id), meter.to_dict(), getattr(settings, 'TRIP_METER_TIMEOUT', 6 * 3600))
+
+
+def discard_trip_meter(ride_id):
+    cache.delete(trip_meter_key(ride_id))
+
+
+def apply_trip_meter(ride):
+    """
+    Fill in ``distance`` (km) and ``duration`` (minutes) of a ride being
+    completed from its trip meter, without saving. Duration runs from the
+    pickup time, or the first point on board, to the drop-off. Returns
+    False if the meter never saw the passenger on board.
+    """
+    meter = load_trip_meter(ride.id)
+    if meter.started is None:
+        return False
+    started = ride.pickup_time or datetime.fromtimestamp(meter.started, tz=dt_timezone.utc)
+    finished = ride.dropoff_time or timezone.now()
+    ride.distance = Decimal(f'{meter.distance_km:.2f}')
+    ride.duration = max(round((finished - started).total_seconds() / 60), 0)
+    return True
@@ -1,7 +1,10 @@
 from django.urls import path
 from . import views
 from . import views_tracking
-from .views_notifications import NotificationListView, MarkNotificationAsReadView
+from .views_notifications import (
+    NotificationListView, MarkNotificationAsReadView, MarkNotificationsReadView, UnreadNotificationCountView
+)
+from .views_metrics import MetricsView
 from .views import CreatePaymentIntentView, ProcessPaymentView, CashPaymentView
 
 urlpatterns = [
@@ -12,10 +15,13 @@ urlpatterns = [
     path('update-tracking-preferences/', views_tracking.update_tracking_preferences, name='update_tracking_preferences'),
     path('get-tracking-status/', views_tracking.get_tracking_status, name='get_tracking_status'),
     path('notifications/', NotificationListView.as_view(), name='notifications'),
+    path('notifications/unread-count/', UnreadNotificationCountView.as_view(), name='notifications-unread-count'),
+    path('notifications/read/', MarkNotificationsReadView.as_view(), name='mark-notifications-read'),
     path('notifications/<int:pk>/read/', MarkNotificationAsReadView.as_view(), name='mark-notification-read'),
     path('payments/create/', CreatePaymentIntentView.as_view(), name='create-payment-intent'),
     path('payments/process/', ProcessPaymentView.as_view(), name='process-payment'),
     path('payments/cash/', CashPaymentView.as_view(), name='cash-payment'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
 
 app_name = 'core'
\ No newline at end of file
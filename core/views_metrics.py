@@ -0,0 +1,13 @@
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework.permissions import IsAdminUser
+from . import metrics
+from .outbox import dispatcher
+
+class MetricsView(APIView):
+    """In-process counters, gauges and latency percentiles for operators"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        dispatcher.refresh_queue_depth()
+        return Response(metrics.snapshot())
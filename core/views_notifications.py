@@ -3,16 +3,26 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from .models import Notification
-from .serializers import NotificationSerializer
+from .notifications import adjust_unread_counts, get_unread_count, mark_read
+from .pagination import KeysetPagination
+from .serializers import MarkNotificationsReadSerializer, NotificationSerializer
 
 class NotificationListView(generics.ListAPIView):
+    """Newest first, a page at a time; follow ``next`` for older ones"""
     serializer_class = NotificationSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
     
     def get_queryset(self):
         return Notification.objects.filter(
             recipient=self.request.user
-        ).order_by('-created_at')
+        ).order_by('-created_at', '-id')
+
+class UnreadNotificationCountView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        return Response({'unread_count': get_unread_count(request.user.id)})
 
 class MarkNotificationAsReadView(APIView):
     permission_classes = [IsAuthenticated]
@@ -23,8 +33,10 @@ class MarkNotificationAsReadView(APIView):
                 id=pk,
                 recipient=request.user
             )
-            notification.is_read = True
-            notification.save()
+            if not notification.is_read:
+                notification.is_read = True
+                notification.save(update_fields=['is_read'])
+                adjust_unread_counts({request.user.id: -1})
             
             serializer = NotificationSerializer(notification)
             return Response(serializer.data)
@@ -32,4 +44,27 @@ class MarkNotificationAsReadView(APIView):
             return Response(
                 {'error': 'Notification not found'}, 
                 status=status.HTTP_404_NOT_FOUND
-            )
\ No newline at end of file
+            )
+
+class MarkNotificationsReadView(APIView):
+    """
+    Mark many notifications read in one call, by ``ids``, ``up_to_id`` or
+    ``type``, and return the new unread count
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = MarkNotificationsReadSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        marked = mark_read(
+            request.user.id,
+            ids=serializer.validated_data.get('ids'),
+            up_to_id=serializer.validated_data.get('up_to_id'),
+            notification_type=serializer.validated_data.get('type')
+        )
+        return Response({
+            'marked': marked,
+            'unread_count': get_unread_count(request.user.id),
+        })
@@ -0,0 +1,109 @@
+import json
+import struct
+
+from .track_storage import MICRODEGREES
+
+# Offered by clients in Sec-WebSocket-Protocol; connections that do not
+# negotiate it keep using JSON text frames
+LOCATION_SUBPROTOCOL = 'ruralhailing.location.v1'
+
+KEYFRAME = 1
+DELTA = 2
+
+# type, ride id, micro-degree latitude and longitude
+KEYFRAME_FORMAT = struct.Struct('<BIii')
+# type, micro-degree latitude and longitude change since the previous frame
+DELTA_FORMAT = struct.Struct('<Bhh')
+DELTA_LIMIT = 2 ** 15
+# Set on the type byte when an ETA in seconds follows the frame
+HAS_ETA = 0x80
+ETA_FORMAT = struct.Struct('<H')
+MAX_ETA_SECONDS = 2 ** 16 - 1
+
+
+class WireError(ValueError):
+    pass
+
+
+def location_json(ride_id, latitude, longitude, eta_seconds=None):
+    """The JSON text frame of a location update, as sent to JSON clients"""
+    message = {
+        'type': 'location_update',
+        'latitude': latitude,
+        'longitude': longitude,
+        'ride_id': ride_id
+    }
+    if eta_seconds is not None:
+        message['eta_seconds'] = eta_seconds
+    return json.dumps(message)
+
+
+class LocationEncoder:
+    """
+    Encodes the location frames of one direction of one connection.
+
+    The first frame of a ride is a 13 byte keyframe carrying the ride id and
+    absolute micro-degree coordinates; later frames of the same ride are
+    5 byte deltas from the previous frame, as long as the move fits in
+    16 bits (about 3.6 km). WebSocket frames arrive in order, so the
+    decoder on the other end always holds the same previous frame.
+
+    Frames from the driver's side may carry the ETA: the type byte has the
+    HAS_ETA bit set and two more bytes of seconds follow.
+    """
+
+    def __init__(self):
+        self.last = None  # (ride_id, lat_e6, lng_e6) of the previous frame
+
+    def encode(self, ride_id, latitude, longitude, eta_seconds=None):
+        frame = self._encode(ride_id, latitude, longitude)
+        if eta_seconds is None:
+            return frame
+        eta = ETA_FORMAT.pack(min(max(int(eta_seconds), 0), MAX_ETA_SECONDS))
+        return bytes((frame[0] | HAS_ETA,)) + frame[1:] + eta
+
+    def _encode(self, ride_id, latitude, longitude):
+        try:
+            ride_id = int(ride_id)
+            lat = round(float(latitude) * MICRODEGREES)
+            lng = round(float(longitude) * MICRODEGREES)
+        except (TypeError, ValueError, OverflowError):
+            raise WireError('Invalid location')
+        if not (0 <= ride_id < 2 ** 32 and abs(lat) <= 90 * MICRODEGREES and abs(lng) <= 180 * MICRODEGREES):
+            raise WireError('Invalid location')
+
+        if self.last is not None and self.last[0] == ride_id:
+            delta_lat, delta_lng = lat - self.last[1], lng - self.last[2]
+            if -DELTA_LIMIT <= delta_lat < DELTA_LIMIT and -DELTA_LIMIT <= delta_lng < DELTA_LIMIT:
+                self.last = (ride_id, lat, lng)
+                return DELTA_FORMAT.pack(DELTA, delta_lat, delta_lng)
+        self.last = (ride_id, lat, lng)
+        return KEYFRAME_FORMAT.pack(KEYFRAME, ride_id, lat, lng)
+
+
+class LocationDecoder:
+    """Decodes the frames of a LocationEncoder into ``(ride_id, lat, lng, eta_seconds)``"""
+
+    def __init__(self):
+        self.last = None
+
+    def decode(self, data):
+        kind = data[0] if data else None
+        eta_seconds = None
+        if kind is not None and kind & HAS_ETA:
+            if len(data) < 1 + ETA_FORMAT.size:
+                raise WireError('Malformed location frame')
+            kind &= ~HAS_ETA
+            eta_seconds = ETA_FORMAT.unpack_from(data, len(data) - ETA_FORMAT.size)[0]
+            data = data[:-ETA_FORMAT.size]
+        if kind == KEYFRAME and len(data) == KEYFRAME_FORMAT.size:
+            _, ride_id, lat, lng = KEYFRAME_FORMAT.unpack(data)
+        elif kind == DELTA and len(data) == DELTA_FORMAT.size:
+            if self.last is None:
+                raise WireError('Delta frame without a keyframe')
+            _, delta_lat, delta_lng = DELTA_FORMAT.unpack(data)
+            ride_id, lat, lng = self.last[0], self.last[1] + delta_lat, self.last[2] + delta_lng
+        else:
+            raise WireError('Malformed location frame')
+        self.last = (ride_id, lat, lng)
+        return ride_id, lat / MICRODEGREES, lng / MICRODEGREES, eta_seconds
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class DriversConfig(AppConfig):
     name = 'drivers'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,47 @@
+import math
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Calculate distance between two points in km using Haversine formula"""
+    dLat = math.radians(lat2 - lat1)
+    dLon = math.radians(lng2 - lng1)
+    a = (math.sin(dLat/2) * math.sin(dLat/2) +
+         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
+         math.sin(dLon/2) * math.sin(dLon/2))
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    return EARTH_RADIUS_KM * c
+
+
+def haversine_km_many(lat, lng, lats, lngs):
+    """
+    Vectorised haversine distance in km from one point to arrays of points.
+    Returns a NumPy array the same length as ``lats``/``lngs``.
+    """
+    lat, lng = float(lat), float(lng)
+    lat1 = np.radians(lat)
+    lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+    dLat = lat2 - lat1
+    dLon = np.radians(np.asarray(lngs, dtype=np.float64) - lng)
+    a = np.sin(dLat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dLon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def bounding_box(lat, lng, radius_km):
+    """
+    Return ``(min_lat, max_lat, min_lng, max_lng)`` enclosing every point
+    within ``radius_km`` of the given point.
+    """
+    lat, lng = float(lat), float(lng)
+    dLat = radius_km / KM_PER_DEGREE
+    min_lat, max_lat = max(lat - dLat, -90.0), min(lat + dLat, 90.0)
+    if min_lat <= -90.0 or max_lat >= 90.0:
+        return min_lat, max_lat, -180.0, 180.0
+    dLng = dLat / math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    if dLng >= 180.0:
+        return min_lat, max_lat, -180.0, 180.0
+    return min_lat, max_lat, lng - dLng, lng + dLng
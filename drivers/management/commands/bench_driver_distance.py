@@ -0,0 +1,58 @@
+import random
+import time
+from decimal import Decimal
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from drivers.geo import haversine_km, haversine_km_many
+from drivers.spatial import DriverGridIndex
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmark nearest-driver search: scalar loop vs vectorised haversine vs grid index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000])
+        parser.add_argument('--queries', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        queries = options['queries']
+
+        self.stdout.write(f"{'drivers':>8} {'loop ms':>10} {'numpy ms':>10} {'index ms':>10} {'speedup':>8}")
+        for size in options['sizes']:
+            # Drivers scattered over a ~200 km square rural region
+            lats = [-26.0 + rng.random() * 2 for _ in range(size)]
+            lngs = [27.0 + rng.random() * 2 for _ in range(size)]
+            # The original loop works on DecimalField values
+            decimal_points = [(Decimal(f'{lat:.6f}'), Decimal(f'{lng:.6f}')) for lat, lng in zip(lats, lngs)]
+            lat_array = np.array(lats)
+            lng_array = np.array(lngs)
+            index = DriverGridIndex()
+            index.rebuild((i, lat, lng) for i, (lat, lng) in enumerate(zip(lats, lngs)))
+            pickups = [(-26.0 + rng.random() * 2, 27.0 + rng.random() * 2) for _ in range(queries)]
+
+            start = time.perf_counter()
+            for lat, lng in pickups:
+                min_distance = float('inf')
+                for p_lat, p_lng in decimal_points:
+                    distance = haversine_km(lat, lng, float(p_lat), float(p_lng))
+                    if distance < min_distance:
+                        min_distance = distance
+            loop_ms = (time.perf_counter() - start) * 1000 / queries
+
+            start = time.perf_counter()
+            for lat, lng in pickups:
+                int(np.argmin(haversine_km_many(lat, lng, lat_array, lng_array)))
+            numpy_ms = (time.perf_counter() - start) * 1000 / queries
+
+            start = time.perf_counter()
+            for lat, lng in pickups:
+                index.nearest(lat, lng, k=1)
+            index_ms = (time.perf_counter() - start) * 1000 / queries
+
+            self.stdout.write(
+                f"{size:>8} {loop_ms:>10.3f} {numpy_ms:>10.3f} {index_ms:>10.3f} {loop_ms / numpy_ms:>7.1f}x"
+            )
@@ -0,0 +1,19 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:11
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drivers', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='driver',
+            index=models.Index(condition=models.Q(('is_active', True), ('status', 'available')), fields=['location_lat', 'location_lng'], name='driver_avail_lat_lng_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drivers', '0002_driver_avail_lat_lng_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='driver',
+            index=models.Index(fields=['status', 'is_active'], name='driver_status_active_idx'),
+        ),
+    ]
@@ -28,6 +28,17 @@ class Driver(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'is_active'], name='driver_status_active_idx'),
+            # Bounding-box lookups for nearby available drivers
+            models.Index(
+                fields=['location_lat', 'location_lng'],
+                name='driver_avail_lat_lng_idx',
+                condition=models.Q(status='available', is_active=True),
+            ),
+        ]
+
     def __str__(self):
         return f"Driver {self.user.get_full_name()} - {self.vehicle_make} {self.vehicle_model}"
 
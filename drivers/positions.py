@@ -0,0 +1,282 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Driver
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POSITION_STORE = {
+    'BACKEND': 'drivers.positions.InMemoryPositionStore',
+    'OPTIONS': {},
+}
+
+
+class BasePositionStore:
+    """
+    Latest known ``(lat, lng, ts)`` of each driver, kept outside the
+    database so location frames never rewrite Driver rows.
+
+    ``claim_persist`` decides which writer gets to copy a driver's position
+    to the database next, at most once per ``interval`` seconds.
+    """
+
+    def set_many(self, positions):
+        """Store ``{driver_id: (lat, lng, ts)}``"""
+        raise NotImplementedError
+
+    def get_many(self, driver_ids):
+        """Return ``{driver_id: (lat, lng, ts)}`` for the drivers that have a position"""
+        raise NotImplementedError
+
+    def remove(self, driver_id):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def claim_persist(self, driver_id, interval):
+        """True if the caller should persist this driver's position now"""
+        raise NotImplementedError
+
+    def set(self, driver_id, lat, lng, ts=None):
+        self.set_many({driver_id: (lat, lng, ts or timezone.now())})
+
+    def get(self, driver_id):
+        return self.get_many([driver_id]).get(driver_id)
+
+
+class InMemoryPositionStore(BasePositionStore):
+    """Per-process store; each worker process only sees its own updates"""
+
+    def __init__(self, **options):
+        self._lock = threading.Lock()
+        self._positions = {}
+        self._persist_after = {}
+
+    def set_many(self, positions):
+        with self._lock:
+            for driver_id, (lat, lng, ts) in positions.items():
+                self._positions[driver_id] = (float(lat), float(lng), ts)
+
+    def get_many(self, driver_ids):
+        with self._lock:
+            return {
+                driver_id: self._positions[driver_id]
+                for driver_id in driver_ids if driver_id in self._positions
+            }
+
+    def remove(self, driver_id):
+        with self._lock:
+            self._positions.pop(driver_id, None)
+            self._persist_after.pop(driver_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._positions.clear()
+            self._persist_after.clear()
+
+    def claim_persist(self, driver_id, interval):
+        now = time.monotonic()
+        with self._lock:
+            if self._persist_after.get(driver_id, 0) > now:
+                return False
+            self._persist_after[driver_id] = now + interval
+            return True
+
+
+class RedisPositionStore(BasePositionStore):
+    """
+    Store shared by every process, kept in one Redis hash. Works with any
+    server speaking the Redis protocol.
+
+    OPTIONS: ``URL`` (default ``redis://127.0.0.1:6379/0``) and
+    ``KEY_PREFIX`` (default ``driver_positions``).
+    """
+
+    def __init__(self, URL='redis://127.0.0.1:6379/0', KEY_PREFIX='driver_positions', client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(URL)
+        self.client = client
+        self.key = KEY_PREFIX
+        self.persist_prefix = f'{KEY_PREFIX}:persist:'
+
+    def set_many(self, positions):
+        if positions:
+            self.client.hset(self.key, mapping={
+                driver_id: f'{float(lat)},{float(lng)},{ts.timestamp()}'
+                for driver_id, (lat, lng, ts) in positions.items()
+            })
+
+    def get_many(self, driver_ids):
+        driver_ids = list(driver_ids)
+        if not driver_ids:
+            return {}
+        positions = {}
+        for driver_id, value in zip(driver_ids, self.client.hmget(self.key, driver_ids)):
+            if value is not None:
+                lat, lng, ts = (float(part) for part in value.decode().split(','))
+                positions[driver_id] = (lat, lng, datetime.fromtimestamp(ts, tz=dt_timezone.utc))
+        return positions
+
+    def remove(self, driver_id):
+        self.client.hdel(self.key, driver_id)
+        self.client.delete(f'{self.persist_prefix}{driver_id}')
+
+    def clear(self):
+        self.client.delete(self.key)
+        # The persist throttle keys, found with SCAN so Redis is never blocked
+        batch = []
+        for key in self.client.scan_iter(match=f'{self.persist_prefix}*', count=500):
+            batch.append(key)
+            if len(batch) == 500:
+                self.client.delete(*batch)
+                batch = []
+        if batch:
+            self.client.delete(*batch)
+
+    def claim_persist(self, driver_id, interval):
+        # SET NX with an expiry lets exactly one process win each interval
+        return bool(self.client.set(
+            f'{self.persist_prefix}{driver_id}', 1, nx=True, px=max(int(interval * 1000), 1)
+        ))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_position_store():
+    """The store configured by DRIVER_POSITION_STORE"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = getattr(settings, 'DRIVER_POSITION_STORE', DEFAULT_POSITION_STORE)
+                _store = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+    return _store
+
+
+@receiver(setting_changed)
+def reset_position_store(setting, **kwargs):
+    global _store
+    if setting == 'DRIVER_POSITION_STORE':
+        _store = None
+
+
+def record_positions(positions):
+    """
+    Record ``{driver_id: (lat, lng, ts)}`` as the drivers' latest positions
+    and move them in the spatial index. Positions are copied to the Driver
+    rows at most every DRIVER_POSITION_PERSIST_SECONDS per driver, with one
+    narrow UPDATE of the location columns only (``updated_at`` and
+    ``status`` are left alone); a throttled position is written later by
+    ``persist_pending_positions``. Returns the number of drivers persisted.
+    """
+    from .spatial import driver_index
+
+    if not positions:
+        return 0
+    store = get_position_store()
+    store.set_many(positions)
+    for driver_id, (lat, lng, _) in positions.items():
+        driver_index.move(driver_id, lat, lng)
+
+    interval = getattr(settings, 'DRIVER_POSITION_PERSIST_SECONDS', 15)
+    due, throttled = [], []
+    for driver_id, (lat, lng, ts) in positions.items():
+        if store.claim_persist(driver_id, interval):
+            due.append(Driver(id=driver_id, location_lat=lat, location_lng=lng, last_location_update=ts))
+        else:
+            throttled.append(driver_id)
+    if due:
+        Driver.objects.bulk_update(due, ['location_lat', 'location_lng', 'last_location_update'])
+    if throttled:
+        _defer_persist(throttled, interval)
+    return len(due)
+
+
+_unpersisted = set()
+_unpersisted_lock = threading.Lock()
+_persist_timer = None
+
+
+def _defer_persist(driver_ids, interval):
+    """Have persist_pending_positions write these drivers once the throttle allows"""
+    global _persist_timer
+    with _unpersisted_lock:
+        _unpersisted.update(driver_ids)
+        if _persist_timer is None:
+            _persist_timer = threading.Timer(interval, _persist_in_background)
+            _persist_timer.daemon = True
+            _persist_timer.start()
+
+
+def _persist_in_background():
+    try:
+        persist_pending_positions()
+    except Exception:
+        logger.exception('Persisting driver positions failed')
+    finally:
+        connection.close()
+
+
+def persist_pending_positions():
+    """
+    Trailing write of the throttle: copy the latest stored position of
+    every driver whose last update was throttled to the Driver row, so a
+    driver who stops sending within DRIVER_POSITION_PERSIST_SECONDS of the
+    last write still has their final position persisted. Drivers still
+    inside their throttle window are retried one interval later. Returns
+    the number of drivers persisted.
+    """
+    global _persist_timer
+    with _unpersisted_lock:
+        driver_ids = set(_unpersisted)
+        _unpersisted.clear()
+        _persist_timer = None
+    if not driver_ids:
+        return 0
+
+    store = get_position_store()
+    interval = getattr(settings, 'DRIVER_POSITION_PERSIST_SECONDS', 15)
+    due, throttled = [], []
+    for driver_id, (lat, lng, ts) in store.get_many(driver_ids).items():
+        if store.claim_persist(driver_id, interval):
+            due.append(Driver(id=driver_id, location_lat=lat, location_lng=lng, last_location_update=ts))
+        else:
+            throttled.append(driver_id)
+    if due:
+        Driver.objects.bulk_update(due, ['location_lat', 'location_lng', 'last_location_update'])
+    if throttled:
+        _defer_persist(throttled, interval)
+    return len(due)
+
+
+def record_position(driver_id, lat, lng, ts=None):
+    return record_positions({driver_id: (lat, lng, ts or timezone.now())})
+
+
+def overlay_positions(rows):
+    """
+    Replace the database positions in ``(driver_id, lat, lng)`` rows with
+    fresher ones from the position store, since the Driver columns may lag
+    by up to DRIVER_POSITION_PERSIST_SECONDS.
+    """
+    rows = list(rows)
+    fresh = get_position_store().get_many([row[0] for row in rows])
+    if not fresh:
+        return rows
+    return [
+        (driver_id, *fresh[driver_id][:2]) if driver_id in fresh else (driver_id, lat, lng)
+        for driver_id, lat, lng in rows
+    ]
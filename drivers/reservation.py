@@ -0,0 +1,33 @@
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Driver
+from .spatial import driver_index
+
+
+def reserve_driver(driver_id):
+    """
+    Atomically move an available driver to 'on_ride'.
+
+    The conditional UPDATE only matches while the driver is still available,
+    so when several requests race for the same driver exactly one of them
+    gets a row count of 1. Returns True if this caller won the driver.
+    """
+    claimed = Driver.objects.filter(
+        id=driver_id,
+        status='available',
+        is_active=True
+    ).update(status='on_ride', updated_at=timezone.now())
+
+    if claimed:
+        # QuerySet.update() bypasses the Driver signals
+        transaction.on_commit(lambda: driver_index.remove(driver_id))
+    return bool(claimed)
+
+
+def reserve_first_available(driver_ids):
+    """Reserve the first driver in ``driver_ids`` that can still be claimed"""
+    for driver_id in driver_ids:
+        if reserve_driver(driver_id):
+            return driver_id
+    return None
@@ -8,6 +8,15 @@ class DriverSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = ('user', 'rating', 'total_rides', 'created_at', 'updated_at')
 
+class NearbyDriverSerializer(serializers.Serializer):
+    """Slim projection of an available driver for passenger maps"""
+    id = serializers.IntegerField()
+    latitude = serializers.FloatField()
+    longitude = serializers.FloatField()
+    vehicle_type = serializers.CharField(allow_null=True)
+    last_location_update = serializers.DateTimeField(allow_null=True)
+    distance = serializers.FloatField()
+
 class VehicleSerializer(serializers.ModelSerializer):
     class Meta:
         model = Vehicle
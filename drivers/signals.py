@@ -0,0 +1,20 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Driver
+from .spatial import driver_index
+
+
+@receiver(post_save, sender=Driver)
+def index_driver_on_save(sender, instance, **kwargs):
+    """Keep the spatial index in step with driver status and location"""
+    if (instance.status == 'available' and instance.is_active and
+            instance.location_lat is not None and instance.location_lng is not None):
+        driver_index.upsert(instance.id, instance.location_lat, instance.location_lng)
+    else:
+        driver_index.remove(instance.id)
+
+
+@receiver(post_delete, sender=Driver)
+def unindex_driver_on_delete(sender, instance, **kwargs):
+    driver_index.remove(instance.id)
@@ -0,0 +1,223 @@
+import heapq
+import math
+import threading
+import time
+
+from django.conf import settings
+
+import numpy as np
+
+from .models import Driver
+from .geo import KM_PER_DEGREE, bounding_box, haversine_km, haversine_km_many
+from .positions import overlay_positions
+
+
+class DriverGridIndex:
+    """
+    In-process spatial index of available drivers.
+
+    Drivers are bucketed into fixed-size lat/lng grid cells so a nearest
+    driver lookup only has to look at the cells around the pickup point
+    instead of the whole fleet. The index is kept current by the Driver
+    signals in ``drivers.signals`` and is rebuilt from the database every
+    ``DRIVER_INDEX_REFRESH_SECONDS`` to pick up changes made by other
+    processes. Callers must still confirm a candidate against the database
+    before assigning it.
+    """
+
+    def __init__(self, cell_deg=0.02, refresh_seconds=60):
+        self.cell_deg = cell_deg
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.RLock()
+        self._cells = {}
+        self._positions = {}
+        self._loaded_at = None
+
+    def __len__(self):
+        return len(self._positions)
+
+    def cell_for(self, lat, lng):
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def upsert(self, driver_id, lat, lng):
+        lat, lng = float(lat), float(lng)
+        cell = self.cell_for(lat, lng)
+        with self._lock:
+            previous = self._positions.get(driver_id)
+            if previous is not None and previous[2] != cell:
+                self._discard_from_cell(driver_id, previous[2])
+            self._cells.setdefault(cell, set()).add(driver_id)
+            self._positions[driver_id] = (lat, lng, cell)
+
+    def move(self, driver_id, lat, lng):
+        """Update the position of a driver only if it is already indexed"""
+        with self._lock:
+            if driver_id in self._positions:
+                self.upsert(driver_id, lat, lng)
+
+    def remove(self, driver_id):
+        with self._lock:
+            previous = self._positions.pop(driver_id, None)
+            if previous is not None:
+                self._discard_from_cell(driver_id, previous[2])
+
+    def _discard_from_cell(self, driver_id, cell):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(driver_id)
+            if not members:
+                del self._cells[cell]
+
+    def clear(self):
+        with self._lock:
+            self._cells.clear()
+            self._positions.clear()
+            self._loaded_at = None
+
+    def rebuild(self, rows):
+        """Replace the index contents with ``(driver_id, lat, lng)`` rows"""
+        cells = {}
+        positions = {}
+        for driver_id, lat, lng in rows:
+            lat, lng = float(lat), float(lng)
+            cell = self.cell_for(lat, lng)
+            cells.setdefault(cell, set()).add(driver_id)
+            positions[driver_id] = (lat, lng, cell)
+        with self._lock:
+            self._cells = cells
+            self._positions = positions
+            self._loaded_at = time.monotonic()
+
+    def ensure_loaded(self):
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > self.refresh_seconds:
+            self.rebuild(overlay_positions(
+                Driver.objects.filter(
+                    status='available',
+                    is_active=True,
+                    location_lat__isnull=False,
+                    location_lng__isnull=False,
+                ).values_list('id', 'location_lat', 'location_lng')
+            ))
+
+    def _ring_cells(self, center, radius):
+        ci, cj = center
+        if radius == 0:
+            yield center
+            return
+        for j in range(cj - radius, cj + radius + 1):
+            yield (ci - radius, j)
+            yield (ci + radius, j)
+        for i in range(ci - radius + 1, ci + radius):
+            yield (i, cj - radius)
+            yield (i, cj + radius)
+
+    def _ring_gap_km(self, lat, ring):
+        """Lower bound on the distance from the query point to cells in ``ring``"""
+        if ring == 0:
+            return 0.0
+        edge_lat = min(89.0, abs(lat) + ring * self.cell_deg)
+        return (ring - 1) * self.cell_deg * KM_PER_DEGREE * math.cos(math.radians(edge_lat))
+
+    def nearest(self, lat, lng, k=1, max_distance_km=None):
+        """
+        Return up to ``k`` ``(driver_id, distance_km)`` pairs ordered by
+        distance, searching outwards ring by ring from the query cell.
+        """
+        lat, lng = float(lat), float(lng)
+        best = []  # max-heap of (-distance, driver_id)
+
+        def consider(driver_id):
+            p_lat, p_lng, _ = self._positions[driver_id]
+            distance = haversine_km(lat, lng, p_lat, p_lng)
+            if max_distance_km is not None and distance > max_distance_km:
+                return
+            if len(best) < k:
+                heapq.heappush(best, (-distance, driver_id))
+            elif distance < -best[0][0]:
+                heapq.heapreplace(best, (-distance, driver_id))
+
+        with self._lock:
+            if not self._positions or k <= 0:
+                return []
+
+            center = self.cell_for(lat, lng)
+            cells_visited = 0
+            ring = 0
+            while True:
+                gap = self._ring_gap_km(lat, ring)
+                if max_distance_km is not None and gap > max_distance_km:
+                    break
+                if len(best) == k and gap > -best[0][0]:
+                    break
+                if cells_visited > len(self._cells):
+                    # Sparse fleet: scanning the occupied cells directly is
+                    # cheaper than walking any more empty rings.
+                    for (i, j), members in self._cells.items():
+                        if max(abs(i - center[0]), abs(j - center[1])) >= ring:
+                            for driver_id in members:
+                                consider(driver_id)
+                    break
+                for cell in self._ring_cells(center, ring):
+                    cells_visited += 1
+                    for driver_id in self._cells.get(cell, ()):
+                        consider(driver_id)
+                ring += 1
+
+        return [(driver_id, -neg_distance) for neg_distance, driver_id in sorted(best, reverse=True)]
+
+
+driver_index = DriverGridIndex(
+    cell_deg=getattr(settings, 'DRIVER_INDEX_CELL_DEG', 0.02),
+    refresh_seconds=getattr(settings, 'DRIVER_INDEX_REFRESH_SECONDS', 60),
+)
+
+
+def query_nearest_available_drivers(lat, lng, limit=1, max_distance_km=None):
+    """
+    Database-backed nearest driver lookup. A lat/lng bounding box (served
+    by the ``driver_avail_lat_lng_idx`` index) keeps implausible drivers out
+    of the fetch, and the remaining candidates are scored in one vectorised
+    haversine pass.
+    """
+    queryset = Driver.objects.filter(
+        status='available',
+        is_active=True,
+        location_lat__isnull=False,
+        location_lng__isnull=False,
+    )
+    if max_distance_km is not None:
+        min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, max_distance_km)
+        queryset = queryset.filter(
+            location_lat__range=(min_lat, max_lat),
+            location_lng__range=(min_lng, max_lng),
+        )
+
+    rows = overlay_positions(queryset.values_list('id', 'location_lat', 'location_lng'))
+    if not rows or limit <= 0:
+        return []
+
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    lats = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+    lngs = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+    distances = haversine_km_many(lat, lng, lats, lngs)
+
+    if max_distance_km is not None:
+        within = distances <= max_distance_km
+        ids, distances = ids[within], distances[within]
+    if len(ids) > limit:
+        nearest = np.argpartition(distances, limit - 1)[:limit]
+        ids, distances = ids[nearest], distances[nearest]
+    order = np.argsort(distances, kind='stable')
+    return [(int(ids[i]), float(distances[i])) for i in order]
+
+
+def find_nearest_available_drivers(lat, lng, limit=1, max_distance_km=None):
+    """
+    Return ``(driver_id, distance_km)`` pairs for the nearest available
+    drivers to the given point, closest first.
+    """
+    if not getattr(settings, 'DRIVER_SPATIAL_INDEX_ENABLED', True):
+        return query_nearest_available_drivers(lat, lng, limit, max_distance_km)
+    driver_index.ensure_loaded()
+    return driver_index.nearest(lat, lng, k=limit, max_distance_km=max_distance_km)
@@ -1,3 +1,298 @@
-from django.test import TestCase
+import random
+import time
+from fnmatch import fnmatch
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from .geo import bounding_box, haversine_km, haversine_km_many
+from .models import Driver, Vehicle
+from .positions import (
+    InMemoryPositionStore, RedisPositionStore, get_position_store, persist_pending_positions, record_position
+)
+from .views import NearbyDriversView
+from .spatial import (
+    DriverGridIndex, driver_index, find_nearest_available_drivers, query_nearest_available_drivers
+)
+
+User = get_user_model()
+
+
+def create_driver(n, lat=None, lng=None, status='available'):
+    user = User.objects.create_user(
+        email=f'driver{n}@example.com',
+        username=f'driver{n}@example.com',
+        password='testpassword123',
+        first_name='Driver',
+        last_name=str(n),
+        user_type='driver'
+    )
+    return Driver.objects.create(
+        user=user,
+        license_number=f'LIC{n}',
+        vehicle_make='Toyota',
+        vehicle_model='Hilux',
+        vehicle_year=2018,
+        vehicle_color='White',
+        vehicle_plate_number=f'PLATE{n}',
+        status=status,
+        location_lat=lat,
+        location_lng=lng
+    )
+
+
+class DriverGridIndexTestCase(TestCase):
+    def test_nearest_matches_brute_force(self):
+        """Ring search returns the same drivers as scanning every driver"""
+        rng = random.Random(42)
+        index = DriverGridIndex(cell_deg=0.02)
+        points = {}
+        for driver_id in range(2000):
+            lat = -25.5 + rng.random()
+            lng = 28.0 + rng.random()
+            points[driver_id] = (lat, lng)
+            index.upsert(driver_id, lat, lng)
+
+        for _ in range(20):
+            lat = -25.5 + rng.random()
+            lng = 28.0 + rng.random()
+            expected = sorted(
+                (haversine_km(lat, lng, p_lat, p_lng), driver_id)
+                for driver_id, (p_lat, p_lng) in points.items()
+            )[:5]
+            result = index.nearest(lat, lng, k=5)
+            self.assertEqual([driver_id for driver_id, _ in result],
+                             [driver_id for _, driver_id in expected])
+
+    def test_sparse_fleet_and_radius(self):
+        index = DriverGridIndex(cell_deg=0.02)
+        index.upsert(1, -25.0, 28.0)
+        index.upsert(2, -22.0, 30.0)
+
+        self.assertEqual(index.nearest(-22.1, 30.1, k=1)[0][0], 2)
+        self.assertEqual([d for d, _ in index.nearest(-25.0, 28.0, k=5)], [1, 2])
+        self.assertEqual([d for d, _ in index.nearest(-25.0, 28.0, k=5, max_distance_km=50)], [1])
+
+    def test_move_and_remove(self):
+        index = DriverGridIndex(cell_deg=0.02)
+        index.upsert(1, -25.0, 28.0)
+        index.move(1, -24.0, 28.0)
+        index.move(2, -24.0, 28.0)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.nearest(-24.0, 28.0)[0][0], 1)
+
+        index.remove(1)
+        self.assertEqual(index.nearest(-24.0, 28.0), [])
+
+
+class DriverIndexSignalsTestCase(TestCase):
+    def setUp(self):
+        driver_index.clear()
+
+    def test_index_follows_driver_status_and_location(self):
+        driver = create_driver(1, lat=-25.0, lng=28.0)
+        self.assertEqual(driver_index.nearest(-25.0, 28.0)[0][0], driver.id)
+
+        driver.location_lat = -24.0
+        driver.save()
+        self.assertEqual(driver_index.nearest(-25.0, 28.0, max_distance_km=10), [])
+        self.assertEqual(driver_index.nearest(-24.0, 28.0)[0][0], driver.id)
+
+        driver.status = 'offline'
+        driver.save()
+        self.assertEqual(len(driver_index), 0)
+
+
+class GeoTestCase(TestCase):
+    def test_vectorised_haversine_matches_scalar(self):
+        rng = random.Random(7)
+        lats = [-26.0 + rng.random() * 2 for _ in range(100)]
+        lngs = [27.0 + rng.random() * 2 for _ in range(100)]
+
+        distances = haversine_km_many(-25.0, 28.0, lats, lngs)
+
+        for distance, lat, lng in zip(distances, lats, lngs):
+            self.assertAlmostEqual(distance, haversine_km(-25.0, 28.0, lat, lng), places=6)
+
+    def test_bounding_box_encloses_radius(self):
+        min_lat, max_lat, min_lng, max_lng = bounding_box(-25.0, 28.0, 10)
+
+        self.assertAlmostEqual(haversine_km(-25.0, 28.0, max_lat, 28.0), 10, places=3)
+        self.assertGreaterEqual(haversine_km(-25.0, 28.0, -25.0, max_lng), 10)
+        self.assertGreaterEqual(haversine_km(-25.0, 28.0, -25.0, min_lng), 10)
+
+
+class QueryNearestDriversTestCase(TestCase):
+    def test_bounding_box_query_orders_by_distance(self):
+        near = create_driver(1, lat='-25.010000', lng='28.000000')
+        far = create_driver(2, lat='-25.100000', lng='28.000000')
+        create_driver(3, lat='-26.000000', lng='28.000000')
+        create_driver(4, lat='-25.001000', lng='28.000000', status='offline')
+
+        result = query_nearest_available_drivers(-25.0, 28.0, limit=5, max_distance_km=20)
+
+        self.assertEqual([driver_id for driver_id, _ in result], [near.id, far.id])
+        self.assertAlmostEqual(result[0][1], 1.112, places=2)
+        self.assertEqual(len(query_nearest_available_drivers(-25.0, 28.0, limit=5)), 3)
+
+
+class NearbyDriversViewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        driver_index.clear()
+        self.passenger = User.objects.create_user(
+            email='passenger@example.com',
+            username='passenger@example.com',
+            password='testpassword123'
+        )
+
+    def get(self, **params):
+        request = APIRequestFactory().get('/api/drivers/nearby/', params)
+        force_authenticate(request, user=self.passenger)
+        return NearbyDriversView.as_view()(request)
+
+    def test_returns_k_nearest_slim_projection(self):
+        near = create_driver(1, lat='-25.010000', lng='28.000000')
+        Vehicle.objects.create(
+            driver=near, make='Honda', model='Ace', year=2020, color='Red',
+            plate_number='MOTO1', vehicle_type='motorcycle', insurance_number='INS1',
+            insurance_expiry_date='2030-01-01', registration_number='REG1',
+            registration_expiry_date='2030-01-01'
+        )
+        middle = create_driver(2, lat='-25.030000', lng='28.000000')
+        create_driver(3, lat='-25.050000', lng='28.000000')
+        create_driver(4, lat='-26.000000', lng='28.000000')
+
+        response = self.get(lat='-25.0', lng='28.0', radius_km='10', limit='2')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([driver['id'] for driver in response.data], [near.id, middle.id])
+        self.assertEqual(
+            set(response.data[0]),
+            {'id', 'latitude', 'longitude', 'vehicle_type', 'last_location_update', 'distance'}
+        )
+        self.assertEqual(response.data[0]['vehicle_type'], 'motorcycle')
+
+    def test_repeated_requests_in_cell_are_cached(self):
+        create_driver(1, lat='-25.010000', lng='28.000000')
+        self.get(lat='-25.005', lng='28.005')
+
+        with self.assertNumQueries(0):
+            response = self.get(lat='-25.006', lng='28.006')
+        self.assertEqual(len(response.data), 1)
+
+    def test_nearest_to_point_not_to_cell_centre(self):
+        # A crowd at the centre of the passenger's cell, a few drivers by the
+        # passenger near its corner
+        cell_i, cell_j = driver_index.cell_for(-25.0, 28.0)
+        cell_deg = driver_index.cell_deg
+        center_lat, center_lng = (cell_i + 0.5) * cell_deg, (cell_j + 0.5) * cell_deg
+        corner_lat, corner_lng = cell_i * cell_deg + 0.001, cell_j * cell_deg + 0.001
+        for n in range(10):
+            create_driver(n + 1, lat=f'{center_lat:.6f}', lng=f'{center_lng:.6f}')
+        close = [
+            create_driver(n + 11, lat=f'{corner_lat + 0.0005 * n:.6f}', lng=f'{corner_lng:.6f}')
+            for n in range(3)
+        ]
+
+        response = self.get(lat=f'{corner_lat:.6f}', lng=f'{corner_lng:.6f}', limit='3')
+        self.assertEqual({driver['id'] for driver in response.data}, {driver.id for driver in close})
+
+        with override_settings(NEARBY_DRIVERS_CELL_CANDIDATES=5):
+            cache.clear()
+            response = self.get(lat=f'{corner_lat:.6f}', lng=f'{corner_lng:.6f}', limit='3')
+        self.assertEqual({driver['id'] for driver in response.data}, {driver.id for driver in close})
+
+    def test_requires_coordinates(self):
+        self.assertEqual(self.get(lng='28.0').status_code, 400)
+        self.assertEqual(self.get(lat='abc', lng='28.0').status_code, 400)
+
+
+class StandInRedis:
+    """The handful of Redis commands RedisPositionStore uses, kept in memory"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.keys = {}
+
+    def hset(self, name, mapping):
+        self.hashes.setdefault(name, {}).update({str(k): str(v).encode() for k, v in mapping.items()})
+
+    def hmget(self, name, keys):
+        values = self.hashes.get(name, {})
+        return [values.get(str(key)) for key in keys]
+
+    def hdel(self, name, key):
+        self.hashes.get(name, {}).pop(str(key), None)
+
+    def delete(self, *names):
+        for name in names:
+            self.hashes.pop(name, None)
+            self.keys.pop(name, None)
+
+    def scan_iter(self, match, count=None):
+        return [name for name in list(self.hashes) + list(self.keys) if fnmatch(name, match)]
+
+    def set(self, name, value, nx=False, px=None):
+        if nx and name in self.keys:
+            return None
+        self.keys[name] = value
+        return True
+
+
+class PositionStoreTestCase(TestCase):
+    def setUp(self):
+        driver_index.clear()
+        get_position_store().clear()
+        self.addCleanup(get_position_store().clear)
+
+    def test_backends_round_trip_and_throttle(self):
+        ts = timezone.now()
+        for store in (InMemoryPositionStore(), RedisPositionStore(client=StandInRedis())):
+            with self.subTest(store=type(store).__name__):
+                store.set(7, '-25.000001', '28.000002', ts)
+                store.set_many({8: (-25.5, 28.5, ts)})
+                self.assertEqual(store.get(7), (-25.000001, 28.000002, ts))
+                self.assertEqual(set(store.get_many([7, 8, 9])), {7, 8})
+                self.assertTrue(store.claim_persist(7, 60))
+                self.assertFalse(store.claim_persist(7, 60))
+                self.assertTrue(store.claim_persist(8, 60))
+                store.remove(7)
+                self.assertIsNone(store.get(7))
+                store.clear()
+                self.assertIsNone(store.get(8))
+                self.assertTrue(store.claim_persist(8, 60))
+
+    @mock.patch('drivers.positions.threading.Timer')
+    def test_persistence_is_throttled_and_narrow(self, timer):
+        driver = create_driver(1, lat='-25.000000', lng='28.000000')
+        updated_at = driver.updated_at
+
+        with self.assertNumQueries(1):
+            self.assertEqual(record_position(driver.id, -25.01, 28.0), 1)
+        self.assertEqual(record_position(driver.id, -25.02, 28.0), 0)
+        self.assertEqual(timer.call_args[0][0], 15)
+
+        driver.refresh_from_db()
+        self.assertEqual(str(driver.location_lat), '-25.010000')
+        self.assertEqual(driver.updated_at, updated_at)
+        self.assertEqual(driver.status, 'available')
+        # Reads see the latest position, not the persisted one
+        self.assertEqual(get_position_store().get(driver.id)[:2], (-25.02, 28.0))
+        self.assertAlmostEqual(driver_index.nearest(-25.02, 28.0)[0][1], 0)
+        with override_settings(DRIVER_SPATIAL_INDEX_ENABLED=False):
+            self.assertAlmostEqual(find_nearest_available_drivers(-25.02, 28.0, max_distance_km=5)[0][1], 0)
+
+        # The trailing write still lands the throttled last position, once
+        # the throttle window is over
+        self.assertEqual(persist_pending_positions(), 0)
+        self.assertEqual(timer.call_count, 2)
+        with mock.patch('drivers.positions.time.monotonic', return_value=time.monotonic() + 60):
+            self.assertEqual(persist_pending_positions(), 1)
+        driver.refresh_from_db()
+        self.assertEqual(str(driver.location_lat), '-25.020000')
+        self.assertEqual(persist_pending_positions(), 0)
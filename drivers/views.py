@@ -4,8 +4,13 @@ from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from django.shortcuts import get_object_or_404
 from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core.cache import cache
 from .models import Driver, Vehicle
-from .serializers import DriverSerializer, VehicleSerializer
+from .serializers import DriverSerializer, VehicleSerializer, NearbyDriverSerializer
+from .geo import KM_PER_DEGREE, haversine_km
+from .positions import get_position_store
+from .spatial import driver_index, find_nearest_available_drivers
 from accounts.serializers import UserSerializer
 
 User = get_user_model()
@@ -34,6 +39,121 @@ class AvailableDriversView(generics.ListAPIView):
     def get_queryset(self):
         return Driver.objects.filter(status='available', is_active=True)
 
+class NearbyDriversView(APIView):
+    """
+    The k nearest available drivers around a point, for passenger maps.
+
+    Candidates are computed once per spatial index grid cell and cached for
+    NEARBY_DRIVERS_CACHE_SECONDS, so map refreshes from passengers in the
+    same area only re-rank a handful of cached rows.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        try:
+            lat = float(request.query_params['lat'])
+            lng = float(request.query_params['lng'])
+            radius_km = float(request.query_params.get('radius_km', 10))
+            limit = int(request.query_params.get('limit', 10))
+        except (KeyError, ValueError):
+            return Response(
+                {'error': 'lat and lng are required; radius_km and limit must be numbers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180) or radius_km <= 0 or limit <= 0:
+            return Response(
+                {'error': 'Invalid lat, lng, radius_km or limit'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        radius_km = min(radius_km, getattr(settings, 'NEARBY_DRIVERS_MAX_RADIUS_KM', 50))
+        limit = min(limit, getattr(settings, 'NEARBY_DRIVERS_MAX_LIMIT', 50))
+
+        candidates, center, covered_km = self.get_cell_candidates(lat, lng, radius_km)
+        drivers = self.rank(lat, lng, radius_km, candidates)
+
+        # The cell's set holds every driver within covered_km of its centre.
+        # If that does not reach far enough around this point to settle the
+        # k nearest, ask the index directly instead.
+        offset_km = haversine_km(lat, lng, center[0], center[1])
+        if covered_km < radius_km + offset_km and (
+            len(drivers) < limit or drivers[limit - 1]['distance'] > covered_km - offset_km
+        ):
+            drivers = self.rank(lat, lng, radius_km, self.load_candidates(lat, lng, radius_km, limit)[0])
+
+        serializer = NearbyDriverSerializer(drivers[:limit], many=True)
+        return Response(serializer.data)
+
+    def rank(self, lat, lng, radius_km, candidates):
+        """Candidates within ``radius_km`` of the point, closest first"""
+        # Cached rows may lag behind the drivers; rank on their latest positions
+        positions = get_position_store().get_many([driver['id'] for driver in candidates])
+        drivers = []
+        for driver in candidates:
+            if driver['id'] in positions:
+                latitude, longitude, timestamp = positions[driver['id']]
+                driver = dict(driver, latitude=latitude, longitude=longitude, last_location_update=timestamp)
+            distance = haversine_km(lat, lng, driver['latitude'], driver['longitude'])
+            if distance <= radius_km:
+                drivers.append(dict(driver, distance=round(distance, 2)))
+        drivers.sort(key=lambda driver: driver['distance'])
+        return drivers
+
+    def get_cell_candidates(self, lat, lng, radius_km):
+        """
+        Every available driver within ``radius_km`` plus the cell diagonal
+        of the centre of the point's grid cell, cached per cell, so one set
+        serves any point in the cell and any ``limit``. Returns the
+        candidates, the centre and how far from it the set is complete.
+        """
+        cell_deg = driver_index.cell_deg
+        cell_i, cell_j = driver_index.cell_for(lat, lng)
+        cache_key = f'nearby_drivers:{cell_i}:{cell_j}:{radius_km:g}'
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        center = ((cell_i + 0.5) * cell_deg, (cell_j + 0.5) * cell_deg)
+        candidates, covered_km = self.load_candidates(
+            center[0],
+            center[1],
+            radius_km + cell_deg * KM_PER_DEGREE * 2 ** 0.5,
+            getattr(settings, 'NEARBY_DRIVERS_CELL_CANDIDATES', 500)
+        )
+        cached = (candidates, center, covered_km)
+        cache.set(cache_key, cached, getattr(settings, 'NEARBY_DRIVERS_CACHE_SECONDS', 5))
+        return cached
+
+    def load_candidates(self, lat, lng, max_distance_km, limit):
+        """
+        Up to ``limit`` available drivers nearest the point within
+        ``max_distance_km``, and the distance up to which none was left out.
+        """
+        nearest = find_nearest_available_drivers(lat, lng, limit=limit, max_distance_km=max_distance_km)
+        covered_km = nearest[-1][1] if len(nearest) >= limit else max_distance_km
+
+        ids = [driver_id for driver_id, _ in nearest]
+        vehicle_types = dict(
+            Vehicle.objects.filter(driver_id__in=ids, is_active=True)
+            .order_by('created_at')
+            .values_list('driver_id', 'vehicle_type')
+        )
+        candidates = [
+            {
+                'id': row['id'],
+                'latitude': float(row['location_lat']),
+                'longitude': float(row['location_lng']),
+                'vehicle_type': vehicle_types.get(row['id']),
+                'last_location_update': row['last_location_update'],
+            }
+            for row in Driver.objects.filter(
+                id__in=ids,
+                status='available',
+                is_active=True
+            ).values('id', 'location_lat', 'location_lng', 'last_location_update')
+        ]
+        return candidates, covered_km
+
 class DriverProfileView(APIView):
     permission_classes = [IsAuthenticated]
 
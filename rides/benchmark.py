@@ -0,0 +1,340 @@
+import heapq
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection, reset_queries
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from core import metrics
+from core.models import Notification
+from core.wire import LocationEncoder, location_json
+from drivers.models import Driver
+from drivers.spatial import driver_index, find_nearest_available_drivers
+from .matching import BatchMatcher
+from .models import Ride, RideRequest
+from .views import AcceptRideView, RequestRideView
+
+User = get_user_model()
+
+MODES = ('immediate', 'accept', 'batch')
+
+# South-west corner and size in degrees of the synthetic region (~200 km across)
+REGION_LAT, REGION_LNG, REGION_DEG = -26.0, 27.0, 2.0
+
+# Tables of the notification delivery bookkeeping (outbox and event replay)
+DELIVERY_TABLES = ('"core_outboxmessage"', '"core_eventsequence"', '"core_userevent"')
+
+# Simulated location frames sent per matched ride, one every few seconds
+LOCATION_FRAME_SECONDS = 5
+MAX_LOCATION_FRAMES = 120
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q / 100 * len(values)), len(values) - 1)]
+
+
+def summarize(values):
+    return {
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+class MatchingBenchmark:
+    """
+    Replays a Poisson ride-request arrival process against a synthetic
+    rural fleet and records, per request, the wall-clock match latency, the
+    number of DB queries and the number of notifications it caused.
+
+    Drivers are clustered around a handful of villages with the rest
+    scattered over the region. Time is simulated: each matched driver is
+    released at the drop-off point ``trip_minutes`` of simulated time later,
+    so the fleet utilisation follows the arrival ``rate``.
+
+    Modes:
+
+    * ``immediate``: ``RequestRideView`` assigns the nearest driver itself.
+    * ``accept``: the request only notifies drivers and the nearest one
+      accepts through ``AcceptRideView``; both calls count towards the match.
+    * ``batch``: requests are matched by ``BatchMatcher`` every
+      ``batch_window`` simulated seconds; each round's cost is shared
+      between the requests it matched.
+
+    Every matched ride also streams a simulated track of driver location
+    frames, encoded both as JSON text frames and as binary frames of the
+    location subprotocol, to compare the bytes sent per update.
+
+    Must run against a disposable database, with the in-memory channel
+    layer and inline outbox delivery (see the bench_matching command).
+    """
+
+    def __init__(self, drivers=500, requests=200, rate=0.5, trip_minutes=30,
+                 villages=8, mode='immediate', batch_window=2.0, seed=1):
+        if mode not in MODES:
+            raise ValueError(f'Unknown benchmark mode {mode!r}')
+        self.drivers = drivers
+        self.requests = requests
+        self.rate = rate
+        self.trip_seconds = trip_minutes * 60
+        self.villages = villages
+        self.mode = mode
+        self.batch_window = batch_window
+        self.rng = random.Random(seed)
+        # A separate stream, so the simulated tracks do not change the arrivals
+        self.track_rng = random.Random(seed)
+        self.factory = APIRequestFactory()
+
+    def random_point(self, centres):
+        """A point near one of ``centres``, or anywhere in the region"""
+        if centres and self.rng.random() < 0.7:
+            lat, lng = self.rng.choice(centres)
+            lat += self.rng.gauss(0, 0.05)
+            lng += self.rng.gauss(0, 0.05)
+        else:
+            lat = REGION_LAT + self.rng.random() * REGION_DEG
+            lng = REGION_LNG + self.rng.random() * REGION_DEG
+        return round(lat, 6), round(lng, 6)
+
+    def populate(self):
+        self.centres = [
+            (REGION_LAT + self.rng.random() * REGION_DEG, REGION_LNG + self.rng.random() * REGION_DEG)
+            for _ in range(self.villages)
+        ]
+        password = make_password(None)
+
+        driver_users = User.objects.bulk_create([
+            User(
+                username=f'bench-driver{n}@example.com',
+                email=f'bench-driver{n}@example.com',
+                password=password,
+                first_name='Driver',
+                last_name=str(n),
+                user_type='driver'
+            )
+            for n in range(self.drivers)
+        ])
+        drivers = []
+        for n, user in enumerate(driver_users):
+            lat, lng = self.random_point(self.centres)
+            drivers.append(Driver(
+                user=user,
+                license_number=f'BENCH{n}',
+                vehicle_make='Toyota',
+                vehicle_model='Hilux',
+                vehicle_year=2018,
+                vehicle_color='White',
+                vehicle_plate_number=f'BENCH{n}',
+                status='available',
+                location_lat=lat,
+                location_lng=lng
+            ))
+        Driver.objects.bulk_create(drivers)
+
+        self.passengers = User.objects.bulk_create([
+            User(
+                username=f'bench-passenger{n}@example.com',
+                email=f'bench-passenger{n}@example.com',
+                password=password,
+                first_name='Passenger',
+                last_name=str(n),
+                user_type='passenger'
+            )
+            for n in range(self.requests)
+        ])
+
+        # bulk_create bypasses the Driver signals, so load the index afresh
+        driver_index.clear()
+
+    def run(self):
+        self.populate()
+        self.samples = []
+        self.frame_bytes = {'json': [], 'binary': []}
+        self.busy = []  # heap of (free_at, ride_id)
+        self.pending = []  # batch mode: (sample, passenger_id) awaiting a round
+        self.next_round = self.batch_window
+        matcher = BatchMatcher() if self.mode == 'batch' else None
+
+        clock = 0.0
+        started = time.perf_counter()
+        for passenger in self.passengers:
+            clock += self.rng.expovariate(self.rate)
+            self.release_drivers(clock)
+            if matcher is not None:
+                while self.next_round <= clock:
+                    self.run_round(matcher)
+                    self.next_round += self.batch_window
+
+            pickup = self.random_point(self.centres)
+            destination = self.random_point([pickup])
+            self.request_ride(passenger, pickup, destination, clock)
+
+        if matcher is not None:
+            self.run_round(matcher)
+        elapsed = time.perf_counter() - started
+        driver_index.clear()
+        return self.report(elapsed)
+
+    def measure(self, call):
+        """
+        Run ``call`` and return (result, latency ms, queries, delivery
+        queries, notifications, pushes). Delivery queries are the part of
+        the queries spent on the outbox and event numbering, which run
+        inline after commit here but on the dispatcher in production.
+        """
+        enqueued = metrics.counter('outbox.enqueued')
+        notifications_before = Notification.objects.count()
+        pushes_before = enqueued.value
+        # The query log is a bounded deque; keep it from filling up
+        reset_queries()
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            result = call()
+            latency_ms = (time.perf_counter() - start) * 1000
+        delivery_queries = sum(
+            1 for query in context.captured_queries
+            if any(table in query['sql'] for table in DELIVERY_TABLES)
+        )
+        return (
+            result,
+            latency_ms,
+            len(context.captured_queries),
+            delivery_queries,
+            Notification.objects.count() - notifications_before,
+            enqueued.value - pushes_before,
+        )
+
+    def post(self, view, user, data):
+        request = self.factory.post('/', data, format='json')
+        force_authenticate(request, user=user)
+        return view(request)
+
+    def request_ride(self, passenger, pickup, destination, clock):
+        data = {
+            'pickup_address': 'Farm road',
+            'pickup_lat': f'{pickup[0]:.6f}',
+            'pickup_lng': f'{pickup[1]:.6f}',
+            'destination_address': 'Town clinic',
+            'destination_lat': f'{destination[0]:.6f}',
+            'destination_lng': f'{destination[1]:.6f}',
+        }
+        mode = 'immediate' if self.mode == 'immediate' else 'batch'
+        with override_settings(RIDE_MATCHING_MODE=mode):
+            response, latency_ms, queries, delivery_queries, notifications, pushes = self.measure(
+                lambda: self.post(RequestRideView.as_view(), passenger, data)
+            )
+        sample = {
+            'latency_ms': latency_ms,
+            'queries': queries,
+            'delivery_queries': delivery_queries,
+            'notifications': notifications,
+            'pushes': pushes,
+            'matched': False,
+        }
+        self.samples.append(sample)
+        ride_request_id = response.data['id']
+
+        if self.mode == 'batch':
+            self.pending.append((sample, passenger.id))
+            return
+
+        if self.mode == 'accept':
+            nearest = find_nearest_available_drivers(pickup[0], pickup[1], limit=1)
+            if nearest:
+                driver = Driver.objects.select_related('user').get(id=nearest[0][0])
+                response, latency_ms, queries, delivery_queries, notifications, pushes = self.measure(
+                    lambda: self.post(AcceptRideView.as_view(), driver.user, {'ride_request_id': ride_request_id})
+                )
+                sample['latency_ms'] += latency_ms
+                sample['queries'] += queries
+                sample['delivery_queries'] += delivery_queries
+                sample['notifications'] += notifications
+                sample['pushes'] += pushes
+
+        ride = Ride.objects.filter(passenger=passenger, status='accepted').first()
+        if ride is not None:
+            sample['matched'] = True
+            self.stream_locations(ride)
+            heapq.heappush(self.busy, (clock + self.trip_seconds, ride.id))
+
+    def run_round(self, matcher):
+        if not self.pending:
+            return
+        rides, latency_ms, queries, delivery_queries, notifications, pushes = self.measure(matcher.run_once)
+        matched = {ride.passenger_id for ride in rides}
+        # Requests left unmatched by this round wait for the next one
+        still_pending = []
+        share = max(len(rides), 1)
+        for sample, passenger_id in self.pending:
+            if passenger_id in matched:
+                sample['matched'] = True
+                sample['latency_ms'] += latency_ms / share
+                sample['queries'] += queries / share
+                sample['delivery_queries'] += delivery_queries / share
+                sample['notifications'] += notifications / share
+                sample['pushes'] += pushes / share
+            else:
+                still_pending.append((sample, passenger_id))
+        self.pending = still_pending
+        for ride in rides:
+            self.stream_locations(ride)
+            heapq.heappush(self.busy, (self.next_round + self.trip_seconds, ride.id))
+
+    def stream_locations(self, ride):
+        """Encode a jittered pickup to destination track of ``ride`` both ways and record the frame sizes"""
+        frames = max(min(int(self.trip_seconds / LOCATION_FRAME_SECONDS), MAX_LOCATION_FRAMES), 2)
+        start_lat, start_lng = float(ride.pickup_lat), float(ride.pickup_lng)
+        end_lat, end_lng = float(ride.destination_lat), float(ride.destination_lng)
+        encoder = LocationEncoder()
+        for step in range(frames):
+            progress = step / (frames - 1)
+            # GPS noise of a few metres
+            lat = round(start_lat + (end_lat - start_lat) * progress + self.track_rng.gauss(0, 0.00003), 6)
+            lng = round(start_lng + (end_lng - start_lng) * progress + self.track_rng.gauss(0, 0.00003), 6)
+            # Driver frames carry the ETA to the destination
+            eta_seconds = (frames - 1 - step) * LOCATION_FRAME_SECONDS
+            self.frame_bytes['json'].append(len(location_json(ride.id, lat, lng, eta_seconds).encode()))
+            self.frame_bytes['binary'].append(len(encoder.encode(ride.id, lat, lng, eta_seconds)))
+
+    def release_drivers(self, clock):
+        """Complete the rides due by ``clock`` and free their drivers at the drop-off"""
+        finished = []
+        while self.busy and self.busy[0][0] <= clock:
+            finished.append(heapq.heappop(self.busy)[1])
+        if not finished:
+            return
+        for ride in Ride.objects.filter(id__in=finished).select_related('driver'):
+            ride.status = 'completed'
+            ride.save(update_fields=['status'])
+            driver = ride.driver
+            driver.status = 'available'
+            driver.location_lat = ride.destination_lat
+            driver.location_lng = ride.destination_lng
+            driver.save()
+
+    def report(self, elapsed):
+        matched = [sample for sample in self.samples if sample['matched']]
+        return {
+            'mode': self.mode,
+            'drivers': self.drivers,
+            'requests': len(self.samples),
+            'matched': len(matched),
+            'still_open': RideRequest.objects.filter(status='active').count(),
+            'elapsed_seconds': elapsed,
+            'latency_ms': summarize([sample['latency_ms'] for sample in matched]),
+            'queries_per_request': summarize([sample['queries'] for sample in self.samples]),
+            'delivery_queries_per_request': summarize([sample['delivery_queries'] for sample in self.samples]),
+            'notifications_per_request': summarize([sample['notifications'] for sample in self.samples]),
+            'pushes_per_request': summarize([sample['pushes'] for sample in self.samples]),
+            'json_bytes_per_update': summarize(self.frame_bytes['json']),
+            'binary_bytes_per_update': summarize(self.frame_bytes['binary']),
+        }
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from core.services import notify_passengers_requests_expired
+from .models import RideRequest
+
+
+def expire_overdue_requests(now=None, batch_size=None):
+    """
+    Expire active ride requests whose ``expires_at`` has passed.
+
+    Works in bounded batches picked through the ``(status, expires_at)``
+    index, each expired with a single UPDATE and its passengers notified in
+    bulk, so one sweep never holds a long transaction. Returns the number
+    of requests expired.
+    """
+    now = now or timezone.now()
+    batch_size = batch_size or getattr(settings, 'RIDE_REQUEST_EXPIRY_BATCH_SIZE', 500)
+    total = 0
+
+    while True:
+        ids = list(
+            RideRequest.objects.filter(
+                status='active',
+                expires_at__lte=now
+            ).order_by('expires_at').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+
+        with transaction.atomic():
+            expired = RideRequest.objects.filter(id__in=ids, status='active').update(status='expired')
+            # Requests matched in the meantime were skipped by the update
+            notify_passengers_requests_expired(list(
+                RideRequest.objects.filter(id__in=ids, status='expired').only('id', 'passenger_id')
+            ))
+        total += expired
+
+        if len(ids) < batch_size:
+            break
+
+    return total
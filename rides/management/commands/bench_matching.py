@@ -0,0 +1,84 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.test.utils import setup_databases, teardown_databases
+
+from rides.benchmark import MODES, MatchingBenchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark ride matching against a synthetic rural fleet in a throwaway test database, '
+        'reporting match latency, queries and notifications per request and the bytes per location update'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drivers', type=int, default=500)
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--rate', type=float, default=0.5, help='Mean ride requests per simulated second')
+        parser.add_argument('--trip-minutes', type=float, default=30)
+        parser.add_argument('--villages', type=int, default=8)
+        parser.add_argument('--mode', choices=MODES, nargs='+', default=['immediate'])
+        parser.add_argument('--batch-window', type=float, default=2.0, help='Simulated seconds between batch rounds')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                OUTBOX_WORKERS=0
+            ):
+                for mode in options['mode']:
+                    result = MatchingBenchmark(
+                        drivers=options['drivers'],
+                        requests=options['requests'],
+                        rate=options['rate'],
+                        trip_minutes=options['trip_minutes'],
+                        villages=options['villages'],
+                        mode=mode,
+                        batch_window=options['batch_window'],
+                        seed=options['seed'],
+                    ).run()
+                    self.write_report(result)
+                    call_command('flush', interactive=False, verbosity=0)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def write_report(self, result):
+        self.stdout.write(
+            f"\nmode={result['mode']} drivers={result['drivers']} requests={result['requests']} "
+            f"matched={result['matched']} still_open={result['still_open']} "
+            f"elapsed={result['elapsed_seconds']:.1f}s"
+        )
+        self.stdout.write(f"{'':<26} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+        for label, key in (
+            ('match latency ms', 'latency_ms'),
+            ('queries / request', 'queries_per_request'),
+            ('  of which delivery', 'delivery_queries_per_request'),
+            ('notifications / request', 'notifications_per_request'),
+            ('pushes / request', 'pushes_per_request'),
+            ('JSON bytes / update', 'json_bytes_per_update'),
+            ('binary bytes / update', 'binary_bytes_per_update'),
+        ):
+            stats = result[key]
+            self.stdout.write(f"{label:<26} " + ' '.join(
+                f"{stats[name]:>9.2f}" if stats[name] is not None else f"{'-':>9}"
+                for name in ('mean', 'p50', 'p95', 'p99', 'max')
+            ))
+
+        queries = result['queries_per_request']['mean']
+        delivery = result['delivery_queries_per_request']['mean']
+        if queries:
+            self.stdout.write(
+                f"{delivery / queries * 100:.0f}% of the queries are outbox and event numbering "
+                f"bookkeeping, run inline after commit here and by the dispatcher in production"
+            )
+        json_bytes = result['json_bytes_per_update']['mean']
+        binary_bytes = result['binary_bytes_per_update']['mean']
+        if json_bytes:
+            self.stdout.write(
+                f"binary location frames save {json_bytes - binary_bytes:.1f} bytes per update "
+                f"({(1 - binary_bytes / json_bytes) * 100:.0f}% of the JSON payload)"
+            )
@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rides.expiry import expire_overdue_requests
+
+
+class Command(BaseCommand):
+    help = 'Expire overdue active ride requests and notify their passengers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=getattr(settings, 'RIDE_REQUEST_EXPIRY_BATCH_SIZE', 500)
+        )
+        parser.add_argument('--loop', action='store_true', help='Keep sweeping instead of exiting')
+        parser.add_argument('--interval', type=float, default=15, help='Seconds between sweeps with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            expired = expire_overdue_requests(batch_size=options['batch_size'])
+            if expired or not options['loop']:
+                self.stdout.write(f"Expired {expired} ride request(s)")
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
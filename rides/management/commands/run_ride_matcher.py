@@ -0,0 +1,33 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rides.matching import BatchMatcher
+
+
+class Command(BaseCommand):
+    help = 'Collect active ride requests in fixed windows and assign drivers with a global min-cost matching'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--window',
+            type=float,
+            default=getattr(settings, 'RIDE_BATCH_WINDOW_SECONDS', 2),
+            help='Seconds between matching rounds'
+        )
+        parser.add_argument('--once', action='store_true', help='Run a single matching round and exit')
+
+    def handle(self, *args, **options):
+        matcher = BatchMatcher()
+        window = options['window']
+
+        while True:
+            started = time.monotonic()
+            rides = matcher.run_once()
+            elapsed_ms = (time.monotonic() - started) * 1000
+            if rides or options['once']:
+                self.stdout.write(f"Matched {len(rides)} ride(s) in {elapsed_ms:.1f} ms")
+            if options['once']:
+                return
+            time.sleep(max(window - elapsed_ms / 1000, 0))
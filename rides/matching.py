@@ -0,0 +1,228 @@
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from core.services import notify_passengers_rides_accepted
+from drivers.models import Driver
+from drivers.spatial import driver_index
+from .models import Ride, RideRequest
+
+
+def build_ride(ride_request, driver):
+    """Return an unsaved accepted Ride for a matched ride request"""
+    return Ride(
+        passenger=ride_request.passenger,
+        driver=driver,
+        pickup_address=ride_request.pickup_address,
+        pickup_lat=ride_request.pickup_lat,
+        pickup_lng=ride_request.pickup_lng,
+        destination_address=ride_request.destination_address,
+        destination_lat=ride_request.destination_lat,
+        destination_lng=ride_request.destination_lng,
+        status='accepted'
+    )
+
+
+def claim_ride_request(ride_request_id, now=None):
+    """
+    Atomically mark an active, unexpired ride request as matched. Returns
+    True if this caller claimed it, False if it was already taken.
+    """
+    return bool(
+        RideRequest.objects.filter(
+            id=ride_request_id,
+            status='active',
+            expires_at__gt=now or timezone.now()
+        ).update(status='matched')
+    )
+
+
+def solve_assignment(rows, unmatched_cost, eps=1, deadline=None):
+    """
+    Min-cost assignment of rows to columns on a sparse cost matrix using the
+    auction algorithm.
+
+    ``rows`` is a list of ``{column: cost}`` dicts holding only the feasible
+    edges of each row. Every row also gets a private "unmatched" column
+    costing ``unmatched_cost``, so a feasible assignment always exists. The
+    total cost is within ``len(rows) * eps`` of the optimum; a single phase
+    is run from zero prices so that columns left unassigned keep a zero
+    price, which is what makes the asymmetric (more drivers than requests)
+    case come out right.
+
+    Returns a list with the assigned column (or None) for each row. If
+    ``deadline`` (a ``time.monotonic()`` value) passes, the rows still
+    bidding are finished greedily.
+    """
+    n = len(rows)
+    edges = []
+    for i, row in enumerate(rows):
+        row_edges = [(col, -cost) for col, cost in row.items()]
+        row_edges.append(((None, i), -unmatched_cost))
+        edges.append(row_edges)
+
+    prices = {}
+    owner = {}
+    assigned = [None] * n
+    queue = deque(range(n))
+    while queue:
+        if deadline is not None and time.monotonic() > deadline:
+            return _finish_greedily(edges, assigned, owner)
+
+        i = queue.popleft()
+        best_col, best_value, second_value = None, None, None
+        for col, benefit in edges[i]:
+            value = benefit - prices.get(col, 0)
+            if best_value is None or value > best_value:
+                second_value = best_value
+                best_col, best_value = col, value
+            elif second_value is None or value > second_value:
+                second_value = value
+
+        if second_value is None:
+            increment = eps
+        else:
+            increment = best_value - second_value + eps
+        prices[best_col] = prices.get(best_col, 0) + increment
+
+        previous = owner.get(best_col)
+        if previous is not None:
+            assigned[previous] = None
+            queue.append(previous)
+        owner[best_col] = i
+        assigned[i] = best_col
+
+    return [_real_column(col) for col in assigned]
+
+
+def _real_column(col):
+    if isinstance(col, tuple) and col[0] is None:
+        return None
+    return col
+
+
+def _finish_greedily(edges, assigned, owner):
+    for i, col in enumerate(assigned):
+        if col is not None:
+            continue
+        choices = sorted(edges[i], key=lambda edge: -edge[1])
+        for candidate, _ in choices:
+            if candidate not in owner:
+                owner[candidate] = i
+                assigned[i] = candidate
+                break
+    return [_real_column(col) for col in assigned]
+
+
+class BatchMatcher:
+    """
+    Windowed ride matching.
+
+    Instead of giving each ride request the closest driver the moment it
+    arrives, the matcher periodically collects all active requests and
+    solves a global min-cost assignment (total pickup distance) against
+    the available drivers, then creates the resulting rides in bulk.
+    """
+
+    def __init__(self, radius_km=None, candidates=None, max_requests=None,
+                 time_budget_ms=None, unmatched_cost_km=None):
+        self.radius_km = radius_km if radius_km is not None else \
+            getattr(settings, 'RIDE_BATCH_RADIUS_KM', 30)
+        self.candidates = candidates if candidates is not None else \
+            getattr(settings, 'RIDE_BATCH_CANDIDATES', 8)
+        self.max_requests = max_requests if max_requests is not None else \
+            getattr(settings, 'RIDE_BATCH_MAX_REQUESTS', 500)
+        self.time_budget_ms = time_budget_ms if time_budget_ms is not None else \
+            getattr(settings, 'RIDE_BATCH_TIME_BUDGET_MS', 200)
+        self.unmatched_cost_km = unmatched_cost_km if unmatched_cost_km is not None else \
+            2 * self.radius_km
+
+    def run_once(self, now=None):
+        """Match one window of active ride requests and return the new rides"""
+        now = now or timezone.now()
+        deadline = time.monotonic() + self.time_budget_ms / 1000
+
+        ride_requests = list(
+            RideRequest.objects.filter(
+                status='active',
+                expires_at__gt=now
+            ).select_related('passenger').order_by('requested_at')[:self.max_requests]
+        )
+        if not ride_requests:
+            return []
+
+        driver_index.ensure_loaded()
+        rows = []
+        for ride_request in ride_requests:
+            candidates = driver_index.nearest(
+                ride_request.pickup_lat,
+                ride_request.pickup_lng,
+                k=self.candidates,
+                max_distance_km=self.radius_km
+            )
+            # Costs in metres so integer rounding keeps enough resolution
+            rows.append({driver_id: distance * 1000 for driver_id, distance in candidates})
+
+        assignment = solve_assignment(rows, self.unmatched_cost_km * 1000, deadline=deadline)
+        pairs = [
+            (ride_request, driver_id)
+            for ride_request, driver_id in zip(ride_requests, assignment)
+            if driver_id is not None
+        ]
+        if not pairs:
+            return []
+
+        return self._create_rides(pairs)
+
+    def _create_rides(self, pairs):
+        with transaction.atomic():
+            # Re-check both sides under lock: the index and the request list
+            # may be stale by the time the assignment is solved.
+            drivers = Driver.objects.select_for_update(of=('self',)).filter(
+                id__in=[driver_id for _, driver_id in pairs],
+                status='available',
+                is_active=True
+            ).select_related('user').in_bulk()
+            open_request_ids = set(
+                RideRequest.objects.select_for_update().filter(
+                    id__in=[ride_request.id for ride_request, _ in pairs],
+                    status='active'
+                ).values_list('id', flat=True)
+            )
+            pairs = [
+                (ride_request, drivers[driver_id])
+                for ride_request, driver_id in pairs
+                if driver_id in drivers and ride_request.id in open_request_ids
+            ]
+            if not pairs:
+                return []
+
+            # Conditional updates, so a driver or request claimed concurrently
+            # (e.g. on databases without row locks) aborts the whole window
+            reserved = Driver.objects.filter(
+                id__in=[driver.id for _, driver in pairs],
+                status='available'
+            ).update(status='on_ride', updated_at=timezone.now())
+            matched = RideRequest.objects.filter(
+                id__in=[ride_request.id for ride_request, _ in pairs],
+                status='active'
+            ).update(status='matched')
+            if reserved != len(pairs) or matched != len(pairs):
+                transaction.set_rollback(True)
+                return []
+
+            rides = Ride.objects.bulk_create(
+                [build_ride(ride_request, driver) for ride_request, driver in pairs]
+            )
+
+            # Delivered by the outbox dispatcher once this commits
+            notify_passengers_rides_accepted(rides)
+
+        # Bulk updates bypass the Driver signals
+        for _, driver in pairs:
+            driver_index.remove(driver.id)
+
+        return rides
@@ -0,0 +1,28 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drivers', '0003_composite_indexes'),
+        ('rides', '0002_riderequest_status_expires_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['passenger', 'status', '-created_at'], name='ride_passenger_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(fields=['driver', 'status'], name='ride_driver_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ride',
+            index=models.Index(condition=models.Q(('status__in', ['requested', 'accepted', 'picked_up', 'in_transit'])), fields=['passenger', '-created_at'], name='ride_active_passenger_idx'),
+        ),
+    ]
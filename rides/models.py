@@ -45,6 +45,18 @@ class Ride(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['passenger', 'status', '-created_at'], name='ride_passenger_status_idx'),
+            models.Index(fields=['driver', 'status'], name='ride_driver_status_idx'),
+            # Current-ride lookups only ever look at the few unfinished rides
+            models.Index(
+                fields=['passenger', '-created_at'],
+                name='ride_active_passenger_idx',
+                condition=models.Q(status__in=['requested', 'accepted', 'picked_up', 'in_transit']),
+            ),
+        ]
+
     def __str__(self):
         return f"Ride #{self.id} - {self.passenger.username} - {self.status}"
 
@@ -65,5 +77,11 @@ class RideRequest(models.Model):
     expires_at = models.DateTimeField()
     status = models.CharField(max_length=20, default='active')  # active, matched, expired
 
+    class Meta:
+        indexes = [
+            # Expiry sweeps and active-request scans
+            models.Index(fields=['status', 'expires_at'], name='riderequest_status_expires_idx'),
+        ]
+
     def __str__(self):
         return f"Ride Request #{self.id} - {self.passenger.username}"
@@ -16,4 +16,5 @@ class RideRequestSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = RideRequest
-        fields = '__all__'
\ No newline at end of file
+        fields = '__all__'
+        read_only_fields = ('expires_at',)
\ No newline at end of file
@@ -1,3 +1,516 @@
-from django.test import TestCase
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from drivers.models import Driver
+from drivers.positions import get_position_store
+from drivers.spatial import driver_index
+from core.location_buffer import append_track_runs, location_buffer
+from core.models import Location, RideTrack, TrackChunk
+from core.track_storage import from_epoch_ms, unpack_chunk
+from core.trajectory import compact_ride_track, decode_polyline, decode_track
+from core.tests import IN_MEMORY_CHANNEL_LAYERS
+from core.trip_meter import TripMeter, load_trip_meter, save_trip_meter
+from drivers.tests import create_driver
+from .benchmark import MODES, MatchingBenchmark
+from .expiry import expire_overdue_requests
+from .matching import BatchMatcher, solve_assignment
+from .models import Ride, RideRequest
+from .views import AcceptRideView, CompleteRideView, RideTrackView
+
+User = get_user_model()
+
+
+def ride_request_payload(lat='-25.000000', lng='28.000000'):
+    return {
+        'pickup_address': 'Farm road 1',
+        'pickup_lat': lat,
+        'pickup_lng': lng,
+        'destination_address': 'Town clinic',
+        'destination_lat': '-25.100000',
+        'destination_lng': '28.100000',
+    }
+
+
+@mock.patch('rides.views.notify_passenger_ride_accepted')
+@mock.patch('rides.views.notify_available_drivers')
+class RequestRideTestCase(TestCase):
+    def setUp(self):
+        driver_index.clear()
+        self.passenger = User.objects.create_user(
+            email='passenger@example.com',
+            username='passenger@example.com',
+            password='testpassword123',
+            first_name='Pass',
+            last_name='Enger'
+        )
+        self.client.force_login(self.passenger)
+
+    def test_assigns_nearest_available_driver(self, notify_drivers, notify_passenger):
+        far = create_driver(1, lat='-25.200000', lng='28.000000')
+        near = create_driver(2, lat='-25.010000', lng='28.000000')
+        create_driver(3, lat='-25.001000', lng='28.000000', status='offline')
+
+        response = self.client.post(reverse('rides:api-request-ride'), ride_request_payload())
+
+        self.assertEqual(response.status_code, 201)
+        ride = Ride.objects.get()
+        self.assertEqual(ride.driver, near)
+        near.refresh_from_db()
+        far.refresh_from_db()
+        self.assertEqual(near.status, 'on_ride')
+        self.assertEqual(far.status, 'available')
+        self.assertEqual(RideRequest.objects.get().status, 'matched')
+
+    @override_settings(DRIVER_SPATIAL_INDEX_ENABLED=False)
+    def test_database_fallback_keeps_to_match_radius(self, notify_drivers, notify_passenger):
+        create_driver(1, lat='-26.000000', lng='28.000000')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('rides:api-request-ride'), ride_request_payload())
+
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(Ride.objects.exists())
+        driver_queries = [query['sql'] for query in queries if 'FROM "drivers_driver"' in query['sql']]
+        self.assertTrue(driver_queries)
+        self.assertIn('"location_lat" BETWEEN', driver_queries[0])
+
+    def test_request_stays_open_without_drivers(self, notify_drivers, notify_passenger):
+        response = self.client.post(reverse('rides:api-request-ride'), ride_request_payload())
+
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(Ride.objects.exists())
+        self.assertEqual(RideRequest.objects.get().status, 'active')
+
+
+class SolveAssignmentTestCase(TestCase):
+    def test_global_assignment_beats_greedy(self):
+        # Greedy would give row 0 column 'a' and leave row 1 the long pickup
+        rows = [{'a': 900, 'b': 1000}, {'a': 100, 'b': 2000}]
+
+        self.assertEqual(solve_assignment(rows, unmatched_cost=10000), ['b', 'a'])
+
+    def test_rows_without_candidates_stay_unmatched(self):
+        rows = [{'a': 10}, {}, {'a': 20}]
+
+        self.assertEqual(solve_assignment(rows, unmatched_cost=1000), ['a', None, None])
+
+    def test_expired_deadline_still_returns_valid_assignment(self):
+        rows = [{'a': 10, 'b': 20}, {'a': 5}, {'b': 1}]
+
+        result = solve_assignment(rows, unmatched_cost=1000, deadline=0)
+
+        assigned = [col for col in result if col is not None]
+        self.assertEqual(len(assigned), len(set(assigned)))
+
+
+@mock.patch('rides.matching.notify_passengers_rides_accepted')
+class BatchMatcherTestCase(TestCase):
+    def setUp(self):
+        driver_index.clear()
+
+    def create_request(self, n, lat):
+        passenger = User.objects.create_user(
+            email=f'passenger{n}@example.com',
+            username=f'passenger{n}@example.com',
+            password='testpassword123'
+        )
+        return RideRequest.objects.create(
+            passenger=passenger,
+            pickup_address='Farm road',
+            pickup_lat=lat,
+            pickup_lng='28.000000',
+            destination_address='Town clinic',
+            destination_lat='-25.100000',
+            destination_lng='28.100000',
+            expires_at=timezone.now() + timedelta(minutes=10)
+        )
+
+    def test_window_is_matched_globally_in_bulk(self, notify_passenger):
+        first = self.create_request(1, '-25.000000')
+        second = self.create_request(2, '-25.009000')
+        expired = self.create_request(3, '-25.000000')
+        RideRequest.objects.filter(id=expired.id).update(expires_at=timezone.now())
+        d1 = create_driver(1, lat='-25.008100', lng='28.000000')
+        d2 = create_driver(2, lat='-24.991000', lng='28.000000')
+
+        rides = BatchMatcher().run_once()
+
+        self.assertEqual(len(rides), 2)
+        self.assertEqual(Ride.objects.get(passenger=first.passenger).driver, d2)
+        self.assertEqual(Ride.objects.get(passenger=second.passenger).driver, d1)
+        self.assertEqual(
+            set(RideRequest.objects.values_list('id', 'status')),
+            {(first.id, 'matched'), (second.id, 'matched'), (expired.id, 'active')}
+        )
+        self.assertEqual(set(Driver.objects.values_list('status', flat=True)), {'on_ride'})
+        self.assertEqual(len(driver_index), 0)
+        notify_passenger.assert_called_once_with(rides)
+
+
+@mock.patch('rides.views.notify_passenger_ride_accepted')
+class ConcurrentAcceptTestCase(TransactionTestCase):
+    """Parallel accepts against a small driver pool must never double-assign"""
+
+    def setUp(self):
+        driver_index.clear()
+
+    def accept(self, driver, ride_request_id):
+        try:
+            for _ in range(50):
+                request = APIRequestFactory().post(
+                    '/api/rides/accept/', {'ride_request_id': ride_request_id}, format='json'
+                )
+                force_authenticate(request, user=driver.user)
+                try:
+                    return AcceptRideView.as_view()(request).status_code
+                except OperationalError:
+                    # SQLite reports lock contention instead of waiting
+                    continue
+        finally:
+            connection.close()
+
+    def test_no_double_assignment(self, notify_passenger):
+        drivers = [create_driver(n, lat='-25.000000', lng='28.000000') for n in range(3)]
+        ride_requests = []
+        for n in range(10):
+            passenger = User.objects.create_user(
+                email=f'passenger{n}@example.com',
+                username=f'passenger{n}@example.com',
+                password='testpassword123'
+            )
+            ride_requests.append(RideRequest.objects.create(
+                passenger=passenger,
+                pickup_address='Farm road',
+                pickup_lat='-25.000000',
+                pickup_lng='28.000000',
+                destination_address='Town clinic',
+                destination_lat='-25.100000',
+                destination_lng='28.100000',
+                expires_at=timezone.now() + timedelta(minutes=10)
+            ))
+
+        attempts = [(driver, ride_request.id) for ride_request in ride_requests for driver in drivers]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            statuses = list(executor.map(lambda attempt: self.accept(*attempt), attempts))
+
+        self.assertEqual(statuses.count(200), 3)
+        rides = list(Ride.objects.values_list('driver_id', 'passenger_id'))
+        self.assertEqual(len(rides), 3)
+        self.assertEqual(max(Counter(driver_id for driver_id, _ in rides).values()), 1)
+        self.assertEqual(max(Counter(passenger_id for _, passenger_id in rides).values()), 1)
+        self.assertEqual(RideRequest.objects.filter(status='matched').count(), 3)
+        self.assertEqual(set(Driver.objects.values_list('status', flat=True)), {'on_ride'})
+
+
+class ExpireOverdueRequestsTestCase(TestCase):
+    def create_request(self, n, expires_in, status='active'):
+        passenger = User.objects.create_user(
+            email=f'passenger{n}@example.com',
+            username=f'passenger{n}@example.com',
+            password='testpassword123'
+        )
+        return RideRequest.objects.create(
+            passenger=passenger,
+            pickup_address='Farm road',
+            pickup_lat='-25.000000',
+            pickup_lng='28.000000',
+            destination_address='Town clinic',
+            destination_lat='-25.100000',
+            destination_lng='28.100000',
+            expires_at=timezone.now() + expires_in,
+            status=status
+        )
+
+    @mock.patch('rides.expiry.notify_passengers_requests_expired')
+    def test_overdue_requests_expire_in_batches(self, notify_expired):
+        overdue = [self.create_request(n, timedelta(minutes=-1)) for n in range(5)]
+        fresh = self.create_request(5, timedelta(minutes=5))
+        matched = self.create_request(6, timedelta(minutes=-1), status='matched')
+
+        self.assertEqual(expire_overdue_requests(batch_size=2), 5)
+
+        self.assertEqual(
+            set(RideRequest.objects.filter(status='expired').values_list('id', flat=True)),
+            {ride_request.id for ride_request in overdue}
+        )
+        fresh.refresh_from_db()
+        matched.refresh_from_db()
+        self.assertEqual((fresh.status, matched.status), ('active', 'matched'))
+        self.assertEqual(notify_expired.call_count, 3)
+        notified = [r.passenger_id for call in notify_expired.call_args_list for r in call.args[0]]
+        self.assertEqual(sorted(notified), sorted(r.passenger_id for r in overdue))
+
+    def test_expired_request_cannot_be_accepted(self):
+        ride_request = self.create_request(1, timedelta(seconds=-1))
+        driver = create_driver(1, lat='-25.000000', lng='28.000000')
+        self.client.force_login(driver.user)
+
+        response = self.client.post(reverse('rides:accept-ride'), {'ride_request_id': ride_request.id})
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Ride.objects.exists())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, OUTBOX_WORKERS=0)
+class MatchingBenchmarkTestCase(TestCase):
+    def test_every_mode_matches_and_reports(self):
+        for mode in MODES:
+            with self.subTest(mode=mode):
+                driver_index.clear()
+                result = MatchingBenchmark(drivers=20, requests=5, villages=2, mode=mode).run()
+                self.assertEqual(result['requests'], 5)
+                self.assertEqual(result['matched'], 5)
+                self.assertGreater(result['queries_per_request']['mean'], 0)
+                self.assertGreater(result['notifications_per_request']['max'], 0)
+                self.assertIsNotNone(result['latency_ms']['p99'])
+                self.assertLess(result['binary_bytes_per_update']['mean'], result['json_bytes_per_update']['mean'])
+                User.objects.filter(username__startswith='bench-').delete()
+
+
+@override_settings(TRACK_SIMPLIFY_TOLERANCE_M=5)
+class RideTrackTestCase(TestCase):
+    def setUp(self):
+        driver_index.clear()
+        self.passenger = User.objects.create_user(
+            email='passenger@example.com',
+            username='passenger@example.com',
+            password='testpassword123'
+        )
+        self.driver = create_driver(1, '-25.000000', '28.000000', status='on_ride')
+        self.ride = Ride.objects.create(
+            passenger=self.passenger,
+            driver=self.driver,
+            pickup_address='Farm road',
+            pickup_lat='-25.000000',
+            pickup_lng='28.000000',
+            destination_address='Town clinic',
+            destination_lat='-25.010000',
+            destination_lng='28.010000',
+            status='in_transit'
+        )
+        started = timezone.now() - timedelta(minutes=10)
+        # North along a straight road, then east
+        route = [(-25 + i / 10000, 28) for i in range(100)] + [(-24.9901, 28 + i / 10000) for i in range(1, 50)]
+        Location.objects.bulk_create([
+            Location(driver=self.driver, ride=self.ride, latitude=f'{lat:.6f}', longitude=f'{lng:.6f}',
+                     timestamp=started + timedelta(seconds=3 * i))
+            for i, (lat, lng) in enumerate(route)
+        ])
+        self.factory = APIRequestFactory()
+
+    def call(self, view, method, user, **kwargs):
+        request = getattr(self.factory, method)('/')
+        force_authenticate(request, user=user)
+        return view.as_view()(request, pk=self.ride.id, **kwargs)
+
+    def test_completion_compacts_track_for_replay(self):
+        live = self.call(RideTrackView, 'get', self.passenger)
+        self.assertFalse(live.data['compacted'])
+        self.assertEqual(len(live.data['points']), 149)
+
+        response = self.call(CompleteRideView, 'post', self.driver.user)
+        self.assertEqual(response.status_code, 200)
+
+        self.assertFalse(Location.objects.filter(ride=self.ride).exists())
+        track = RideTrack.objects.get(ride=self.ride)
+        self.assertEqual((track.raw_point_count, track.point_count), (149, 3))
+
+        replay = self.call(RideTrackView, 'get', self.driver.user)
+        self.assertTrue(replay.data['compacted'])
+        self.assertEqual(replay.data['polyline'], track.polyline)
+        self.assertEqual(
+            [(point['latitude'], point['longitude']) for point in replay.data['points']],
+            [(-25.0, 28.0), (-24.9901, 28.0), (-24.9901, 28.0049)]
+        )
+        self.assertEqual(
+            replay.data['points'][-1]['timestamp'] - replay.data['points'][0]['timestamp'],
+            timedelta(seconds=3 * 148)
+        )
+
+    @override_settings(LOCATION_BUFFER_MAX_SIZE=1000, LOCATION_BUFFER_FLUSH_SECONDS=3600)
+    def test_live_points_are_packed_then_compacted(self):
+        Location.objects.all().delete()
+        started = timezone.now().replace(microsecond=0)
+        for i in range(20):
+            location_buffer.add(-25 + i / 10000, 28, self.ride.id, driver_id=self.driver.id,
+                                timestamp=started + timedelta(seconds=i))
+        location_buffer.flush()
+        self.assertEqual(TrackChunk.objects.get(ride=self.ride).point_count, 20)
+
+        live = self.call(RideTrackView, 'get', self.passenger)
+        self.assertEqual(len(live.data['points']), 20)
+        self.assertEqual(live.data['points'][-1]['latitude'], -24.9981)
+        self.assertEqual(live.data['points'][-1]['timestamp'], started + timedelta(seconds=19))
+
+        self.call(CompleteRideView, 'post', self.driver.user)
+        self.assertFalse(TrackChunk.objects.filter(ride=self.ride).exists())
+        track = RideTrack.objects.get(ride=self.ride)
+        self.assertEqual((track.raw_point_count, track.point_count), (20, 2))
+
+    def test_late_points_are_merged_in_time_order(self):
+        self.call(CompleteRideView, 'post', self.driver.user)
+        started_at = RideTrack.objects.get(ride=self.ride).started_at
+
+        # An offline batch from halfway up the road, with a detour to the west
+        with transaction.atomic():
+            append_track_runs({(self.ride.id, None, self.driver.id): [
+                (Decimal('-24.995000'), Decimal('28.000000'), started_at + timedelta(seconds=150)),
+                (Decimal('-24.994500'), Decimal('27.998000'), started_at + timedelta(seconds=153)),
+                (Decimal('-24.994000'), Decimal('28.000000'), started_at + timedelta(seconds=156)),
+            ]})
+        previous = decode_track(RideTrack.objects.get(ride=self.ride))
+
+        # Replay shows the points flushed after compaction straight away
+        replay = self.call(RideTrackView, 'get', self.passenger)
+        self.assertEqual(len(replay.data['points']), len(previous) + 3)
+        self.assertEqual(replay.data['raw_point_count'], 152)
+        self.assertEqual(len(decode_polyline(replay.data['polyline'])), len(previous) + 3)
+
+        track = compact_ride_track(self.ride)
+        points = decode_track(track)
+        offsets = [(timestamp - started_at).total_seconds() for _, _, timestamp in points]
+        self.assertEqual(offsets, sorted(offsets))
+        self.assertIn((-24.9945, 27.998), [(lat, lng) for lat, lng, _ in points])
+        self.assertEqual(track.raw_point_count, 152)
+        # The earlier track is kept as it was; only the new span is simplified
+        self.assertTrue(set(previous) <= set(points))
+
+    def test_completion_writes_trip_meter_totals(self):
+        meter = TripMeter()
+        started = timezone.now().timestamp() - 25 * 60
+        # About 11.1 km north in 25 minutes
+        for i in range(11):
+            self.assertTrue(meter.add(-25 + i / 100, 28, started + 150 * i))
+        save_trip_meter(self.ride.id, meter)
+
+        self.call(CompleteRideView, 'post', self.driver.user)
+        self.ride.refresh_from_db()
+        self.assertAlmostEqual(float(self.ride.distance), 11.12, places=1)
+        self.assertEqual(self.ride.duration, 25)
+        self.assertIsNone(load_trip_meter(self.ride.id).started)
+
+    def test_only_participants_can_read_track(self):
+        stranger = User.objects.create_user(
+            email='stranger@example.com',
+            username='stranger@example.com',
+            password='testpassword123'
+        )
+        self.assertEqual(self.call(RideTrackView, 'get', stranger).status_code, 404)
+
+
+class UpdateLocationTestCase(TestCase):
+    def setUp(self):
+        driver_index.clear()
+        cache.clear()
+        get_position_store().clear()
+        self.addCleanup(get_position_store().clear)
+        self.passenger = User.objects.create_user(
+            email='passenger@example.com',
+            username='passenger@example.com',
+            password='testpassword123'
+        )
+        self.driver = create_driver(1, '-25.000000', '28.000000', status='on_ride')
+        self.ride = Ride.objects.create(
+            passenger=self.passenger,
+            driver=self.driver,
+            pickup_address='Farm road',
+            pickup_lat='-25.000000',
+            pickup_lng='28.000000',
+            destination_address='Town clinic',
+            destination_lat='-25.100000',
+            destination_lng='28.000000',
+            status='in_transit'
+        )
+        self.started = timezone.now().replace(microsecond=0) - timedelta(minutes=5)
+        Ride.objects.filter(id=self.ride.id).update(created_at=self.started - timedelta(minutes=1))
+        self.client.force_login(self.driver.user)
+
+    def upload(self, points, ride_id=None):
+        return self.client.post(
+            reverse('rides:update-location'),
+            {'ride_id': ride_id or self.ride.id, 'points': points},
+            content_type='application/json'
+        )
+
+    def point(self, second, lat=None):
+        return {
+            'latitude': -25 - second / 10000 if lat is None else lat,
+            'longitude': 28,
+            'timestamp': (self.started + timedelta(seconds=second)).isoformat(),
+        }
+
+    def test_batch_is_validated_deduplicated_and_stored_once(self):
+        # Sent newest first, with a repeat, a bad coordinate and a point from the future
+        points = [self.point(second) for second in range(30, -1, -10)]
+        points += [self.point(10), self.point(40, lat=95), {'latitude': -25, 'longitude': 28,
+                   'timestamp': (timezone.now() + timedelta(hours=1)).isoformat()}, 'junk']
+
+        # Session, user and ride, one insert and one position update in a
+        # savepoint, then the merge check
+        with self.assertNumQueries(8):
+            response = self.upload(points)
+        self.assertEqual(response.data, {'accepted': 4, 'duplicates': 1, 'rejected': 3})
+
+        chunk = TrackChunk.objects.get(ride=self.ride)
+        self.assertEqual((chunk.driver_id, chunk.point_count), (self.driver.id, 4))
+        lat, _, ts = unpack_chunk(bytes(chunk.data))
+        self.assertEqual(lat.tolist(), [-25000000, -25001000, -25002000, -25003000])
+        self.assertEqual(from_epoch_ms(ts[-1]), self.started + timedelta(seconds=30))
+
+        lat, lng, timestamp = get_position_store().get(self.driver.id)
+        self.assertEqual((float(lat), timestamp), (-25.003, self.started + timedelta(seconds=30)))
+        self.assertAlmostEqual(load_trip_meter(self.ride.id).distance_km, 0.333, places=2)
+
+        # A retried upload stores nothing new
+        response = self.upload(points[:4] + [self.point(50)])
+        self.assertEqual((response.data['accepted'], response.data['duplicates']), (1, 4))
+        # The new point is sealed in a row of its own
+        self.assertEqual(
+            list(TrackChunk.objects.filter(ride=self.ride).order_by('first_timestamp').values_list('point_count', flat=True)),
+            [4, 1]
+        )
+
+    def test_upload_after_live_points_fills_the_gap(self):
+        # Live points before and after the socket dropped, timed by the server
+        meter = TripMeter()
+        received = self.started.timestamp()
+        for second, offset in ((0, 0), (10, 10), (40, 100), (50, 110)):
+            meter.add(-25 - second / 10000, 28, received + offset)
+        save_trip_meter(self.ride.id, meter)
+
+        # Points the device recorded in between, on its own clock, arrive
+        # afterwards and show it went 100 m past the turn and back
+        response = self.upload([self.point(20, lat=-25.0035), self.point(30, lat=-25.0025)])
+        self.assertEqual(response.data['accepted'], 2)
+        meter = load_trip_meter(self.ride.id)
+        self.assertAlmostEqual(meter.distance_km, 0.556 + 0.222, places=2)
+        self.assertEqual(meter.last[2], received + 110)
+
+    def test_single_point_and_access(self):
+        self.client.force_login(self.passenger)
+        response = self.client.post(
+            reverse('rides:update-location'),
+            dict(self.point(0), ride_id=self.ride.id),
+            content_type='application/json'
+        )
+        self.assertEqual(response.data['accepted'], 1)
+        chunk = TrackChunk.objects.get(ride=self.ride)
+        self.assertEqual((chunk.user_id, chunk.driver_id), (self.passenger.id, None))
+        self.assertIsNone(get_position_store().get(self.driver.id))
+
+        stranger = create_driver(2, '-25.1', '28.1')
+        self.client.force_login(stranger.user)
+        self.assertEqual(self.upload([self.point(0)]).status_code, 404)
+        self.assertEqual(self.upload([]).status_code, 400)
@@ -9,8 +9,10 @@ urlpatterns = [
     path('<int:pk>/', views.RideDetailView.as_view(), name='ride-detail'),
     path('<int:pk>/cancel/', views.CancelRideView.as_view(), name='cancel-ride'),
     path('<int:pk>/complete/', views.CompleteRideView.as_view(), name='complete-ride'),
+    path('<int:pk>/track/', views.RideTrackView.as_view(), name='ride-track'),
     path('history/', views.RideHistoryView.as_view(), name='ride-history'),
     path('current/', views.CurrentRideView.as_view(), name='current-ride'),
+    path('update-location/', views.UpdateLocationView.as_view(), name='update-location'),
 ]
 
 app_name = 'rides'
\ No newline at end of file
@@ -1,3 +1,5 @@
+import logging
+
 from django.shortcuts import render
 from rest_framework import generics, status
 from rest_framework.response import Response
@@ -6,12 +8,23 @@ from rest_framework.permissions import IsAuthenticated
 from django.shortcuts import get_object_or_404
 from .models import Ride, RideRequest
 from .serializers import RideSerializer, RideRequestSerializer
+from .matching import build_ride, claim_ride_request
 from drivers.models import Driver
+from drivers.geo import haversine_km
+from drivers.spatial import find_nearest_available_drivers
+from drivers.reservation import reserve_driver, reserve_first_available
 from django.utils import timezone
+from datetime import timedelta
 from django.contrib.auth import get_user_model
 from django.db import transaction
-import math
-from core.services import notify_available_drivers, notify_passenger_ride_accepted
+from django.db.models import Q
+from django.conf import settings
+from core.services import notify_available_drivers, notify_passenger_ride_accepted, notify_ride_ended
+from core.location_ingest import ingest_locations
+from core.trajectory import compact_ride_track, encode_polyline, ride_track
+from core.trip_meter import apply_trip_meter, discard_trip_meter
+
+logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
@@ -30,81 +43,50 @@ class RequestRideView(generics.CreateAPIView):
     permission_classes = [IsAuthenticated]
 
     def perform_create(self, serializer):
-        # Create a ride request
-        ride_request = serializer.save(passenger=self.request.user)
+        # Create a ride request; the expiry sweeper closes it if unmatched
+        ride_request = serializer.save(
+            passenger=self.request.user,
+            expires_at=timezone.now() + timedelta(seconds=getattr(settings, 'RIDE_REQUEST_TTL_SECONDS', 300))
+        )
 
         # Notify available drivers about the new ride request
         notify_available_drivers(ride_request)
 
-        # Find the nearest available driver
-        available_drivers = Driver.objects.filter(
-            status='available',
-            is_active=True
+        # In batch mode drivers are assigned by the windowed matcher
+        if getattr(settings, 'RIDE_MATCHING_MODE', 'immediate') == 'batch':
+            return ride_request
+
+        # Find the nearest available drivers using the spatial index. The
+        # index may lag behind the database, so each candidate is claimed
+        # with a conditional update and the next one is tried on failure.
+        candidates = find_nearest_available_drivers(
+            ride_request.pickup_lat,
+            ride_request.pickup_lng,
+            limit=getattr(settings, 'RIDE_MATCH_CANDIDATES', 5),
+            max_distance_km=getattr(settings, 'RIDE_MATCH_RADIUS_KM', 20),
         )
 
-        # Calculate distances and find the closest driver
-        closest_driver = None
-        min_distance = float('inf')
-
-        for driver in available_drivers:
-            if driver.location_lat and driver.location_lng:
-                distance = self.calculate_distance(
-                    float(ride_request.pickup_lat),
-                    float(ride_request.pickup_lng),
-                    float(driver.location_lat),
-                    float(driver.location_lng)
-                )
+        with transaction.atomic():
+            driver_id = reserve_first_available(driver_id for driver_id, _ in candidates)
 
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_driver = driver
-
-        # If we found a driver, assign the ride
-        if closest_driver:
-            with transaction.atomic():
-                # Create the actual ride
-                ride = Ride.objects.create(
-                    passenger=self.request.user,
-                    driver=closest_driver,
-                    pickup_address=ride_request.pickup_address,
-                    pickup_lat=ride_request.pickup_lat,
-                    pickup_lng=ride_request.pickup_lng,
-                    destination_address=ride_request.destination_address,
-                    destination_lat=ride_request.destination_lat,
-                    destination_lng=ride_request.destination_lng,
-                    status='accepted'
-                )
-
-                # Update driver status
-                closest_driver.status = 'on_ride'
-                closest_driver.save()
+            # If we found a driver, assign the ride. A driver may already
+            # have accepted the request through AcceptRideView.
+            if driver_id is None or not claim_ride_request(ride_request.id):
+                transaction.set_rollback(True)
+                # If no driver found, keep the request open
+                return ride_request
 
-                # Mark the ride request as matched
-                ride_request.status = 'matched'
-                ride_request.save()
+            ride = build_ride(ride_request, Driver.objects.select_related('user').get(id=driver_id))
+            ride.save()
 
-                # Notify the passenger that their ride has been accepted
-                notify_passenger_ride_accepted(ride)
+            # Notify the passenger that their ride has been accepted
+            notify_passenger_ride_accepted(ride)
 
-                # Return the created ride
-                ride_serializer = RideSerializer(ride)
-                return ride
-
-        # If no driver found, keep the request open
-        return ride_request
+            return ride
 
     def calculate_distance(self, lat1, lng1, lat2, lng2):
         """Calculate distance between two points in km using Haversine formula"""
-        R = 6371  # Earth radius in km
-
-        dLat = math.radians(lat2 - lat1)
-        dLon = math.radians(lng2 - lng1)
-        a = (math.sin(dLat/2) * math.sin(dLat/2) +
-             math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
-             math.sin(dLon/2) * math.sin(dLon/2))
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-        distance = R * c
-        return distance
+        return haversine_km(lat1, lng1, lat2, lng2)
 
 class AcceptRideView(APIView):
     """Endpoint for drivers to accept a ride request"""
@@ -113,51 +95,43 @@ class AcceptRideView(APIView):
     def post(self, request):
         ride_request_id = request.data.get('ride_request_id')
 
+        # Get the driver
         try:
-            ride_request = RideRequest.objects.get(id=ride_request_id, status='active')
+            driver = request.user.driver_profile
+        except Driver.DoesNotExist:
+            return Response(
+                {'error': 'Only drivers can accept ride requests'},
+                status=status.HTTP_403_FORBIDDEN
+            )
 
-            # Get the driver
-            try:
-                driver = request.user.driver_profile
-            except Driver.DoesNotExist:
+        with transaction.atomic():
+            # Claim the request and the driver with conditional updates so
+            # concurrent accepts cannot match a request or a driver twice
+            if not claim_ride_request(ride_request_id):
                 return Response(
-                    {'error': 'Only drivers can accept ride requests'},
-                    status=status.HTTP_403_FORBIDDEN
+                    {'error': 'Ride request not found'},
+                    status=status.HTTP_404_NOT_FOUND
                 )
 
-            # Create the ride
-            with transaction.atomic():
-                ride = Ride.objects.create(
-                    passenger=ride_request.passenger,
-                    driver=driver,
-                    pickup_address=ride_request.pickup_address,
-                    pickup_lat=ride_request.pickup_lat,
-                    pickup_lng=ride_request.pickup_lng,
-                    destination_address=ride_request.destination_address,
-                    destination_lat=ride_request.destination_lat,
-                    destination_lng=ride_request.destination_lng,
-                    status='accepted'
+            if not reserve_driver(driver.id):
+                transaction.set_rollback(True)
+                return Response(
+                    {'error': 'Driver is not available'},
+                    status=status.HTTP_409_CONFLICT
                 )
 
-                # Update driver status
-                driver.status = 'on_ride'
-                driver.save()
+            ride_request = RideRequest.objects.select_related('passenger').get(id=ride_request_id)
+            driver.status = 'on_ride'
 
-                # Mark the request as matched
-                ride_request.status = 'matched'
-                ride_request.save()
+            # Create the ride
+            ride = build_ride(ride_request, driver)
+            ride.save()
 
-                # Notify the passenger that their ride has been accepted
-                notify_passenger_ride_accepted(ride)
+            # Notify the passenger that their ride has been accepted
+            notify_passenger_ride_accepted(ride)
 
-                serializer = RideSerializer(ride)
-                return Response(serializer.data)
-
-        except RideRequest.DoesNotExist:
-            return Response(
-                {'error': 'Ride request not found'},
-                status=status.HTTP_404_NOT_FOUND
-            )
+            serializer = RideSerializer(ride)
+            return Response(serializer.data)
 
 class RideDetailView(generics.RetrieveAPIView):
     serializer_class = RideSerializer
@@ -214,6 +188,8 @@ class CancelRideView(APIView):
                 if ride.driver:
                     ride.driver.status = 'available'
                     ride.driver.save()
+                notify_ride_ended(ride)
+                discard_trip_meter(ride.id)
 
                 serializer = RideSerializer(ride)
                 return Response(serializer.data)
@@ -239,13 +215,24 @@ class CompleteRideView(APIView):
             if ride.status == 'in_transit':
                 ride.status = 'completed'
                 ride.dropoff_time = timezone.now()
+                # Distance and duration come from the live trip meter
+                apply_trip_meter(ride)
                 ride.save()
+                discard_trip_meter(ride.id)
 
                 # Update driver status
                 driver = ride.driver
                 driver.status = 'available'
                 driver.total_rides += 1
                 driver.save()
+                notify_ride_ended(ride)
+
+                # Replace the raw location history with a compact track; a
+                # failure here must not undo the completion
+                try:
+                    compact_ride_track(ride)
+                except Exception:
+                    logger.exception('Could not compact the track of ride %s', ride.id)
 
                 serializer = RideSerializer(ride)
                 return Response(serializer.data)
@@ -258,4 +245,95 @@ class CompleteRideView(APIView):
             return Response(
                 {'error': 'Ride not found'},
                 status=status.HTTP_404_NOT_FOUND
-            )
\ No newline at end of file
+            )
+
+class RideTrackView(APIView):
+    """Route of a ride for replay, to its passenger and driver"""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        ride = Ride.objects.filter(
+            Q(passenger=request.user) | Q(driver__user=request.user),
+            id=pk
+        ).first()
+        if ride is None:
+            return Response(
+                {'error': 'Ride not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        points, track = ride_track(ride)
+        polyline, raw_point_count = None, len(points)
+        if track is not None:
+            # Points flushed after compaction are not in the stored polyline yet
+            leftover = len(points) - track.point_count
+            polyline = track.polyline
+            if leftover:
+                polyline = encode_polyline(((lat, lng) for lat, lng, _ in points), track.precision)
+            raw_point_count = track.raw_point_count + leftover
+        return Response({
+            'ride_id': ride.id,
+            'compacted': track is not None,
+            'polyline': polyline,
+            'precision': track.precision if track else None,
+            'raw_point_count': raw_point_count,
+            'points': [
+                {'latitude': lat, 'longitude': lng, 'timestamp': timestamp}
+                for lat, lng, timestamp in points
+            ],
+        })
+
+class UpdateLocationView(APIView):
+    """
+    Batch upload of the points a device recorded for a ride, for example
+    while its WebSocket was down. Takes ``{"ride_id", "points": [...]}``
+    with each point's ``latitude``, ``longitude`` and ``timestamp``, or a
+    single point at the top level.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        points = request.data.get('points')
+        if points is None:
+            points = [request.data]
+        if not isinstance(points, list) or not points:
+            return Response(
+                {'error': 'points must be a non-empty list'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        max_points = getattr(settings, 'LOCATION_BATCH_MAX_POINTS', 500)
+        if len(points) > max_points:
+            return Response(
+                {'error': f'At most {max_points} points per batch'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            ride_id = int(request.data.get('ride_id'))
+        except (TypeError, ValueError):
+            ride_id = None
+        ride = Ride.objects.filter(
+            Q(passenger=request.user) | Q(driver__user=request.user),
+            id=ride_id
+        ).select_related('driver').first()
+        if ride is None:
+            return Response(
+                {'error': 'Ride not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        if ride.status not in ['accepted', 'picked_up', 'in_transit', 'completed']:
+            return Response(
+                {'error': 'Ride is not under way'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        driver_id = ride.driver_id if ride.driver and ride.driver.user_id == request.user.id else None
+        result = ingest_locations(ride, request.user, points, driver_id=driver_id)
+
+        # Points arriving after completion are merged into the compacted track
+        if ride.status == 'completed' and result['accepted']:
+            try:
+                compact_ride_track(ride)
+            except Exception:
+                logger.exception('Could not compact the track of ride %s', ride.id)
+        return Response(result)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -167,6 +168,99 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Cache
+# Unread notification counters, trip meters and location upload
+# high-water marks live in the cache. The per-process default only suits a
+# single process; once run_outbox_dispatcher, run_ride_matcher,
+# purge_notifications or more than one web/ASGI worker run, set
+# REDIS_CACHE_URL so all of them share one cache.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+if os.environ.get('REDIS_CACHE_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_CACHE_URL'],
+        },
+    }
+# Tests always get a private in-memory cache
+TEST_RUNNER = 'rural_hailing.test_runner.TestRunner'
+
+# Ride matching
+DRIVER_SPATIAL_INDEX_ENABLED = True  # False falls back to bounding-box database queries
+DRIVER_INDEX_CELL_DEG = 0.02  # grid cell size of the available-driver index (~2 km)
+DRIVER_INDEX_REFRESH_SECONDS = 60  # full rebuild from the database
+RIDE_MATCH_CANDIDATES = 5  # nearest drivers confirmed against the database per request
+RIDE_MATCH_RADIUS_KM = 20  # drivers further from the pickup are never matched; bounds the database fallback
+RIDE_REQUEST_TTL_SECONDS = 300  # unmatched requests expire after this
+RIDE_REQUEST_EXPIRY_BATCH_SIZE = 500
+RIDE_MATCHING_MODE = 'immediate'  # 'batch' leaves assignment to the run_ride_matcher command
+RIDE_BATCH_WINDOW_SECONDS = 2
+RIDE_BATCH_RADIUS_KM = 30
+RIDE_BATCH_CANDIDATES = 8  # candidate drivers (cost matrix edges) per request
+RIDE_BATCH_MAX_REQUESTS = 500
+RIDE_BATCH_TIME_BUDGET_MS = 200
+RIDE_REQUEST_NOTIFY_LIMIT = 10  # nearest drivers told about a new ride request
+RIDE_REQUEST_NOTIFY_RADIUS_KM = 20
+NEARBY_DRIVERS_CACHE_SECONDS = 5  # per grid cell cache of /api/drivers/nearby/ candidates
+NEARBY_DRIVERS_MAX_RADIUS_KM = 50
+NEARBY_DRIVERS_MAX_LIMIT = 50
+NEARBY_DRIVERS_CELL_CANDIDATES = 500  # most drivers cached per cell; denser cells fall back to direct lookups
+
+# Notification outbox
+OUTBOX_WORKERS = 2  # delivery threads per process; 0 delivers inline after commit
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_BACKOFF_SECONDS = 2  # doubled on every failed attempt
+OUTBOX_CLAIM_TIMEOUT_SECONDS = 60  # batches claimed longer ago are reclaimed
+
+# Live location writes
+DRIVER_POSITION_STORE = {
+    # drivers.positions.RedisPositionStore shares positions between processes
+    'BACKEND': 'drivers.positions.InMemoryPositionStore',
+    'OPTIONS': {},
+}
+DRIVER_POSITION_PERSIST_SECONDS = 15  # how often a moving driver's row is updated
+TRACK_CHUNK_MAX_POINTS = 4096  # points small track chunks are merged into before a row is full
+TRACK_CHUNK_MAX_OPEN = 16  # small track chunks a ride participant may have before they are merged
+TRACK_SIMPLIFY_TOLERANCE_M = 5  # Douglas-Peucker tolerance when a finished ride's track is compacted
+TRACK_POLYLINE_PRECISION = 5  # decimal places kept in the encoded polyline (~1 m)
+LOCATION_FILTER = {
+    # Frames closer than MIN_DISTANCE_M to the last kept one or sooner than
+    # MIN_INTERVAL_SECONDS after it are dropped; MAX_INTERVAL_SECONDS is the heartbeat
+    'driver': {'MIN_DISTANCE_M': 10, 'MIN_INTERVAL_SECONDS': 2, 'MAX_INTERVAL_SECONDS': 30},
+    'passenger': {'MIN_DISTANCE_M': 25, 'MIN_INTERVAL_SECONDS': 5, 'MAX_INTERVAL_SECONDS': 60},
+}
+LOCATION_BUFFER_MAX_SIZE = 500  # buffered points that trigger an immediate flush
+LOCATION_BUFFER_FLUSH_SECONDS = 2  # longest a point waits before it is written
+LOCATION_BUFFER_MAX_PENDING = 50000  # oldest points are dropped beyond this while the DB is failing
+LOCATION_BATCH_MAX_POINTS = 500  # points per upload to /api/rides/update-location/
+LOCATION_BATCH_MAX_CLOCK_SKEW_SECONDS = 60  # uploaded points further in the future are rejected
+NOTIFICATION_PAGE_SIZE = 20  # notifications per inbox page
+NOTIFICATION_UNREAD_COUNT_TIMEOUT = 3600  # cached unread counters are re-seeded from the database after this
+NOTIFICATION_RETENTION = {
+    # Seconds each type is kept by the purge_notifications command; unlisted types are kept forever
+    'ride_request': 15 * 60,
+    'driver_arrived': 24 * 3600,
+    'ride_accepted': 7 * 24 * 3600,
+    'ride_completed': 90 * 24 * 3600,
+    'system': 30 * 24 * 3600,
+    'payment': 365 * 24 * 3600,
+}
+NOTIFICATION_PURGE_BATCH_SIZE = 1000  # rows deleted per transaction by purge_notifications
+NOTIFICATION_COALESCE_SECONDS = 60  # a driver's unread ride request notice this recent is updated instead of repeated
+NOTIFICATION_PUSH_DEBOUNCE_SECONDS = 5  # coalesced ride requests are pushed as one summary this often
+EVENT_REPLAY_BUFFER_SIZE = 100  # numbered events per user kept in the database for clients resuming a dropped WebSocket
+EVENT_REPLAY_TIMEOUT = 3600  # seconds a kept event can still be replayed
+TRIP_METER_SPEED_ALPHA = 0.3  # weight of the newest step in the moving-average speed
+TRIP_METER_MAX_SPEED_KMH = 160  # faster steps are GPS jumps and are ignored
+TRIP_METER_GAP_SECONDS = 60  # longer live steps mean the stream was cut; uploaded points reroute them
+TRIP_METER_MIN_SPEED_KMH = 5  # speed floor for ETAs while stopped
+TRIP_METER_ROUTE_FACTOR = 1.3  # road distance over straight-line distance on rural roads
+
 # Authentication backends
 AUTHENTICATION_BACKENDS = [
     'accounts.authentication.EmailBackend',  # Custom email authentication
@@ -6,40 +6,264 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Initialize WebSocket connection for real-time updates
     initializeWebSocket();
+
+    // Upload locations recorded while offline once we are back
+    setInterval(uploadQueuedLocations, 15000);
+    window.addEventListener('online', uploadQueuedLocations);
 });
 
+// Binary location frames, negotiated as a WebSocket subprotocol. Servers
+// that do not pick it keep talking JSON (see core/wire.py for the layout).
+const LOCATION_SUBPROTOCOL = 'ruralhailing.location.v1';
+const LOCATION_KEYFRAME = 1;
+const LOCATION_DELTA = 2;
+const LOCATION_HAS_ETA = 0x80;
+const MICRODEGREES = 1000000;
+
+// Keeps the previous frame of one direction of a connection; the first
+// frame of a ride is a 13 byte keyframe, later ones 5 byte deltas; the
+// high bit of the type byte means a 2 byte ETA in seconds follows
+class LocationCodec {
+    constructor() {
+        this.last = null;
+    }
+
+    encode(rideId, latitude, longitude) {
+        const lat = Math.round(latitude * MICRODEGREES);
+        const lng = Math.round(longitude * MICRODEGREES);
+        const last = this.last;
+        this.last = { rideId: rideId, lat: lat, lng: lng };
+
+        if (last && last.rideId === rideId) {
+            const dLat = lat - last.lat;
+            const dLng = lng - last.lng;
+            if (dLat >= -32768 && dLat < 32768 && dLng >= -32768 && dLng < 32768) {
+                const view = new DataView(new ArrayBuffer(5));
+                view.setUint8(0, LOCATION_DELTA);
+                view.setInt16(1, dLat, true);
+                view.setInt16(3, dLng, true);
+                return view.buffer;
+            }
+        }
+        const view = new DataView(new ArrayBuffer(13));
+        view.setUint8(0, LOCATION_KEYFRAME);
+        view.setUint32(1, rideId, true);
+        view.setInt32(5, lat, true);
+        view.setInt32(9, lng, true);
+        return view.buffer;
+    }
+
+    decode(buffer) {
+        let view = new DataView(buffer);
+        let kind = view.byteLength ? view.getUint8(0) : null;
+        let etaSeconds = null;
+        if (kind !== null && (kind & LOCATION_HAS_ETA)) {
+            if (view.byteLength < 3) {
+                return null;
+            }
+            kind &= ~LOCATION_HAS_ETA;
+            etaSeconds = view.getUint16(view.byteLength - 2, true);
+            view = new DataView(buffer, 0, view.byteLength - 2);
+        }
+        if (kind === LOCATION_KEYFRAME && view.byteLength === 13) {
+            this.last = {
+                rideId: view.getUint32(1, true),
+                lat: view.getInt32(5, true),
+                lng: view.getInt32(9, true)
+            };
+        } else if (kind === LOCATION_DELTA && view.byteLength === 5 && this.last) {
+            this.last = {
+                rideId: this.last.rideId,
+                lat: this.last.lat + view.getInt16(1, true),
+                lng: this.last.lng + view.getInt16(3, true)
+            };
+        } else {
+            return null;
+        }
+        const update = {
+            type: 'location_update',
+            ride_id: this.last.rideId,
+            latitude: this.last.lat / MICRODEGREES,
+            longitude: this.last.lng / MICRODEGREES
+        };
+        if (etaSeconds !== null) {
+            update.eta_seconds = etaSeconds;
+        }
+        return update;
+    }
+}
+
+// Send our location over the ride-tracking socket in whichever format was negotiated
+function sendLocation(rideId, latitude, longitude) {
+    const socket = window.rideSocket;
+    if (!socket || socket.readyState !== WebSocket.OPEN) {
+        return false;
+    }
+    if (socket.protocol === LOCATION_SUBPROTOCOL) {
+        socket.send(socket.outgoingLocations.encode(Number(rideId), latitude, longitude));
+    } else {
+        socket.send(JSON.stringify({
+            type: 'location_update',
+            ride_id: rideId,
+            latitude: latitude,
+            longitude: longitude
+        }));
+    }
+    return true;
+}
+
+// Points recorded while the socket is down wait here, kept in localStorage
+// so a reload does not lose them, and are uploaded in batches
+const LOCATION_QUEUE_KEY = 'ruralhailing.pendingLocations';
+const LOCATION_QUEUE_LIMIT = 5000;
+const LOCATION_BATCH_SIZE = 200;
+let locationUploadInFlight = false;
+
+function loadLocationQueue() {
+    try {
+        return JSON.parse(localStorage.getItem(LOCATION_QUEUE_KEY)) || [];
+    } catch (error) {
+        return [];
+    }
+}
+
+function saveLocationQueue(queue) {
+    try {
+        // Keep the newest points if the device was offline for very long
+        localStorage.setItem(LOCATION_QUEUE_KEY, JSON.stringify(queue.slice(-LOCATION_QUEUE_LIMIT)));
+    } catch (error) {
+        console.warn('Could not store queued locations:', error);
+    }
+}
+
+// Send a location live over the socket, or queue it for a batch upload
+function recordLocation(rideId, latitude, longitude, accuracy) {
+    if (!rideId) {
+        return;
+    }
+    if (sendLocation(rideId, latitude, longitude)) {
+        return;
+    }
+    const queue = loadLocationQueue();
+    queue.push({
+        ride_id: rideId,
+        latitude: latitude,
+        longitude: longitude,
+        accuracy: accuracy,
+        timestamp: new Date().toISOString()
+    });
+    saveLocationQueue(queue);
+}
+
+// Upload queued points, one ride and one batch at a time, oldest first
+async function uploadQueuedLocations() {
+    if (locationUploadInFlight || !navigator.onLine) {
+        return;
+    }
+    const queue = loadLocationQueue();
+    if (!queue.length) {
+        return;
+    }
+    const rideId = queue[0].ride_id;
+    const batch = queue.filter(point => point.ride_id === rideId).slice(0, LOCATION_BATCH_SIZE);
+
+    locationUploadInFlight = true;
+    let done = false;
+    try {
+        const response = await fetch('/api/rides/update-location/', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': getCookie('csrftoken')
+            },
+            body: JSON.stringify({ ride_id: rideId, points: batch })
+        });
+        // A client error will not go away by retrying, so drop those points too;
+        // the server ignores points it already has if a retry repeats them
+        done = response.ok || (response.status >= 400 && response.status < 500);
+    } catch (error) {
+        console.warn('Location upload failed, will retry:', error);
+    } finally {
+        locationUploadInFlight = false;
+    }
+
+    if (done) {
+        const sent = new Set(batch.map(point => `${point.ride_id}|${point.timestamp}`));
+        const remaining = loadLocationQueue().filter(point => !sent.has(`${point.ride_id}|${point.timestamp}`));
+        saveLocationQueue(remaining);
+        if (remaining.length) {
+            setTimeout(uploadQueuedLocations, 0);
+        }
+    }
+}
+
+// Sequence number of the last numbered event received; a reconnecting
+// socket asks the server to replay whatever came after it
+let lastEventSeq = null;
+
 // Initialize WebSocket connection
 function initializeWebSocket() {
     // Check if user is authenticated before connecting
     if (window.userAuthenticated) {
         // Connect to WebSocket for notifications and ride updates
         const protocol = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
-        const wsUrl = `${protocol}${window.location.host}/ws/ride-tracking/`;
+        let wsUrl = `${protocol}${window.location.host}/ws/ride-tracking/`;
+        if (lastEventSeq !== null) {
+            wsUrl += `?resume_from=${lastEventSeq}`;
+        }
         
-        const socket = new WebSocket(wsUrl);
+        const socket = new WebSocket(wsUrl, [LOCATION_SUBPROTOCOL]);
+        socket.binaryType = 'arraybuffer';
+        // Each connection starts with fresh codec state in both directions
+        socket.outgoingLocations = new LocationCodec();
+        const incomingLocations = new LocationCodec();
         
         socket.onopen = function(event) {
-            console.log('WebSocket connected');
+            console.log('WebSocket connected', socket.protocol || 'json');
+            uploadQueuedLocations();
         };
         
         socket.onmessage = function(event) {
-            const data = JSON.parse(event.data);
+            const data = event.data instanceof ArrayBuffer
+                ? incomingLocations.decode(event.data)
+                : JSON.parse(event.data);
+            if (!data) {
+                console.warn('Dropped malformed location frame');
+                return;
+            }
             console.log('Received message:', data);
+
+            if (data.type === 'resync') {
+                // Missed events are gone; pages reload their state instead
+                lastEventSeq = data.seq;
+                document.dispatchEvent(new CustomEvent('ruralhailing:resync'));
+                return;
+            }
+            if (data.seq !== undefined) {
+                if (lastEventSeq !== null && data.seq !== lastEventSeq + 1) {
+                    // A gap or a number out of step: reconnect at once and let
+                    // the server replay from the last event seen, or resync
+                    socket.resumeNow = true;
+                    socket.close();
+                    return;
+                }
+                lastEventSeq = data.seq;
+            }
             
             // Handle different types of messages
             if (data.type === 'location_update') {
-                updateRideLocation(data.latitude, data.longitude, data.ride_id);
+                updateRideLocation(data.latitude, data.longitude, data.ride_id, data.eta_seconds);
             } else if (data.type === 'ride_status_update') {
                 updateRideStatus(data.ride_id, data.status);
             } else if (data.type === 'notification') {
-                showNotification(data.message);
+                showNotification(describeNotification(data.message));
             }
         };
         
         socket.onclose = function(event) {
             console.log('WebSocket disconnected');
             // Attempt to reconnect after 3 seconds
-            setTimeout(initializeWebSocket, 3000);
+            setTimeout(initializeWebSocket, socket.resumeNow ? 0 : 3000);
         };
         
         socket.onerror = function(error) {
@@ -52,7 +276,7 @@ function initializeWebSocket() {
 }
 
 // Update ride location on map
-function updateRideLocation(latitude, longitude, rideId) {
+function updateRideLocation(latitude, longitude, rideId, etaSeconds) {
     console.log(`Updating location for ride ${rideId}: ${latitude}, ${longitude}`);
     
     // Update map if it exists
@@ -65,6 +289,12 @@ function updateRideLocation(latitude, longitude, rideId) {
     if (locationElement) {
         locationElement.textContent = `Current Location: ${latitude.toFixed(6)}, ${longitude.toFixed(6)}`;
     }
+
+    // ETA from the driver's trip meter, to the pickup or the destination
+    const etaElement = document.getElementById('eta');
+    if (etaElement && etaSeconds !== undefined && etaSeconds !== null) {
+        etaElement.textContent = Math.max(1, Math.round(etaSeconds / 60)) + ' mins';
+    }
 }
 
 // Update ride status in UI
@@ -95,6 +325,23 @@ function updateRideStatus(rideId, status) {
     }
 }
 
+// Turn a server notification payload into display text
+function describeNotification(message) {
+    if (typeof message === 'string') {
+        return message;
+    }
+    switch(message.type) {
+        case 'ride_request':
+            return `New ride request from ${message.pickup_address}`;
+        case 'ride_request_summary':
+            return `${message.count} ride requests near you, latest from ${message.pickup_address}`;
+        case 'ride_accepted':
+            return `${message.driver_name} has accepted your ride (${message.vehicle_info})`;
+        default:
+            return message.title || message.message || 'New notification';
+    }
+}
+
 // Show notification to user
 function showNotification(message, type = 'info') {
     // Create notification element